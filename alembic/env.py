@@ -20,6 +20,9 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 from infra.models.base import Base
 from infra.models.employee import Employee
+from infra.models.outbox_event import OutboxEvent
+# autogenerate leaves out the intended differences between the models and a migrated database
+from infra.migrations import DEFAULT_LOCK_TIMEOUT, include_object
 target_metadata = Base.metadata
 
 # other values from the config, defined by the needs of env.py,
@@ -46,12 +49,31 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
     )
 
     with context.begin_transaction():
         context.run_migrations()
 
 
+def configure_connection(connection) -> None:
+    """
+    every revision runs in its own transaction (the online helpers of infra.migrations commit in between), on
+    postgres DDL gives up after lock_timeout instead of queueing every query behind it -
+    alembic -x lock_timeout=10s -x statement_timeout=0 upgrade head
+    """
+    x_arguments = context.get_x_argument(as_dictionary=True)
+    if connection.dialect.name == "postgresql":
+        lock_timeout = x_arguments.get("lock_timeout", DEFAULT_LOCK_TIMEOUT)
+        statement_timeout = x_arguments.get("statement_timeout", "0")
+        # session level - also holds for the autocommit blocks of the online helpers
+        connection.exec_driver_sql(f"SET lock_timeout = '{lock_timeout}'")
+        connection.exec_driver_sql(f"SET statement_timeout = '{statement_timeout}'")
+        connection.commit()
+    context.configure(connection=connection, target_metadata=target_metadata, transaction_per_migration=True,
+                      include_object=include_object)
+
+
 def run_migrations_online() -> None:
     """Run migrations in 'online' mode.
 
@@ -59,6 +81,14 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    # a connection handed in through config.attributes (e.g. AsyncConnection.run_sync from the test templates)
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        configure_connection(connection)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
@@ -66,9 +96,7 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata
-        )
+        configure_connection(connection)
 
         with context.begin_transaction():
             context.run_migrations()
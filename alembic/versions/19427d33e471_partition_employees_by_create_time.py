@@ -0,0 +1,125 @@
+"""partition employees by create_time
+
+converts employees (postgres only, sqlite is left untouched) into a table range partitioned by month on create_time.
+postgres requires the partition key in every unique constraint, so the primary key becomes (id, create_time) and
+the uniqueness of identification_code is enforced through the employee_identification_codes table, kept in sync by
+a trigger. the rows are copied into the new table - run it in a maintenance window.
+future partitions are created by infra.partitioning (on app startup and periodically)
+
+Revision ID: 19427d33e471
+Revises: d788c6b53ffb
+Create Date: 2026-10-19 10:12:41.203514
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+from infra.partitioning import create_partition_statements, month_start, DEFAULT_PARTITION
+
+# revision identifiers, used by Alembic.
+revision = '19427d33e471'
+down_revision = 'd788c6b53ffb'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+EMPLOYEES_COLUMNS = "id, identification_code, create_time, birth_date, first_name, last_name, email, city, country, " \
+                    "street, building_number"
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("ALTER TABLE employees RENAME TO employees_unpartitioned")
+    op.execute("ALTER INDEX employees_pkey RENAME TO employees_unpartitioned_pkey")
+    op.execute("ALTER INDEX idx_employee_identification_code RENAME TO idx_employee_unpartitioned_identification_code")
+    op.execute("""
+        CREATE TABLE employees (
+            id INTEGER NOT NULL DEFAULT nextval('employees_id_seq'),
+            identification_code VARCHAR,
+            create_time TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            birth_date DATE,
+            first_name VARCHAR,
+            last_name VARCHAR,
+            email VARCHAR,
+            city VARCHAR,
+            country VARCHAR,
+            street VARCHAR,
+            building_number VARCHAR,
+            CONSTRAINT employees_pkey PRIMARY KEY (id, create_time)
+        ) PARTITION BY RANGE (create_time)
+    """)
+    op.execute("CREATE INDEX idx_employee_identification_code ON employees (identification_code)")
+    op.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF employees DEFAULT")
+
+    oldest = op.get_bind().execute(sa.text("SELECT min(create_time) FROM employees_unpartitioned")).scalar()
+    today = datetime.utcnow().date()
+    start = month_start(oldest.date() if oldest else today)
+    while start <= month_start(today, MONTHS_AHEAD):
+        for statement in create_partition_statements(start):
+            op.execute(statement)
+        start = month_start(start, 1)
+
+    op.execute(f"INSERT INTO employees ({EMPLOYEES_COLUMNS}) "
+               f"SELECT {EMPLOYEES_COLUMNS.replace('create_time', 'coalesce(create_time, CURRENT_TIMESTAMP)')} "
+               f"FROM employees_unpartitioned")
+    op.execute("ALTER SEQUENCE employees_id_seq OWNED BY employees.id")
+    op.execute("DROP TABLE employees_unpartitioned")
+
+    op.create_table('employee_identification_codes',
+    sa.Column('identification_code', sa.String(), nullable=False),
+    sa.Column('employee_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('identification_code')
+    )
+    op.execute("INSERT INTO employee_identification_codes (identification_code, employee_id) "
+               "SELECT identification_code, id FROM employees WHERE identification_code IS NOT NULL")
+    op.execute("""
+        CREATE FUNCTION employees_identification_code_guard() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND NEW.identification_code IS DISTINCT FROM OLD.identification_code) THEN
+                DELETE FROM employee_identification_codes WHERE identification_code = OLD.identification_code;
+            END IF;
+            IF NEW.identification_code IS NOT NULL AND
+               (TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.identification_code IS DISTINCT FROM OLD.identification_code)) THEN
+                -- raises unique_violation for a duplicate code, just like the unique constraint did
+                INSERT INTO employee_identification_codes (identification_code, employee_id)
+                VALUES (NEW.identification_code, NEW.id);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("CREATE TRIGGER employees_identification_code_guard AFTER INSERT OR UPDATE OR DELETE ON employees "
+               "FOR EACH ROW EXECUTE FUNCTION employees_identification_code_guard()")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("ALTER TABLE employees RENAME TO employees_partitioned")
+    op.execute("ALTER INDEX employees_pkey RENAME TO employees_partitioned_pkey")
+    op.execute("ALTER INDEX idx_employee_identification_code RENAME TO idx_employee_partitioned_identification_code")
+    op.execute("""
+        CREATE TABLE employees (
+            id INTEGER NOT NULL DEFAULT nextval('employees_id_seq'),
+            identification_code VARCHAR,
+            create_time TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            birth_date DATE,
+            first_name VARCHAR,
+            last_name VARCHAR,
+            email VARCHAR,
+            city VARCHAR,
+            country VARCHAR,
+            street VARCHAR,
+            building_number VARCHAR,
+            CONSTRAINT employees_pkey PRIMARY KEY (id),
+            CONSTRAINT employees_identification_code_key UNIQUE (identification_code)
+        )
+    """)
+    op.execute("CREATE INDEX idx_employee_identification_code ON employees (identification_code)")
+    op.execute(f"INSERT INTO employees ({EMPLOYEES_COLUMNS}) SELECT {EMPLOYEES_COLUMNS} FROM employees_partitioned")
+    op.execute("ALTER SEQUENCE employees_id_seq OWNED BY employees.id")
+    op.execute("DROP TABLE employees_partitioned")
+    op.execute("DROP FUNCTION employees_identification_code_guard()")
+    op.drop_table('employee_identification_codes')
@@ -0,0 +1,33 @@
+"""employees index cleanup
+
+drops idx_employee_identification_code where the unique constraint on identification_code already indexes it (every
+write paid for two identical indexes). postgres keeps it - since partition_employees_by_create_time the uniqueness is
+enforced through employee_identification_codes and this index is the only one on the column.
+adds an index on create_time for the after_datetime filters of BaseCrud.get_all / count
+
+Revision ID: 5b0c3e9f2a61
+Revises: 19427d33e471
+Create Date: 2026-10-19 14:02:17.550912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0c3e9f2a61'
+down_revision = '19427d33e471'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name != "postgresql":
+        op.drop_index('idx_employee_identification_code', table_name='employees')
+    op.create_index('idx_employee_create_time', 'employees', ['create_time'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_employee_create_time', table_name='employees')
+    if op.get_bind().dialect.name != "postgresql":
+        op.create_index('idx_employee_identification_code', 'employees', ['identification_code'], unique=False)
@@ -0,0 +1,28 @@
+"""outbox events aggregate index
+
+index for the dispatcher's lookup of the earlier events of a row (an event behind one that waits for its retry, or is
+claimed by another worker, is held back)
+
+Revision ID: c6f1a2d94b38
+Revises: a3e8d41f7c20
+Create Date: 2026-10-19 18:12:44.302871
+
+"""
+from alembic import op
+from infra import migrations
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6f1a2d94b38'
+down_revision = 'a3e8d41f7c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    migrations.create_index_concurrently('idx_outbox_event_aggregate', 'outbox_events',
+                                         ['aggregate_type', 'aggregate_id', 'id'])
+
+
+def downgrade() -> None:
+    migrations.drop_index_concurrently('idx_outbox_event_aggregate', 'outbox_events')
@@ -1,13 +1,23 @@
-from typing import AsyncIterator
+from typing import AsyncIterator, Optional, List, Union
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncEngine
+from sqlalchemy.orm import sessionmaker, Session
 from enums.DBType import DBType
+from enums.SQLiteProfile import SQLiteProfile
+from infra.crud.base import RELEASE_CONNECTION_AFTER_READS
+from infra.deadline import install_deadline_listeners
+from infra.pool_monitor import TimedQueuePool, pool_utilization, pool_wait_seconds
+from infra.sharding.router import ShardRouter
+from infra.sharding.session import ShardedSession
+from infra.sqlite import high_concurrency_pragmas, create_high_concurrency_engines, routing_session_class
 from settings import settings
 
 database_url: str
 
 match settings.DB_DRIVER:
+    case _ if settings.DB_SHARD_URLS:
+        # sharded mode - DB_HOST & co. are ignored, the main engine (no requests go through it) uses the first shard
+        database_url = settings.DB_SHARD_URLS[0]
     case DBType.SQLITE:
         database_url = "sqlite+aiosqlite:///db.sqlite"
     case DBType.POSTGRES:
@@ -20,7 +30,60 @@ match settings.DB_DRIVER:
     case _:
         raise NotImplementedError()
 
-engine = create_async_engine(database_url, echo=True, future=True)
+
+
+class RequestSession(Session):
+    """sync session class behind every request AsyncSession, the request deadline listeners are bound to it"""
+
+
+# engine serves all statements, except in the sqlite high concurrency profile where it is the single writer connection
+# and reads go to reader_engine
+engine: AsyncEngine
+reader_engine: Optional[AsyncEngine] = None
+request_session_class: type = RequestSession
+
+if settings.DB_DRIVER == DBType.SQLITE and settings.SQLITE_PROFILE == SQLiteProfile.HIGH_CONCURRENCY \
+        and not settings.DB_SHARD_URLS:
+    pragmas = high_concurrency_pragmas(mmap_size=settings.SQLITE_MMAP_SIZE, cache_size_kib=settings.SQLITE_CACHE_SIZE_KIB,
+                                       busy_timeout_ms=settings.SQLITE_BUSY_TIMEOUT_MS)
+    engine, reader_engine = create_high_concurrency_engines(database_url, settings.SQLITE_READER_POOL_SIZE, pragmas,
+                                                            echo=True, future=True)
+    request_session_class = routing_session_class(RequestSession, engine, reader_engine)
+    install_deadline_listeners(reader_engine.sync_engine, RequestSession)
+elif settings.DB_DRIVER == DBType.POSTGRES:
+    engine = create_async_engine(database_url, echo=True, future=True, poolclass=TimedQueuePool)
+else:
+    # NullPool - a connection per checkout, there is no pool to saturate (see infra.pool_monitor)
+    engine = create_async_engine(database_url, echo=True, future=True)
+
+install_deadline_listeners(engine.sync_engine, RequestSession)
+
+# region sharding
+shard_engines: List[AsyncEngine] = [create_async_engine(url, echo=True, future=True) for url in settings.DB_SHARD_URLS]
+shard_router: Optional[ShardRouter] = None
+if shard_engines:
+    shard_router = ShardRouter.from_settings(settings.DB_SHARDING_STRATEGY, settings.DB_SHARD_RANGES, len(shard_engines))
+    for shard_engine in shard_engines:
+        install_deadline_listeners(shard_engine.sync_engine, RequestSession)
+# endregion
+
+
+# sessions of background writers (e.g. the write batcher), not bound to a request
+background_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# sessions of long background reads (exports) - on the readers when there are any, a read streaming the whole table
+# through the single writer connection would hold back every write until it is done
+background_read_session = async_sessionmaker(reader_engine or engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def get_pool_utilization() -> Optional[float]:
+    """checked out connections relative to pool_size + max_overflow, None when the pool has no limit (NullPool)"""
+    # with a single writer connection its pool is saturated by every write, the readers tell the actual load
+    return pool_utilization((reader_engine or engine).pool)
+
+
+def get_pool_wait_seconds() -> Optional[float]:
+    """how long checkouts currently wait for a connection, None when it is not measured (NullPool)"""
+    return pool_wait_seconds((reader_engine or engine).pool)
 
 
 # async def connect():
@@ -31,7 +94,19 @@ engine = create_async_engine(database_url, echo=True, future=True)
 #     await engine.dispose()
 
 
-async def get_session() -> AsyncIterator[AsyncSession]:
-    async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=True)
-    async with async_session() as session:
+# request sessions - a connection is checked out by the first statement and returned right after every commit and
+# every read only statement, objects stay usable after that (expire_on_commit=False)
+request_session = async_sessionmaker(engine, class_=AsyncSession, sync_session_class=request_session_class,
+                                     expire_on_commit=False, info={RELEASE_CONNECTION_AFTER_READS: True})
+shard_request_sessions = [async_sessionmaker(shard_engine, class_=AsyncSession, sync_session_class=RequestSession,
+                                             expire_on_commit=False, info={RELEASE_CONNECTION_AFTER_READS: True})
+                          for shard_engine in shard_engines]
+
+
+async def get_session() -> AsyncIterator[Union[AsyncSession, ShardedSession]]:
+    if shard_engines:
+        async with ShardedSession(shard_request_sessions, shard_router) as session:
+            yield session
+        return
+    async with request_session() as session:
         yield session
@@ -0,0 +1,8 @@
+from enum import Enum
+
+
+class ExportJobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class OutboxEventType(str, Enum):
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
@@ -0,0 +1,7 @@
+from enum import IntEnum
+
+
+class RequestPriority(IntEnum):
+    READ = 0
+    WRITE = 1
+    BULK = 2
@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class SQLiteProfile(str, Enum):
+    DEFAULT = "default"
+    HIGH_CONCURRENCY = "high_concurrency"
@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class ShardingStrategy(str, Enum):
+    HASH = "hash"
+    ID_RANGE = "id_range"
@@ -0,0 +1,60 @@
+"""
+CPU time per BaseCrud call with and without the statement cache -
+python -m infra.benchmarks.statement_cache [--iterations 5000]
+"""
+import argparse
+import asyncio
+import time
+from uuid import uuid4
+from faker import Faker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from infra.crud import base as crud_base, employee as crud_employee
+from infra.crud.employee import EmployeesCrud
+from infra.crud.statement_cache import StatementCache
+from infra.general import generate_random_date
+from infra.models.base import Base
+
+
+async def run_calls(session: AsyncSession, employees_crud: EmployeesCrud, identification_code: str, iterations: int):
+    for index in range(iterations):
+        await employees_crud.get_by_id(session, index % 100 + 1)
+        await employees_crud.get_by_identification_code(session, identification_code)
+        await employees_crud.get_all(session, city="Haifa", offset=0, limit=10)
+
+
+async def measure(session: AsyncSession, employees_crud: EmployeesCrud, identification_code: str, iterations: int,
+                  cache: StatementCache) -> float:
+    crud_base.statement_cache = crud_employee.statement_cache = cache
+    await run_calls(session, employees_crud, identification_code, 10)
+    started = time.process_time()
+    await run_calls(session, employees_crud, identification_code, iterations)
+    return (time.process_time() - started) / (iterations * 3)
+
+
+async def main():
+    fake = Faker()
+    parser = argparse.ArgumentParser(description="statement cache benchmark")
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    employees_crud = EmployeesCrud()
+    async with async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as session:
+        employees = [await employees_crud.create(
+            session, identification_code=str(uuid4()), birth_date=generate_random_date(), first_name=fake.first_name(),
+            last_name=fake.last_name(), email=fake.email(), city=fake.city(), country=fake.country(),
+            street=fake.street_name(), building_number=fake.building_number()) for _ in range(100)]
+        code = employees[0].identification_code
+        # max_size=0 caches nothing - every call builds its statement like before the cache
+        uncached = await measure(session, employees_crud, code, args.iterations, StatementCache(max_size=0))
+        cache = StatementCache()
+        cached = await measure(session, employees_crud, code, args.iterations, cache)
+    await engine.dispose()
+    print(f"uncached: {uncached * 1e6:.1f}us CPU per call")
+    print(f"cached:   {cached * 1e6:.1f}us CPU per call ({100 * (1 - cached / uncached):.1f}% less), {cache.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
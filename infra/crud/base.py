@@ -1,15 +1,39 @@
+import asyncio
+import heapq
+from collections import defaultdict
 from abc import abstractmethod, ABC
+from operator import itemgetter
 from datetime import datetime
-from typing import TypeVar, Generic, List, Union
+from typing import TypeVar, Generic, List, Union, Optional, Callable, Awaitable, Dict, Any, Sequence
+from sqlalchemy import func, inspect, bindparam
 from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.engine import Result
+from sqlalchemy.sql import Executable
+from enums.OutboxEventType import OutboxEventType
+from infra.crud.errors import EntryNotFoundError
+from infra.crud.statement_cache import statement_cache
+from infra.crud.write_batcher import write_batchers
+from infra.outbox import outbox_models, create_outbox_event
+from infra.deadline import execute_cancellable
 from infra.models.base import Base
+from infra.sharding.session import ShardedSession
+from infra.sqlite import selective
 
 ModelType = TypeVar("ModelType", bound=Base)
+SessionType = Union[AsyncSession, ShardedSession]
+# session info key - read only transactions of such sessions are ended right after their statement (see execute)
+RELEASE_CONNECTION_AFTER_READS = "release_connection_after_reads"
 
 
 class BaseCrud(Generic[ModelType], ABC):
+    """
+    writes commit right away and return their objects without reloading them, sessions are expected to use
+    expire_on_commit=False and models with server defaults eager_defaults
+    """
+
     def __init__(self, model: ModelType):
         self.model = model
 
@@ -18,49 +42,252 @@ class BaseCrud(Generic[ModelType], ABC):
     def datetime_creation_field_name(self):
         pass
 
-    async def get_by_id(self, session: AsyncSession, id: int) -> Union[ModelType, None]:
-        query = select(self.model).where(self.model.id == id)
-        result = await session.execute(query)
+    @property
+    def shard_key_field_name(self) -> Optional[str]:
+        """field rows are routed by in hash sharded mode, None when only the id is routable"""
+        return None
+
+    @staticmethod
+    async def first_from_shards(session: ShardedSession, shard_id: Optional[int],
+                                method: Callable[..., Awaitable[Optional[ModelType]]], *args) -> Optional[ModelType]:
+        """runs a single row lookup on its shard, or on all shards in parallel when the shard is unknown"""
+        if shard_id is not None:
+            return await method(session.shard(shard_id), *args)
+        results = await asyncio.gather(*(method(shard, *args) for shard in session.shards()))
+        return next((result for result in results if result is not None), None)
+
+    @staticmethod
+    async def execute(session: AsyncSession, query: Executable, params: Optional[Dict[str, Any]] = None) -> Result:
+        # pending changes are flushed by the query and belong to the caller's transaction
+        release = session.info.get(RELEASE_CONNECTION_AFTER_READS) and \
+            not (session.new or session.dirty or session.deleted)
+        result = await execute_cancellable(session, query, params)
+        if release:
+            # the rows are buffered - ending the read only transaction returns the connection to the pool now instead
+            # of when the session is closed, which is only after the response was sent
+            await session.commit()
+        return result
+
+    async def get_by_id(self, session: SessionType, id: int) -> Union[ModelType, None]:
+        if isinstance(session, ShardedSession):
+            try:
+                shard_id = session.router.shard_for_id(id)
+            except KeyError:
+                # outside the id ranges of the shard map - no row can have it
+                return None
+            return await self.first_from_shards(session, shard_id, self.get_by_id, id)
+        query = statement_cache.get((self.model, "get_by_id"),
+                                    lambda: select(self.model).where(self.model.id == bindparam("id")))
+        result = await self.execute(session, query, dict(id=id))
         return result.scalars().first()
 
-    async def get_by_foreign_key(self, session: AsyncSession, foreign_key: str, value: int) -> Union[ModelType, None]:
-        query = (
+    async def get_by_ids(self, session: SessionType, ids: Sequence[int]) -> List[Optional[ModelType]]:
+        shard_for = session.router.shard_for_id if isinstance(session, ShardedSession) else None
+        return await self.get_by_field_values(session, "id", ids, shard_for)
+
+    async def get_by_field_values(self, session: SessionType, field_name: str, values: Sequence[Any],
+                                  shard_for: Callable[[Any], Optional[int]] = None) -> List[Optional[ModelType]]:
+        """
+        rows whose `field_name` is one of `values` with a single IN query (per shard), in the order of `values` with
+        None for the missing ones. `shard_for` maps a value to its shard, values of an unknown shard go to all shards
+        and values it raises KeyError for (outside the shard map) are missing
+        """
+        if not values:
+            return []
+        if isinstance(session, ShardedSession):
+            values_by_shard = defaultdict(list)
+            for value in dict.fromkeys(values):
+                try:
+                    shard_id = shard_for(value) if shard_for else None
+                except KeyError:
+                    continue
+                for shard in [shard_id] if shard_id is not None else range(len(session.session_makers)):
+                    values_by_shard[shard].append(value)
+            results = await asyncio.gather(*(self.get_by_field_values(session.shard(shard), field_name, shard_values)
+                                             for shard, shard_values in values_by_shard.items()))
+            found = {getattr(obj, field_name): obj for result in results for obj in result if obj is not None}
+            return [found.get(value) for value in values]
+        # expanding - one cached statement whatever the number of values
+        query = statement_cache.get((self.model, "get_by_field_values", field_name), lambda: (
+            select(self.model).where(getattr(self.model, field_name).in_(bindparam("values", expanding=True)))
+        ))
+        result = await self.execute(session, query, dict(values=list(dict.fromkeys(values))))
+        found = {getattr(obj, field_name): obj for obj in result.scalars()}
+        return [found.get(value) for value in values]
+
+    async def get_by_foreign_key(self, session: SessionType, foreign_key: str, value: int) -> Union[ModelType, None]:
+        if isinstance(session, ShardedSession):
+            return await self.first_from_shards(session, None, self.get_by_foreign_key, foreign_key, value)
+        query = statement_cache.get((self.model, "get_by_foreign_key", foreign_key), lambda: (
             select(self.model)
             .options(selectinload(getattr(self.model, foreign_key)))
-            .where(getattr(self.model, foreign_key).id == value)
-        )
-        result = await session.execute(query)
+            .where(getattr(self.model, foreign_key).id == bindparam("value"))
+        ))
+        result = await self.execute(session, query, dict(value=value))
         return result.scalars().first()
 
-    async def get_all(self, session: AsyncSession, after_datetime: datetime = None, offset: int = None,
-                      limit: int = None, **kwargs) -> List[ModelType]:
-        query = select(self.model)
-        for key, value in kwargs.items():
-            query = query.where(getattr(self.model, key) == value)
-        if after_datetime:
-            query = query.where(getattr(self.model, self.datetime_creation_field_name) >= after_datetime)
-        if offset is not None:
-            query = query.offset(offset)
-        if limit is not None:
-            query = query.limit(limit)
-        result = await session.execute(query)
+    async def get_all(self, session: SessionType, after_datetime: datetime = None, offset: int = None,
+                      limit: int = None, after_id: int = None, **kwargs) -> List[ModelType]:
+        """rows ordered by id, `after_id` is the keyset alternative to `offset` (cheaper on deep pages)"""
+        if isinstance(session, ShardedSession):
+            # every shard returns its first offset + limit rows, the global page is cut from their merge
+            shard_limit = None if limit is None else limit + (offset or 0)
+            results = await asyncio.gather(*(self.get_all(shard, after_datetime, limit=shard_limit, after_id=after_id,
+                                                          **kwargs) for shard in session.shards()))
+            merged = list(heapq.merge(*results, key=lambda obj: obj.id))
+            return merged[offset or 0:shard_limit]
+        shape = (self.model, "get_all", self.filter_keys(kwargs), after_datetime is not None, after_id is not None,
+                 offset is not None, limit is not None)
+        query = statement_cache.get(shape, lambda: self.build_get_all_query(*shape[2:]))
+        params = self.filter_params(after_datetime, **kwargs)
+        params.update(after_id=after_id, offset=offset, limit=limit)
+        result = await self.execute(session, query, params)
         return result.scalars().all()
 
-    async def create(self, session: AsyncSession, **kwargs) -> ModelType:
-        obj = self.model(**kwargs)
-        session.add(obj)
-        await session.commit()
-        await session.refresh(obj)
-        return obj
+    async def get_all_rows(self, session: SessionType, column_names: Sequence[str], after_datetime: datetime = None,
+                           offset: int = None, limit: int = None, after_id: int = None, **kwargs) -> List[tuple]:
+        """
+        get_all as plain tuples of `column_names` (which include id) - no orm objects, for responses that are
+        serialized straight from the rows
+        """
+        if isinstance(session, ShardedSession):
+            shard_limit = None if limit is None else limit + (offset or 0)
+            results = await asyncio.gather(*(self.get_all_rows(shard, column_names, after_datetime, limit=shard_limit,
+                                                               after_id=after_id, **kwargs)
+                                             for shard in session.shards()))
+            merged = list(heapq.merge(*results, key=itemgetter(list(column_names).index("id"))))
+            return merged[offset or 0:shard_limit]
+        shape = (self.model, "get_all_rows", tuple(column_names), self.filter_keys(kwargs), after_datetime is not None,
+                 after_id is not None, offset is not None, limit is not None)
+        query = statement_cache.get(shape, lambda: self.build_get_all_query(*shape[3:], column_names=shape[2]))
+        params = self.filter_params(after_datetime, **kwargs)
+        params.update(after_id=after_id, offset=offset, limit=limit)
+        result = await self.execute(session, query, params)
+        return [tuple(row) for row in result]
 
-    async def update(self, session: AsyncSession, obj: ModelType, **kwargs) -> ModelType:
+    def build_get_all_query(self, filter_keys: tuple, has_after_datetime: bool, has_after_id: bool, has_offset: bool,
+                            has_limit: bool, column_names: tuple = ()):
+        selected = select(*(getattr(self.model, name) for name in column_names)) if column_names else select(self.model)
+        query = self.filter_query(selected, filter_keys, has_after_datetime).order_by(self.model.id)
+        if has_after_id:
+            query = query.where(self.model.id > bindparam("after_id"))
+        if has_offset:
+            query = query.offset(bindparam("offset"))
+        if has_limit:
+            query = query.limit(bindparam("limit"))
+        return query
+
+    async def count(self, session: SessionType, after_datetime: datetime = None, **kwargs) -> int:
+        if isinstance(session, ShardedSession):
+            return sum(await asyncio.gather(*(self.count(shard, after_datetime, **kwargs)
+                                              for shard in session.shards())))
+        filter_keys = self.filter_keys(kwargs)
+        query = statement_cache.get((self.model, "count", filter_keys, after_datetime is not None), lambda: (
+            self.filter_query(select(func.count()).select_from(self.model), filter_keys, after_datetime is not None)
+        ))
+        result = await self.execute(session, query, self.filter_params(after_datetime, **kwargs))
+        return result.scalar_one()
+
+    @staticmethod
+    def filter_keys(kwargs: Dict[str, Any]) -> tuple:
+        """(key, is None) of every filter - `key = NULL` matches nothing, a None filter is a query shape of its own"""
+        return tuple((key, value is None) for key, value in kwargs.items())
+
+    def filter_query(self, query, filter_keys: tuple, has_after_datetime: bool):
+        for key, is_null in filter_keys:
+            column = getattr(self.model, key)
+            query = query.where(column.is_(None) if is_null else column == bindparam(f"filter_{key}"))
+        if has_after_datetime:
+            # after_datetime asks for the recent rows, without the hint sqlite ignores the index on the column
+            query = query.where(selective(
+                getattr(self.model, self.datetime_creation_field_name) >= bindparam("after_datetime")))
+        return query
+
+    @staticmethod
+    def filter_params(after_datetime: datetime = None, **kwargs) -> Dict[str, Any]:
+        params = {f"filter_{key}": value for key, value in kwargs.items() if value is not None}
+        if after_datetime is not None:
+            params.update(after_datetime=after_datetime)
+        return params
+
+    async def create(self, session: SessionType, **kwargs) -> ModelType:
+        if isinstance(session, ShardedSession):
+            shard_key = kwargs.get(self.shard_key_field_name) if self.shard_key_field_name else None
+            shard_id = session.router.shard_for_new_row(shard_key, kwargs.get("id"))
+            # an id generated by the shard has to route back to it, otherwise the row could never be found
+            return await self._insert(session.shard(shard_id), kwargs, OutboxEventType.CREATED,
+                                      check_row=lambda obj: session.router.check_new_id(shard_id, obj.id))
+        write_batcher = write_batchers.get(self.model)
+        if write_batcher is not None and write_batcher.serves(session):
+            return await write_batcher.create(**kwargs)
+        return await self._insert(session, kwargs, OutboxEventType.CREATED)
+
+    async def update(self, session: SessionType, obj: ModelType, **kwargs) -> ModelType:
+        if isinstance(session, ShardedSession):
+            return await self.update_sharded(session, obj, **kwargs)
+        write_batcher = write_batchers.get(self.model)
+        if write_batcher is not None and write_batcher.serves(session):
+            return await write_batcher.update(obj.id, **kwargs)
         for key, value in kwargs.items():
             setattr(obj, key, value)
-        await session.merge(obj)
+        obj = await session.merge(obj)
+        if obj in session.new:
+            # merge found no row to update and would insert it again
+            session.expunge(obj)
+            raise EntryNotFoundError(f"{self.model.__tablename__} {obj.id} not found")
+        if self.model in outbox_models:
+            session.add(create_outbox_event(obj, OutboxEventType.UPDATED))
+        try:
+            await session.commit()
+        except StaleDataError:
+            # deleted after it was loaded into this session - the UPDATE matched no row
+            await session.rollback()
+            raise EntryNotFoundError(f"{self.model.__tablename__} {obj.id} not found")
+        return obj
+
+    async def delete(self, session: SessionType, obj: ModelType):
+        if isinstance(session, ShardedSession):
+            return await self.delete(session.shard(session.shard_of(obj)), obj)
+        await self._remove(session, obj, OutboxEventType.DELETED)
+
+    async def _insert(self, session: AsyncSession, values: Dict[str, Any], event_type: Optional[OutboxEventType],
+                      check_row: Optional[Callable[[ModelType], None]] = None) -> ModelType:
+        """`check_row` runs before the commit, when it raises the insert is rolled back"""
+        obj = self.model(**values)
+        session.add(obj)
+        add_event = event_type is not None and self.model in outbox_models
+        if add_event or check_row is not None:
+            # the event / the check need the id of the new row
+            await session.flush()
+        if check_row is not None:
+            try:
+                check_row(obj)
+            except Exception:
+                await session.rollback()
+                raise
+        if add_event:
+            session.add(create_outbox_event(obj, event_type))
+        # server defaults come back with the INSERT (eager_defaults), no refresh checking out a connection again
         await session.commit()
-        await session.refresh(obj)
         return obj
 
-    async def delete(self, session: AsyncSession, obj: ModelType):
+    async def _remove(self, session: AsyncSession, obj: ModelType, event_type: Optional[OutboxEventType]):
+        if event_type is not None and self.model in outbox_models:
+            session.add(create_outbox_event(obj, event_type))
         await session.delete(obj)
         await session.commit()
+
+    async def update_sharded(self, session: ShardedSession, obj: ModelType, **kwargs) -> ModelType:
+        shard_id = session.shard_of(obj)
+        target_shard_id = None
+        if self.shard_key_field_name and self.shard_key_field_name in kwargs:
+            target_shard_id = session.router.shard_for_key(kwargs[self.shard_key_field_name])
+        if target_shard_id is None or target_shard_id == shard_id:
+            return await self.update(session.shard(shard_id), obj, **kwargs)
+        # the new shard key belongs to another shard - the row moves (insert first so it is never missing).
+        # consumers see a single update, the shards' outboxes are not ordered with each other
+        values = {attribute.key: getattr(obj, attribute.key) for attribute in inspect(self.model).column_attrs}
+        values.update(kwargs)
+        moved = await self._insert(session.shard(target_shard_id), values, OutboxEventType.UPDATED)
+        await self._remove(session.shard(shard_id), obj, None)
+        return moved
@@ -1,10 +1,11 @@
-from typing import Optional
+from typing import Optional, List, Sequence
 
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, bindparam
 
-from infra.crud.base import BaseCrud
+from infra.crud.base import BaseCrud, SessionType
+from infra.crud.statement_cache import statement_cache
 from infra.models.employee import Employee
+from infra.sharding.session import ShardedSession
 
 
 class EmployeesCrud(BaseCrud):
@@ -12,10 +13,24 @@ class EmployeesCrud(BaseCrud):
     def datetime_creation_field_name(self):
         return "create_time"
 
+    @property
+    def shard_key_field_name(self):
+        return "identification_code"
+
     def __init__(self):
         super().__init__(Employee)
 
-    async def get_by_identification_code(self, session: AsyncSession, identification_code: str) -> Optional[Employee]:
-        query = select(self.model).where(self.model.identification_code == identification_code)
-        result = await session.execute(query)
+    async def get_by_identification_code(self, session: SessionType, identification_code: str) -> Optional[Employee]:
+        if isinstance(session, ShardedSession):
+            return await self.first_from_shards(session, session.router.shard_for_key(identification_code),
+                                                self.get_by_identification_code, identification_code)
+        query = statement_cache.get((self.model, "get_by_identification_code"), lambda: (
+            select(self.model).where(self.model.identification_code == bindparam("identification_code"))
+        ))
+        result = await self.execute(session, query, dict(identification_code=identification_code))
         return result.scalars().first()
+
+    async def get_by_identification_codes(self, session: SessionType,
+                                          identification_codes: Sequence[str]) -> List[Optional[Employee]]:
+        shard_for = session.router.shard_for_key if isinstance(session, ShardedSession) else None
+        return await self.get_by_field_values(session, "identification_code", identification_codes, shard_for)
@@ -0,0 +1,2 @@
+class EntryNotFoundError(LookupError):
+    """the row a write targets does not exist (anymore), e.g. deleted between the lookup and the update"""
@@ -0,0 +1,36 @@
+from typing import Any, Callable, Dict, Hashable
+from sqlalchemy.sql import Executable
+
+
+class StatementCache:
+    """
+    statements by query shape (e.g. which filters a get_all call uses), built once with bind parameters in place of
+    the values. a reused statement object skips both the construction and the cache key generation sqlalchemy needs
+    to find its compiled form
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._statements: Dict[Hashable, Executable] = {}
+
+    def get(self, key: Hashable, build: Callable[[], Executable]) -> Executable:
+        statement = self._statements.get(key)
+        if statement is not None:
+            self.hits += 1
+            return statement
+        self.misses += 1
+        statement = build()
+        # shapes come from code, the bound only protects against callers building keys from input
+        if len(self._statements) < self.max_size:
+            self._statements[key] = statement
+        return statement
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self._statements),
+                    hitRatio=self.hits / lookups if lookups else 0)
+
+
+statement_cache = StatementCache()
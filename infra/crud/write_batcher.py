@@ -0,0 +1,162 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from infra.crud.errors import EntryNotFoundError
+from enums.OutboxEventType import OutboxEventType
+from infra.logger import get_logger
+from infra.outbox import outbox_models, create_outbox_event
+
+logger = get_logger(__file__)
+
+
+@dataclass
+class WriteRequest:
+    values: Dict[str, Any]
+    future: asyncio.Future
+    enqueue_time: float
+    # None for a create
+    id: Optional[int] = None
+
+
+@dataclass
+class WriteBatcherStats:
+    batches: int = 0
+    rows: int = 0
+    retried_batches: int = 0
+    failed_rows: int = 0
+    max_batch_size: int = 0
+    total_latency_seconds: float = 0
+    max_latency_seconds: float = 0
+
+    def record(self, batch_size: int, latency_seconds: float):
+        self.batches += 1
+        self.rows += batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.total_latency_seconds += latency_seconds
+        self.max_latency_seconds = max(self.max_latency_seconds, latency_seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(batches=self.batches, rows=self.rows, retriedBatches=self.retried_batches,
+                    failedRows=self.failed_rows, maxBatchSize=self.max_batch_size,
+                    avgBatchSize=self.rows / self.batches if self.batches else 0,
+                    avgLatencyMs=1000 * self.total_latency_seconds / self.batches if self.batches else 0,
+                    maxLatencyMs=1000 * self.max_latency_seconds)
+
+
+class WriteBatcher:
+    """
+    group commit - single row creates / updates submitted concurrently are collected for up to max_delay_seconds
+    (or max_batch_size rows) and written in one transaction, so a burst pays for one commit instead of one per row.
+    when the batch fails every row is retried in its own transaction, so each caller gets its own result or error
+    (e.g. IntegrityError for a duplicate key, EntryNotFoundError for an update of a missing row).
+    only serves sessions bound to the engine of its own sessions (see serves) - shard sessions write row by row
+    """
+
+    def __init__(self, model, session_maker: async_sessionmaker, max_batch_size: int, max_delay_seconds: float):
+        self.model = model
+        self.session_maker = session_maker
+        self.max_batch_size = max_batch_size
+        self.max_delay_seconds = max_delay_seconds
+        self.stats = WriteBatcherStats()
+        self._pending: List[WriteRequest] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+    def serves(self, session) -> bool:
+        """
+        whether writes of `session` may go through this batcher - it writes through its own sessions, a session on
+        another engine (a ShardedSession, one of its shard sessions) would get its row written to the wrong db
+        """
+        return isinstance(session, AsyncSession) and session.bind is self.session_maker.kw.get("bind")
+
+    async def create(self, **kwargs):
+        return await self._submit(kwargs)
+
+    async def update(self, obj_id: int, **kwargs):
+        # rows are updated by id, the id itself is not updatable
+        kwargs.pop("id", None)
+        return await self._submit(kwargs, obj_id)
+
+    async def _submit(self, values: Dict[str, Any], id: Optional[int] = None):
+        loop = asyncio.get_running_loop()
+        request = WriteRequest(values=values, future=loop.create_future(), enqueue_time=time.monotonic(), id=id)
+        self._pending.append(request)
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_delay_seconds, self._flush)
+        return await request.future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+        if self._pending:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.max_delay_seconds, self._flush)
+        task = asyncio.create_task(self._run_batch(batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: List[WriteRequest]):
+        try:
+            await self._write(batch)
+        except Exception as ex:
+            if len(batch) == 1:
+                self.stats.failed_rows += 1
+                if not batch[0].future.done():
+                    batch[0].future.set_exception(ex)
+                return
+            logger.info("write batch failed, retrying row by row", extra=dict(batchSize=len(batch)))
+            self.stats.retried_batches += 1
+            await asyncio.gather(*(self._run_batch([request]) for request in batch))
+            return
+        self.stats.record(len(batch), time.monotonic() - min(request.enqueue_time for request in batch))
+
+    async def _write(self, batch: List[WriteRequest]):
+        async with self.session_maker() as session:
+            update_ids = {request.id for request in batch if request.id is not None}
+            existing = {}
+            if update_ids:
+                result = await session.execute(select(self.model).where(self.model.id.in_(update_ids)))
+                existing = {obj.id: obj for obj in result.scalars()}
+            written = []
+            for request in batch:
+                obj = existing.get(request.id) if request.id is not None else self.model()
+                if obj is not None:
+                    for key, value in request.values.items():
+                        setattr(obj, key, value)
+                    if request.id is None:
+                        session.add(obj)
+                written.append(obj)
+            # one flush - inserts go out as a multi row INSERT
+            await session.flush()
+            written_ids = [obj.id if obj is not None else None for obj in written]
+            if self.model in outbox_models:
+                for request, obj in zip(batch, written):
+                    if obj is not None:
+                        event_type = OutboxEventType.CREATED if request.id is None else OutboxEventType.UPDATED
+                        session.add(create_outbox_event(obj, event_type))
+            await session.commit()
+            # reload once for the whole batch, server side defaults included (like BaseCrud.create's refresh)
+            result = await session.execute(select(self.model).where(self.model.id.in_(
+                [id for id in written_ids if id is not None])).execution_options(populate_existing=True))
+            fresh = {obj.id: obj for obj in result.scalars()}
+        for request, id in zip(batch, written_ids):
+            if request.future.done():
+                continue
+            if id is None:
+                request.future.set_exception(EntryNotFoundError(f"{self.model.__tablename__} {request.id} not found"))
+            else:
+                request.future.set_result(fresh.get(id))
+
+
+# write batchers by model, BaseCrud.create / update go through the batcher of their model when there is one
+write_batchers: Dict[Any, WriteBatcher] = {}
+
+
+def register_write_batcher(write_batcher: WriteBatcher):
+    write_batchers[write_batcher.model] = write_batcher
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Optional, Dict, Any
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, Result
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Executable
+from enums.DBType import DBType
+from infra.logger import get_logger
+
+logger = get_logger(__file__)
+
+# absolute deadline (time.monotonic()) of the request being served, None when there is no deadline
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+# statement currently executed through `execute_cancellable`, filled with its driver connection by the engine listener
+in_flight_statement: ContextVar[Optional["InFlightStatement"]] = ContextVar("in_flight_statement", default=None)
+
+# number of sqlite VM instructions between two deadline checks
+SQLITE_PROGRESS_HANDLER_INTERVAL = 1000
+
+
+def get_remaining_seconds() -> Optional[float]:
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+class _ConnectionDeadline:
+    """deadline of the statement currently running on a sqlite connection, read by the progress handler thread"""
+
+    def __init__(self):
+        self.deadline: Optional[float] = None
+
+    def is_exceeded(self) -> int:
+        return int(self.deadline is not None and time.monotonic() > self.deadline)
+
+
+class InFlightStatement:
+    def __init__(self):
+        self.driver_connection = None
+
+
+# sqlalchemy dialect name -> DBType
+DIALECT_DB_TYPES = {"postgresql": DBType.POSTGRES, "sqlite": DBType.SQLITE}
+
+
+def set_statement_timeout(session: Session, transaction, connection):
+    """session after_begin listener - postgres connections get the remaining time as statement_timeout"""
+    remaining_seconds = get_remaining_seconds()
+    if remaining_seconds is not None and connection.dialect.name == "postgresql":
+        # SET does not accept bound parameters
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(remaining_seconds * 1000), 1)}")
+
+
+def install_deadline_listeners(engine: Engine, session_class: type):
+    """
+    propagates the request deadline to the db, by the engine's dialect (every engine of a sharded setup can differ) -
+    postgres: `SET LOCAL statement_timeout` with the remaining time when a session transaction begins (one listener
+    per session class, however many engines share it)
+    sqlite: a progress handler that interrupts the running statement once the deadline has passed
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def track_in_flight_statement(connection, cursor, statement, parameters, context, executemany):
+        in_flight = in_flight_statement.get()
+        if in_flight is not None:
+            in_flight.driver_connection = connection.connection.driver_connection
+
+    match DIALECT_DB_TYPES.get(engine.dialect.name):
+        case DBType.POSTGRES:
+            if not event.contains(session_class, "after_begin", set_statement_timeout):
+                event.listen(session_class, "after_begin", set_statement_timeout)
+        case DBType.SQLITE:
+            @event.listens_for(engine, "connect")
+            def set_progress_handler(dbapi_connection, connection_record):
+                connection_deadline = _ConnectionDeadline()
+                connection_record.info["deadline"] = connection_deadline
+                dbapi_connection.await_(dbapi_connection.driver_connection.set_progress_handler(
+                    connection_deadline.is_exceeded, SQLITE_PROGRESS_HANDLER_INTERVAL))
+
+            @event.listens_for(engine, "before_cursor_execute")
+            def set_connection_deadline(connection, cursor, statement, parameters, context, executemany):
+                connection_deadline = connection.info.get("deadline")
+                if connection_deadline is not None:
+                    connection_deadline.deadline = request_deadline.get()
+
+
+async def execute_cancellable(session: AsyncSession, query: Executable,
+                              params: Optional[Dict[str, Any]] = None) -> Result:
+    """
+    session.execute that stops the running statement when the awaiting task is cancelled (e.g. client disconnected).
+    the statement runs in its own task so the cancellation can be handled before sqlalchemy sees it -
+    sqlite statements keep running on the aiosqlite thread and are interrupted, other drivers (asyncpg) cancel the
+    running statement on the server by themselves once their task is cancelled.
+    the session is rolled back afterwards so the connection goes back to the pool clean
+    """
+    in_flight = InFlightStatement()
+    token = in_flight_statement.set(in_flight)
+    try:
+        execution = asyncio.ensure_future(session.execute(query, params))
+    finally:
+        in_flight_statement.reset(token)
+    try:
+        return await asyncio.shield(execution)
+    except asyncio.CancelledError:
+        await _cancel_execution(session, execution, in_flight)
+        raise
+
+
+async def _cancel_execution(session: AsyncSession, execution: asyncio.Future, in_flight: InFlightStatement):
+    try:
+        interrupt = getattr(in_flight.driver_connection, "interrupt", None)
+        if interrupt is not None and not execution.done():
+            await interrupt()
+        else:
+            execution.cancel()
+        await asyncio.wait({execution})
+        if not execution.cancelled():
+            # the interrupted statement fails, its error is expected
+            execution.exception()
+        await session.rollback()
+    except Exception:
+        logger.exception("error at cancel_execution")
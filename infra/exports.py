@@ -0,0 +1,219 @@
+"""
+table snapshots as parquet files, written by background export jobs (see routes/exports/v1).
+rows are read with a server side cursor, converted to arrow record batches in a process pool and appended to one
+parquet file per job. jobs live in memory - poll the worker that started the job. finished jobs and their files
+are removed after job_ttl_seconds, or earlier when more than max_jobs jobs are kept
+"""
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+from sqlalchemy import select, Integer, DateTime, Date
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from enums.ExportJobStatus import ExportJobStatus
+from infra.logger import get_logger
+
+logger = get_logger(__file__)
+
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+
+def arrow_fields(model) -> List[Tuple[str, str]]:
+    """(column name, arrow type name) of the model's columns, plain strings so they pickle into the process pool"""
+    fields = []
+    for column in model.__table__.columns:
+        if isinstance(column.type, Integer):
+            type_name = "int64"
+        elif isinstance(column.type, DateTime):
+            type_name = "timestamp"
+        elif isinstance(column.type, Date):
+            type_name = "date32"
+        else:
+            type_name = "string"
+        fields.append((column.name, type_name))
+    return fields
+
+
+def arrow_schema(fields: List[Tuple[str, str]]):
+    import pyarrow as pa
+
+    types = dict(int64=pa.int64(), timestamp=pa.timestamp("us"), date32=pa.date32(), string=pa.string())
+    return pa.schema([(name, types[type_name]) for name, type_name in fields])
+
+
+def rows_to_arrow_ipc(fields: List[Tuple[str, str]], rows: List[tuple]) -> bytes:
+    """runs in the process pool - the python objects to columns conversion is the cpu bound part of an export"""
+    import pyarrow as pa
+
+    schema = arrow_schema(fields)
+    columns = [pa.array([row[index] for row in rows], type=field.type) for index, field in enumerate(schema)]
+    batch = pa.RecordBatch.from_arrays(columns, schema=schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+@dataclass
+class ExportJob:
+    id: str
+    path: str
+    status: ExportJobStatus = ExportJobStatus.PENDING
+    create_time: datetime = field(default_factory=datetime.utcnow)
+    finish_time: Optional[datetime] = None
+    rows: int = 0
+    error: Optional[str] = None
+
+
+class ExportJobManager:
+    """
+    starts export jobs as asyncio tasks and keeps their state. in sharded mode there is a session maker per shard and
+    the file holds the shards one after the other
+    """
+
+    def __init__(self, model, session_makers: List[async_sessionmaker], directory: str, batch_size: int,
+                 process_pool_size: int, max_running_jobs: int, job_ttl_seconds: float, max_jobs: int):
+        self.model = model
+        self.session_makers = session_makers
+        self.directory = directory
+        self.batch_size = batch_size
+        self.process_pool_size = process_pool_size
+        self.max_running_jobs = max_running_jobs
+        self.job_ttl_seconds = job_ttl_seconds
+        self.max_jobs = max_jobs
+        self.jobs: Dict[str, ExportJob] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def running_jobs(self) -> int:
+        return len(self._tasks)
+
+    def start(self) -> Optional[ExportJob]:
+        """None when max_running_jobs jobs are already running"""
+        if self.running_jobs >= self.max_running_jobs:
+            return None
+        self._remove_expired_jobs(reserve=1)
+        self._remove_orphan_files()
+        job_id = uuid4().hex
+        job = ExportJob(id=job_id, path=os.path.join(self.directory, f"{self.model.__tablename__}-{job_id}.parquet"))
+        self.jobs[job_id] = job
+        # an empty context - the job must not inherit the request's deadline (or anything else of the request)
+        task = asyncio.create_task(self._run(job), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        self._remove_expired_jobs()
+        return self.jobs.get(job_id)
+
+    def _remove_expired_jobs(self, reserve: int = 0):
+        """
+        drops finished jobs older than job_ttl_seconds, and the oldest finished ones while more than max_jobs - reserve
+        are kept. running jobs are never dropped. a download still streaming a deleted file keeps reading it
+        """
+        expire_before = datetime.utcnow() - timedelta(seconds=self.job_ttl_seconds)
+        finished = sorted((job for job in self.jobs.values() if job.finish_time is not None),
+                          key=lambda job: job.finish_time)
+        excess = len(self.jobs) - (self.max_jobs - reserve)
+        for index, job in enumerate(finished):
+            if job.finish_time >= expire_before and index >= excess:
+                break
+            del self.jobs[job.id]
+            self._remove_file(job.path)
+
+    def _remove_orphan_files(self):
+        """files of jobs this process does not know (left by a restarted worker) once they are older than the ttl"""
+        if not os.path.isdir(self.directory):
+            return
+        known_paths = {job.path for job in self.jobs.values()}
+        known_paths |= {f"{path}.partial" for path in known_paths}
+        expire_before = time.time() - self.job_ttl_seconds
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(f"{self.model.__tablename__}-") and entry.path not in known_paths \
+                        and entry.stat().st_mtime < expire_before:
+                    self._remove_file(entry.path)
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(cancel_futures=True)
+            self._process_pool = None
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        # created on the first export, importing the app does not fork anything
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.process_pool_size)
+        return self._process_pool
+
+    async def _run(self, job: ExportJob):
+        partial_path = f"{job.path}.partial"
+        job.status = ExportJobStatus.RUNNING
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            job.rows = await self._export(partial_path)
+            os.replace(partial_path, job.path)
+            job.status = ExportJobStatus.SUCCEEDED
+            logger.info("export finished", extra=dict(jobId=job.id, rows=job.rows))
+        except BaseException as ex:
+            job.status = ExportJobStatus.FAILED
+            job.error = type(ex).__name__
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            if not isinstance(ex, Exception):
+                raise
+            logger.exception("error at export", extra=dict(jobId=job.id))
+        finally:
+            job.finish_time = datetime.utcnow()
+
+    async def _export(self, path: str) -> int:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        loop = asyncio.get_running_loop()
+        process_pool = self._get_process_pool()
+        fields = arrow_fields(self.model)
+        columns = [getattr(self.model, name) for name, _ in fields]
+        writer = pq.ParquetWriter(path, arrow_schema(fields))
+        rows = 0
+
+        async def write(conversion: asyncio.Future):
+            # the ipc buffer is read in place, no copy before the parquet encoding
+            table = pa.ipc.open_stream(pa.py_buffer(await conversion)).read_all()
+            await asyncio.to_thread(writer.write_table, table)
+
+        try:
+            for session_maker in self.session_makers:
+                async with session_maker() as session:
+                    result = await session.stream(select(*columns).order_by(self.model.id)
+                                                  .execution_options(yield_per=self.batch_size))
+                    pending = None
+                    async for partition in result.partitions():
+                        batch = [tuple(row) for row in partition]
+                        rows += len(batch)
+                        # the next chunk is fetched while the previous one is converted and written
+                        conversion = loop.run_in_executor(process_pool, rows_to_arrow_ipc, fields, batch)
+                        if pending is not None:
+                            await write(pending)
+                        pending = conversion
+                    if pending is not None:
+                        await write(pending)
+        finally:
+            await asyncio.to_thread(writer.close)
+        return rows
@@ -3,3 +3,7 @@ class ErrorMessages:
     ENTRY_NOT_EXIST: str = "ENTRY_NOT_EXIST"
     ENTRY_ALREADY_EXIST: str = "ENTRY_ALREADY_EXIST"
     INTERNAL_ERROR: str = "INTERNAL_ERROR"
+    SERVICE_OVERLOADED: str = "SERVICE_OVERLOADED"
+    DEADLINE_EXCEEDED: str = "DEADLINE_EXCEEDED"
+    TOO_MANY_KEYS: str = "TOO_MANY_KEYS"
+    EXPORT_NOT_FINISHED: str = "EXPORT_NOT_FINISHED"
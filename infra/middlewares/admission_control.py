@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from starlette.responses import JSONResponse
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+from starlette.types import ASGIApp, Receive, Scope, Send
+from enums.RequestPriority import RequestPriority
+from infra.logger import get_logger
+from infra.messages.error_messages import ErrorMessages
+from infra.middlewares.general import get_route_key
+
+logger = get_logger(__file__)
+
+
+class PriorityLimiter:
+    """
+    concurrency limiter with a bounded waiting queue.
+    a released slot is handed directly to the waiter with the lowest priority value (FIFO within a priority)
+    """
+
+    def __init__(self, concurrency: int, max_queue_depth: int):
+        self.concurrency = concurrency
+        self.max_queue_depth = max_queue_depth
+        self.active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: RequestPriority, timeout: float) -> bool:
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queue_depth:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (int(priority), next(self._sequence), waiter)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            # the slot may have been handed over right as the timeout fired
+            return waiter.done() and not waiter.cancelled()
+        except BaseException:
+            # the slot may have been handed over just before we got cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # hand the slot over, self.active stays the same
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+
+class AdmissionControlMiddleware:
+    """
+    admission control in two levels - every route gets its own PriorityLimiter and all routes share a global one
+    (sized to what the db pool can serve) where reads are admitted before writes and bulk operations.
+    requests that can not be admitted (queue is full, waited too long or, for bulk routes, the db pool is saturated -
+    all its connections are checked out or checkouts wait longer than pool_wait_threshold_seconds) are rejected with
+    503 + Retry-After instead of piling up behind the db pool. exempt routes (file downloads) pass without a slot
+    """
+
+    def __init__(self, app: ASGIApp, global_concurrency: int, default_concurrency: int, max_queue_depth: int,
+                 max_queue_wait_seconds: float, retry_after_seconds: int,
+                 route_concurrency: Optional[Dict[str, int]] = None,
+                 bulk_routes: Optional[List[str]] = None, exempt_routes: Optional[List[str]] = None,
+                 pool_saturation_threshold: float = 1.0,
+                 pool_utilization: Optional[Callable[[], Optional[float]]] = None,
+                 pool_wait_threshold_seconds: Optional[float] = None,
+                 pool_wait_seconds: Optional[Callable[[], Optional[float]]] = None):
+        self.app = app
+        self.default_concurrency = default_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait_seconds = max_queue_wait_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self.route_concurrency = route_concurrency or {}
+        self.bulk_routes = set(bulk_routes or [])
+        self.exempt_routes = set(exempt_routes or [])
+        self.pool_saturation_threshold = pool_saturation_threshold
+        self.pool_utilization = pool_utilization
+        self.pool_wait_threshold_seconds = pool_wait_threshold_seconds
+        self.pool_wait_seconds = pool_wait_seconds
+        self.global_limiter = PriorityLimiter(global_concurrency, max_queue_depth)
+        self.limiters: Dict[str, PriorityLimiter] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route_key = get_route_key(scope)
+        if route_key is None or route_key in self.exempt_routes:
+            # unknown routes (404 / docs) are cheap and never touch the db
+            await self.app(scope, receive, send)
+            return
+        priority = self._get_priority(scope["method"], route_key)
+        if priority == RequestPriority.BULK and self._is_pool_saturated():
+            await self._reject(scope, receive, send, route_key, "db pool saturated")
+            return
+        limiter = self._get_limiter(route_key)
+        deadline = time.monotonic() + self.max_queue_wait_seconds
+        if not await limiter.acquire(priority, self.max_queue_wait_seconds):
+            await self._reject(scope, receive, send, route_key, "route queue full or wait time exceeded")
+            return
+        try:
+            if not await self.global_limiter.acquire(priority, max(deadline - time.monotonic(), 0)):
+                await self._reject(scope, receive, send, route_key, "global queue full or wait time exceeded")
+                return
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                self.global_limiter.release()
+        finally:
+            limiter.release()
+
+    def _get_priority(self, method: str, route_key: str) -> RequestPriority:
+        if route_key in self.bulk_routes:
+            return RequestPriority.BULK
+        if method in ("GET", "HEAD"):
+            return RequestPriority.READ
+        return RequestPriority.WRITE
+
+    def _get_limiter(self, route_key: str) -> PriorityLimiter:
+        limiter = self.limiters.get(route_key)
+        if limiter is None:
+            concurrency = self.route_concurrency.get(route_key, self.default_concurrency)
+            limiter = PriorityLimiter(concurrency, self.max_queue_depth)
+            self.limiters[route_key] = limiter
+        return limiter
+
+    def _is_pool_saturated(self) -> bool:
+        utilization = self.pool_utilization() if self.pool_utilization else None
+        if utilization is not None and utilization >= self.pool_saturation_threshold:
+            return True
+        if self.pool_wait_seconds is None or self.pool_wait_threshold_seconds is None:
+            return False
+        wait_seconds = self.pool_wait_seconds()
+        return wait_seconds is not None and wait_seconds >= self.pool_wait_threshold_seconds
+
+    async def _reject(self, scope: Scope, receive: Receive, send: Send, route_key: str, reason: str):
+        logger.warning("request rejected by admission control", extra=dict(route=route_key, reason=reason))
+        response = JSONResponse(dict(errorMessage=ErrorMessages.SERVICE_OVERLOADED),
+                                status_code=HTTP_503_SERVICE_UNAVAILABLE,
+                                headers={"Retry-After": str(self.retry_after_seconds)})
+        await response(scope, receive, send)
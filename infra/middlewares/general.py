@@ -0,0 +1,13 @@
+from typing import Optional
+from starlette.routing import Match
+from starlette.types import Scope
+
+
+def get_route_key(scope: Scope) -> Optional[str]:
+    """"<METHOD> <route path>" of the route that will serve the request, e.g. "GET /api/v1/employees/{employee_id}" """
+    app = scope.get("app")
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return f"{scope['method']} {route.path}"
+    return None
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import random
+import re
+import time
+from typing import Optional
+from uuid import uuid4
+from starlette.datastructures import Headers, QueryParams
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from infra.logger import get_logger
+
+logger = get_logger(__file__)
+
+PROFILE_FILE_HEADER = "X-Profile-File"
+
+
+class ProfilingMiddleware:
+    """
+    wall clock profile (pyinstrument in async mode - time spent awaiting the db and the event loop is attributed to
+    the awaiting code) of requests that send `trigger_header` together with the api key, or of a random sample of
+    all requests. every profile is written as a speedscope json file (https://www.speedscope.app) to `directory`,
+    its name is returned in the X-Profile-File response header.
+    only added to the app when profiling is enabled, pyinstrument is only imported then
+    """
+
+    def __init__(self, app: ASGIApp, api_key: str, api_key_name: str, trigger_header: str, directory: str,
+                 sample_rate: float = 0.0, interval_seconds: float = 0.001):
+        from pyinstrument import Profiler
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        self.app = app
+        self.api_key = api_key
+        self.api_key_name = api_key_name
+        self.trigger_header = trigger_header
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.interval_seconds = interval_seconds
+        self.profiler_class = Profiler
+        self.renderer = SpeedscopeRenderer()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        file_name = self._file_name(scope)
+
+        async def send_with_file_name(message: Message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(PROFILE_FILE_HEADER.lower().encode(),
+                                                                  file_name.encode())]
+            await send(message)
+
+        profiler = self.profiler_class(interval=self.interval_seconds, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_file_name)
+        finally:
+            session = profiler.stop()
+            try:
+                await asyncio.to_thread(self._write, file_name, self.renderer.render(session))
+                logger.info("request profiled", extra=dict(path=scope["path"], file=file_name,
+                                                           durationSeconds=session.duration))
+            except Exception:
+                logger.exception("error at profiling", extra=dict(path=scope["path"]))
+
+    def _should_profile(self, scope: Scope) -> bool:
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        headers = Headers(scope=scope)
+        return self.trigger_header in headers and self._get_api_key(scope, headers) == self.api_key
+
+    def _get_api_key(self, scope: Scope, headers: Headers) -> Optional[str]:
+        # the same places get_api_key looks at - query, header, cookie
+        return QueryParams(scope.get("query_string", b"")).get(self.api_key_name) or \
+            headers.get(self.api_key_name) or \
+            cookie_parser(headers.get("cookie", "")).get(self.api_key_name)
+
+    @staticmethod
+    def _file_name(scope: Scope) -> str:
+        path = re.sub(r"[^A-Za-z0-9]+", "_", scope["path"]).strip("_") or "root"
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method']}-{path}-{uuid4().hex[:8]}.speedscope.json"
+
+    def _write(self, file_name: str, profile: str):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, file_name), "w") as file:
+            file.write(profile)
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from typing import Dict, Optional
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.status import HTTP_504_GATEWAY_TIMEOUT
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from infra.deadline import request_deadline
+from infra.logger import get_logger
+from infra.messages.error_messages import ErrorMessages
+from infra.middlewares.general import get_route_key
+
+logger = get_logger(__file__)
+
+
+class RequestDeadlineMiddleware:
+    """
+    gives every request a deadline (route default, optionally shortened by the client through a header), exposes it
+    to the db layer through `infra.deadline.request_deadline` and cancels the request once the deadline has passed
+    or the client has disconnected, so in flight statements do not keep holding pool connections
+    """
+
+    def __init__(self, app: ASGIApp, default_deadline_seconds: float, header_name: str,
+                 route_deadlines: Optional[Dict[str, float]] = None):
+        self.app = app
+        self.default_deadline_seconds = default_deadline_seconds
+        self.header_name = header_name
+        self.route_deadlines = route_deadlines or {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        deadline_seconds = self._get_deadline_seconds(scope)
+        token = request_deadline.set(time.monotonic() + deadline_seconds)
+        messages: asyncio.Queue[Message] = asyncio.Queue()
+        disconnected = False
+        response_started = False
+        response_complete = False
+
+        async def receive_message() -> Message:
+            if disconnected and messages.empty():
+                return {"type": "http.disconnect"}
+            return await messages.get()
+
+        async def send_message(message: Message):
+            nonlocal response_started, response_complete
+            if message["type"] == "http.response.start":
+                response_started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.create_task(self.app(scope, receive_message, send_message))
+
+        async def watch_disconnect():
+            # the request body is read here and handed to the app through the queue, so the app never misses it
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected = True
+                    # once the response was sent the app is only running teardown - let it finish
+                    if not response_complete:
+                        app_task.cancel()
+                await messages.put(message)
+                if disconnected:
+                    return
+
+        watcher = asyncio.create_task(watch_disconnect())
+        timed_out = False
+        try:
+            done, _ = await asyncio.wait({app_task}, timeout=deadline_seconds)
+            if not done:
+                timed_out = True
+                app_task.cancel()
+            try:
+                await app_task
+            except asyncio.CancelledError:
+                if not (timed_out or disconnected):
+                    raise
+        except asyncio.CancelledError:
+            app_task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+            request_deadline.reset(token)
+
+        if timed_out:
+            logger.warning("request deadline exceeded", extra=dict(path=scope["path"], deadline=deadline_seconds))
+            if not response_started and not disconnected:
+                response = JSONResponse(dict(errorMessage=ErrorMessages.DEADLINE_EXCEEDED),
+                                        status_code=HTTP_504_GATEWAY_TIMEOUT)
+                await response(scope, receive, send)
+        elif disconnected and not response_complete:
+            logger.info("client disconnected, request cancelled", extra=dict(path=scope["path"]))
+
+    def _get_deadline_seconds(self, scope: Scope) -> float:
+        route_key = get_route_key(scope)
+        deadline_seconds = self.route_deadlines.get(route_key, self.default_deadline_seconds)
+        requested = Headers(scope=scope).get(self.header_name)
+        if requested:
+            try:
+                deadline_seconds = min(deadline_seconds, max(float(requested), 0))
+            except ValueError:
+                pass
+        return deadline_seconds
@@ -0,0 +1,242 @@
+"""
+helpers for migrations of large tables, called from alembic/versions scripts like the op.* functions they replace.
+on postgres none of them holds a lock that blocks reads and writes for longer than a catalog update:
+- create_index_concurrently / drop_index_concurrently - CREATE / DROP INDEX CONCURRENTLY outside the migration
+  transaction, partitioned tables get the index partition by partition
+- backfill - UPDATEs in committed key range batches, throttled, resumable after a failure (progress is kept in
+  migration_backfills)
+- add_check_constraint_not_valid / add_foreign_key_not_valid + validate_constraint, set_not_null - constraints that
+  check the existing rows without an ACCESS EXCLUSIVE lock
+other databases (sqlite) run the plain operations. alembic/env.py runs every revision in its own transaction, so
+the transaction a helper commits before its autocommit block only holds that revision's earlier steps
+"""
+import time
+from typing import List, Optional, Sequence
+from alembic import op
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from infra.logger import get_logger
+from infra.partitioning import PARTITIONED_TABLE
+
+logger = get_logger(__file__)
+
+# postgres lock_timeout of migrations (alembic -x lock_timeout=... overrides it), a DDL statement waiting for its lock
+# blocks every query queued behind it - failing fast and retrying later is cheaper than an outage
+DEFAULT_LOCK_TIMEOUT = "5s"
+BACKFILLS_TABLE = "migration_backfills"
+# postgres lock_not_available / query_canceled, a backfill batch hitting them is retried
+RETRIED_SQLSTATES = ("55P03", "57014")
+# tables of the database that no model describes - backfill progress and, on postgres, the partitions of employees
+# and employee_identification_codes (see the partition_employees_by_create_time revision)
+UNMODELED_TABLES = (BACKFILLS_TABLE, "employee_identification_codes")
+
+
+def _is_postgres() -> bool:
+    return op.get_context().dialect.name == "postgresql"
+
+
+def _columns_sql(columns: Sequence[str]) -> str:
+    return ", ".join(columns)
+
+
+def create_index_statement(name: str, table: str, columns: Sequence[str], unique: bool = False,
+                           concurrently: bool = True, only: bool = False, where: Optional[str] = None) -> str:
+    return f"CREATE {'UNIQUE ' if unique else ''}INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS " \
+           f"{name} ON {'ONLY ' if only else ''}{table} ({_columns_sql(columns)})" + \
+           (f" WHERE {where}" if where else "")
+
+
+def _partitions(table: str) -> List[str]:
+    result = op.get_bind().execute(text(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid WHERE parent.relname = :table "
+        "ORDER BY child.relname"), dict(table=table))
+    return list(result.scalars())
+
+
+def _drop_invalid_index(name: str):
+    """a failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, IF NOT EXISTS would keep it"""
+    valid = op.get_bind().execute(text(
+        "SELECT pg_index.indisvalid FROM pg_index JOIN pg_class ON pg_index.indexrelid = pg_class.oid "
+        "WHERE pg_class.relname = :name"), dict(name=name)).scalar()
+    if valid is False:
+        logger.warning("dropping invalid index", extra=dict(index=name))
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def create_index_concurrently(name: str, table: str, columns: Sequence[str], unique: bool = False,
+                              where: Optional[str] = None):
+    """
+    CREATE INDEX CONCURRENTLY - writes go on while the index is built. on a partitioned table (which does not support
+    CONCURRENTLY) the index is created on the parent only and the concurrently built index of every partition is
+    attached to it, the parent index becomes valid with the last one. safe to rerun after a failure
+    """
+    if not _is_postgres():
+        op.create_index(name, table, list(columns), unique=unique)
+        return
+    with op.get_context().autocommit_block():
+        if op.get_context().as_sql:
+            # no catalog to look at - plain tables only
+            op.execute(create_index_statement(name, table, columns, unique, where=where))
+            return
+        partitions = _partitions(table)
+        if not partitions:
+            _drop_invalid_index(name)
+            op.execute(create_index_statement(name, table, columns, unique, where=where))
+            return
+        op.execute(create_index_statement(name, table, columns, unique, concurrently=False, only=True, where=where))
+        for partition in partitions:
+            partition_index = f"{partition}_{name}"
+            _drop_invalid_index(partition_index)
+            op.execute(create_index_statement(partition_index, partition, columns, unique, where=where))
+            # a no-op for an index already attached by an earlier run
+            op.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+def drop_index_concurrently(name: str, table: str):
+    if not _is_postgres():
+        op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        if not op.get_context().as_sql and _partitions(table):
+            # partitioned indexes can not be dropped concurrently
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+        else:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def backfill(name: str, table: str, set_clause: str, where: Optional[str] = None, key_column: str = "id",
+             batch_size: int = 10_000, sleep_seconds: float = 0.1, max_retries: int = 5):
+    """
+    UPDATE {table} SET {set_clause} [WHERE {where}] one key range of batch_size at a time, every batch commits on its
+    own - row locks are held for one batch only and the work done survives a failure. the last finished key is kept
+    in migration_backfills under `name`, a rerun continues after it and a finished backfill is skipped.
+    batches have to be idempotent (a batch may run again after a crash before its progress was saved), rows written
+    after the backfill started are expected to get the value from the application.
+    `sleep_seconds` between batches leaves room for the regular load (and replication) to catch up
+    """
+    context = op.get_context()
+    if context.as_sql:
+        raise RuntimeError("backfill needs a database connection, it can not run in offline (--sql) mode")
+    with context.autocommit_block():
+        connection = op.get_bind()
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {BACKFILLS_TABLE} (name VARCHAR PRIMARY KEY, last_key BIGINT, "
+            f"max_key BIGINT, updated_rows BIGINT NOT NULL, done BOOLEAN NOT NULL)"))
+        progress = connection.execute(text(
+            f"SELECT last_key, max_key, updated_rows, done FROM {BACKFILLS_TABLE} WHERE name = :name"),
+            dict(name=name)).first()
+        if progress is None:
+            min_key, max_key = connection.execute(
+                text(f"SELECT min({key_column}), max({key_column}) FROM {table}")).first()
+            last_key, updated_rows = (None if min_key is None else min_key - 1), 0
+            connection.execute(text(
+                f"INSERT INTO {BACKFILLS_TABLE} (name, last_key, max_key, updated_rows, done) "
+                f"VALUES (:name, :last_key, :max_key, 0, :done)"),
+                dict(name=name, last_key=last_key, max_key=max_key, done=max_key is None))
+            if max_key is None:
+                return
+        elif progress.done:
+            logger.info("backfill already done", extra=dict(backfill=name, updatedRows=progress.updated_rows))
+            return
+        else:
+            last_key, max_key, updated_rows = progress.last_key, progress.max_key, progress.updated_rows
+            logger.info("resuming backfill", extra=dict(backfill=name, lastKey=last_key, maxKey=max_key))
+
+        first_key = last_key
+        condition = f" AND ({where})" if where else ""
+        update = text(f"UPDATE {table} SET {set_clause} "
+                      f"WHERE {key_column} > :low AND {key_column} <= :high{condition}")
+        started = time.monotonic()
+        while last_key < max_key:
+            high = min(last_key + batch_size, max_key)
+            result = _execute_with_retries(connection, update, dict(low=last_key, high=high), max_retries)
+            last_key, updated_rows = high, updated_rows + result.rowcount
+            connection.execute(text(
+                f"UPDATE {BACKFILLS_TABLE} SET last_key = :last_key, updated_rows = :updated_rows, done = :done "
+                f"WHERE name = :name"), dict(name=name, last_key=last_key, updated_rows=updated_rows,
+                                             done=last_key >= max_key))
+            logger.info("backfill progress", extra=dict(
+                backfill=name, lastKey=last_key, maxKey=max_key, updatedRows=updated_rows,
+                percent=round(100 * (last_key - first_key) / max(max_key - first_key, 1), 1),
+                elapsedSeconds=round(time.monotonic() - started, 1)))
+            if sleep_seconds and last_key < max_key:
+                time.sleep(sleep_seconds)
+
+
+def _execute_with_retries(connection, statement, params, max_retries: int):
+    for attempt in range(max_retries + 1):
+        try:
+            return connection.execute(statement, params)
+        except DBAPIError as ex:
+            sqlstate = getattr(ex.orig, "sqlstate", None) or getattr(ex.orig, "pgcode", None)
+            if attempt == max_retries or sqlstate not in RETRIED_SQLSTATES:
+                raise
+            logger.warning("backfill batch retried", extra=dict(error=str(ex.orig), attempt=attempt + 1))
+            time.sleep(2 ** attempt)
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """
+    alembic autogenerate filter (alembic/env.py) for the intended differences between the models and the database.
+    employees is partitioned on postgres, where a unique constraint has to include the partition key - the uniqueness
+    of identification_code the model declares is enforced through employee_identification_codes instead, and
+    idx_employee_identification_code (dropped on sqlite, where the constraint indexes the column) serves the lookups.
+    without the filter autogenerate proposes adding the constraint, which postgres rejects, and dropping the index
+    """
+    if type_ == "table":
+        return not (reflected and compare_to is None and
+                    (name in UNMODELED_TABLES or name.startswith(f"{PARTITIONED_TABLE}_")))
+    if type_ == "index" and reflected and compare_to is None and name == "idx_employee_identification_code":
+        return False
+    if type_ == "unique_constraint" and not reflected and compare_to is None and \
+            object.table.name == PARTITIONED_TABLE:
+        return False
+    return True
+
+
+def add_check_constraint_not_valid(name: str, table: str, condition: str):
+    """
+    postgres - the constraint applies to new writes right away, the existing rows are checked by validate_constraint
+    (run it in a following revision, or right after - it takes its own transaction)
+    """
+    if not _is_postgres():
+        with op.batch_alter_table(table) as batch:
+            batch.create_check_constraint(name, condition)
+        return
+    op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} CHECK ({condition}) NOT VALID")
+
+
+def add_foreign_key_not_valid(name: str, table: str, referred_table: str, columns: Sequence[str],
+                              referred_columns: Sequence[str], ondelete: Optional[str] = None):
+    if not _is_postgres():
+        with op.batch_alter_table(table) as batch:
+            batch.create_foreign_key(name, referred_table, list(columns), list(referred_columns), ondelete=ondelete)
+        return
+    op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} FOREIGN KEY ({_columns_sql(columns)}) "
+               f"REFERENCES {referred_table} ({_columns_sql(referred_columns)})" +
+               (f" ON DELETE {ondelete}" if ondelete else "") + " NOT VALID")
+
+
+def validate_constraint(name: str, table: str):
+    """scans the table under a SHARE UPDATE EXCLUSIVE lock - reads and writes go on"""
+    if not _is_postgres():
+        return
+    with op.get_context().autocommit_block():
+        op.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+
+def set_not_null(table: str, column: str):
+    """
+    SET NOT NULL scans the table under an ACCESS EXCLUSIVE lock, unless a validated CHECK (column IS NOT NULL)
+    already proves it (postgres 12+) - the check is added NOT VALID, validated, and dropped once it did its job
+    """
+    if not _is_postgres():
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, nullable=False)
+        return
+    check_name = f"{table}_{column}_not_null"
+    add_check_constraint_not_valid(check_name, table, f"{column} IS NOT NULL")
+    validate_constraint(check_name, table)
+    op.alter_column(table, column, nullable=False)
+    op.drop_constraint(check_name, table, type_="check")
@@ -17,6 +17,10 @@ class Employee(Base):
     street = Column(String)
     building_number = Column(String)
     
+    # create_time is returned by the INSERT itself instead of a reload after the commit
+    __mapper_args__ = {"eager_defaults": True}
+    # identification_code lookups use the index of its unique constraint - on postgres (partitioned, see
+    # infra.migrations.include_object) idx_employee_identification_code serves them instead
     __table_args__ = (
-        Index('idx_employee_identification_code', identification_code),
+        Index('idx_employee_create_time', create_time),
     )
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, Integer, DateTime, String, Text, func, Index
+
+from infra.models.base import Base
+
+
+class OutboxEvent(Base):
+    """change events of the rows of other tables, written in the same transaction as the change (see infra.outbox)"""
+    __tablename__ = "outbox_events"
+    id = Column(Integer, primary_key=True)
+    aggregate_type = Column(String, nullable=False)
+    aggregate_id = Column(Integer, nullable=False)
+    event_type = Column(String, nullable=False)
+    # json of the row's columns, the values before the delete for a delete
+    payload = Column(Text, nullable=False)
+    create_time = Column(DateTime, server_default=func.now())
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_time = Column(DateTime)
+    last_error = Column(String)
+
+    __table_args__ = (
+        # the dispatcher looks up the earlier events of a row
+        Index('idx_outbox_event_aggregate', aggregate_type, aggregate_id, id),
+    )
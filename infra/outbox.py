@@ -0,0 +1,169 @@
+"""
+transactional outbox - every create / update / delete of a registered model adds a change event to the same
+transaction (BaseCrud, the write batcher), OutboxDispatcher delivers the events to webhooks in batches.
+delivery is at least once (a failed round is retried for every sink, consumers dedupe by event id) and in order per
+row - an event waiting for its retry (or claimed by a round in progress) holds back the later events of its row
+"""
+import asyncio
+import json
+import urllib.request
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+from sqlalchemy import select, update, delete, inspect, text, or_, exists
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from sqlalchemy.orm import aliased
+from enums.OutboxEventType import OutboxEventType
+from infra.logger import get_logger
+from infra.models.outbox_event import OutboxEvent
+
+logger = get_logger(__file__)
+
+# pg_try_advisory_xact_lock key - one worker at a time claims events
+OUTBOX_LOCK_KEY = 7_301_904
+MAX_ERROR_LENGTH = 500
+
+# models whose changes are written to the outbox
+outbox_models: Set[Any] = set()
+
+
+def register_outbox_model(model):
+    outbox_models.add(model)
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not json serializable")
+
+
+def create_outbox_event(obj, event_type: OutboxEventType) -> OutboxEvent:
+    values = {attribute.key: getattr(obj, attribute.key) for attribute in inspect(type(obj)).column_attrs}
+    return OutboxEvent(aggregate_type=obj.__tablename__, aggregate_id=obj.id, event_type=event_type.value,
+                       payload=json.dumps(values, default=_json_default), attempts=0)
+
+
+def event_message(event: OutboxEvent) -> Dict[str, Any]:
+    return dict(id=event.id, type=f"{event.aggregate_type}.{event.event_type}", aggregateId=event.aggregate_id,
+                createTime=event.create_time.isoformat() if event.create_time else None,
+                data=json.loads(event.payload))
+
+
+def due_events_query(now: datetime, limit: int):
+    """due events in id order, minus those behind an event of their row that is not due (backoff or claimed)"""
+    earlier = aliased(OutboxEvent)
+    return (
+        select(OutboxEvent)
+        .where(or_(OutboxEvent.next_attempt_time.is_(None), OutboxEvent.next_attempt_time <= now))
+        .where(~exists().where(earlier.aggregate_type == OutboxEvent.aggregate_type,
+                               earlier.aggregate_id == OutboxEvent.aggregate_id,
+                               earlier.id < OutboxEvent.id, earlier.next_attempt_time > now))
+        .order_by(OutboxEvent.id)
+        .limit(limit)
+    )
+
+
+@dataclass
+class OutboxDispatcherStats:
+    rounds: int = 0
+    delivered_events: int = 0
+    failed_rounds: int = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(rounds=self.rounds, deliveredEvents=self.delivered_events, failedRounds=self.failed_rounds)
+
+
+class OutboxDispatcher:
+    """
+    every round claims up to batch_size due events per database (one per shard in sharded mode), posts them as one
+    json array (ordered by event id) to every sink and deletes them once all sinks accepted them. a failed round
+    schedules the retry of its events with exponential backoff.
+    a claim is a short transaction that moves next_attempt_time of the events claim_seconds ahead, the posts run with
+    no transaction open - other workers skip the claimed events, and take them over should this one die mid round
+    """
+
+    def __init__(self, session_makers: List[async_sessionmaker], sink_urls: List[str], batch_size: int,
+                 request_timeout_seconds: float, max_backoff_seconds: float, claim_seconds: float):
+        self.session_makers = session_makers
+        self.sink_urls = sink_urls
+        self.batch_size = batch_size
+        self.request_timeout_seconds = request_timeout_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.claim_seconds = claim_seconds
+        self.stats = OutboxDispatcherStats()
+
+    async def dispatch_once(self) -> int:
+        """one round over all databases, returns the number of delivered events"""
+        delivered = 0
+        for session_maker in self.session_makers:
+            async with session_maker() as session:
+                delivered += await self._dispatch(session)
+        return delivered
+
+    async def _claim(self, session: AsyncSession, now: datetime) -> List[OutboxEvent]:
+        if session.bind.dialect.name == "postgresql":
+            locked = await session.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), dict(key=OUTBOX_LOCK_KEY))
+            if not locked.scalar():
+                await session.rollback()
+                return []
+        events = list((await session.execute(due_events_query(now, self.batch_size))).scalars())
+        # detached - they keep their loaded values past the commit
+        session.expunge_all()
+        if events:
+            await session.execute(update(OutboxEvent).where(OutboxEvent.id.in_([event.id for event in events]))
+                                  .values(next_attempt_time=now + timedelta(seconds=self.claim_seconds)),
+                                  execution_options=dict(synchronize_session=False))
+        await session.commit()
+        return events
+
+    async def _dispatch(self, session: AsyncSession) -> int:
+        now = datetime.utcnow()
+        events = await self._claim(session, now)
+        if not events:
+            return 0
+
+        self.stats.rounds += 1
+        body = json.dumps([event_message(event) for event in events]).encode()
+        errors = [error for error in await asyncio.gather(*(self._post(url, body) for url in self.sink_urls))
+                  if error is not None]
+        if errors:
+            self.stats.failed_rounds += 1
+            now = datetime.utcnow()
+            await session.execute(update(OutboxEvent), [
+                dict(id=event.id, attempts=event.attempts + 1, last_error=errors[0][:MAX_ERROR_LENGTH],
+                     next_attempt_time=now + timedelta(seconds=min(2 ** (event.attempts + 1),
+                                                                   self.max_backoff_seconds)))
+                for event in events])
+            await session.commit()
+            return 0
+        await session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_([event.id for event in events])))
+        await session.commit()
+        self.stats.delivered_events += len(events)
+        return len(events)
+
+    async def _post(self, url: str, body: bytes) -> Optional[str]:
+        """None when the sink accepted the events, the error otherwise"""
+        request = urllib.request.Request(url, data=body, method="POST", headers={"Content-Type": "application/json"})
+        try:
+            await asyncio.to_thread(self._send, request)
+        except Exception as ex:
+            logger.warning("outbox delivery failed", extra=dict(url=url, error=str(ex)))
+            return f"{url}: {ex}"
+        return None
+
+    def _send(self, request: urllib.request.Request):
+        # non 2xx responses raise HTTPError
+        with urllib.request.urlopen(request, timeout=self.request_timeout_seconds) as response:
+            response.read()
+
+
+async def run_outbox_dispatcher(dispatcher: OutboxDispatcher, interval_seconds: float):
+    while True:
+        try:
+            delivered = await dispatcher.dispatch_once()
+        except Exception:
+            logger.exception("error at run_outbox_dispatcher")
+            delivered = 0
+        # a full batch - more events are probably waiting
+        if delivered < dispatcher.batch_size:
+            await asyncio.sleep(interval_seconds)
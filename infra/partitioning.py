@@ -0,0 +1,206 @@
+"""
+maintenance of the monthly create_time range partitions of the employees table (postgres only, see the
+partition_employees_by_create_time migration) -
+python -m infra.partitioning ensure --months-ahead 3
+python -m infra.partitioning detach --before 2024-01-01 [--archive-schema archive]
+"""
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from typing import AsyncIterator, List
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from infra.logger import get_logger
+
+logger = get_logger(__file__)
+
+PARTITIONED_TABLE = "employees"
+DEFAULT_PARTITION = "employees_default"
+# partition DDL must never queue up behind long running queries (and block everything queued behind it)
+LOCK_TIMEOUT = "5s"
+# a detach that runs into lock_timeout (lock_not_available) is retried
+DETACH_ATTEMPTS = 3
+LOCK_NOT_AVAILABLE = "55P03"
+# pg_try_advisory_lock key - every app worker runs the maintenance, one pass at a time does the DDL
+MAINTENANCE_LOCK_KEY = 7_301_905
+
+
+def month_start(value: date, months_offset: int = 0) -> date:
+    month_index = value.year * 12 + value.month - 1 + months_offset
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(start: date) -> str:
+    return f"{PARTITIONED_TABLE}_p{start:%Y%m}"
+
+
+def create_partition_statements(start: date) -> List[str]:
+    """
+    the partition is created standalone with a CHECK constraint matching its bounds and then attached - ATTACH takes a
+    SHARE UPDATE EXCLUSIVE lock on the parent (CREATE TABLE ... PARTITION OF would take an ACCESS EXCLUSIVE one) and
+    the constraint lets postgres skip the validation scan of the new partition.
+    employees_default is still scanned, under an ACCESS EXCLUSIVE lock on it, for rows that belong to the new bounds -
+    cheap while it stays (nearly) empty, which is what creating the partitions months ahead is for
+    """
+    name = partition_name(start)
+    end = month_start(start, 1)
+    return [
+        f"CREATE TABLE IF NOT EXISTS {name} (LIKE {PARTITIONED_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)",
+        f"ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {name}_bounds",
+        f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds "
+        f"CHECK (create_time IS NOT NULL AND create_time >= '{start}' AND create_time < '{end}')",
+        f"ALTER TABLE {PARTITIONED_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')",
+        # attached - the partition bounds enforce the same thing from now on
+        f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds",
+    ]
+
+
+def detach_partition_statements(name: str, archive_schema: str = None) -> List[str]:
+    """
+    a plain DETACH PARTITION - postgres refuses DETACH ... CONCURRENTLY while the table has a default partition.
+    it holds an ACCESS EXCLUSIVE lock on the parent for a catalog update only, lock_timeout keeps it from waiting
+    behind long running queries (with everything queued behind it)
+    """
+    statements = [f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'",
+                  f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}"]
+    if archive_schema:
+        statements += [f"CREATE SCHEMA IF NOT EXISTS {archive_schema}",
+                       f"ALTER TABLE {name} SET SCHEMA {archive_schema}"]
+    return statements
+
+
+async def get_partitions(engine: AsyncEngine) -> List[str]:
+    async with engine.connect() as connection:
+        result = await connection.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+            "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+            "WHERE parent.relname = :table ORDER BY child.relname"), dict(table=PARTITIONED_TABLE))
+        return list(result.scalars())
+
+
+async def is_partitioned(engine: AsyncEngine) -> bool:
+    async with engine.connect() as connection:
+        result = await connection.execute(text(
+            "SELECT count(*) FROM pg_partitioned_table JOIN pg_class ON pg_partitioned_table.partrelid = pg_class.oid "
+            "WHERE pg_class.relname = :table"), dict(table=PARTITIONED_TABLE))
+        return result.scalar() > 0
+
+
+@asynccontextmanager
+async def maintenance_lock(engine: AsyncEngine) -> AsyncIterator[bool]:
+    """
+    session level advisory lock held on a connection of its own for a whole maintenance pass, False when another
+    worker (or the cli) is in the middle of one - concurrent passes would race on CREATE / ATTACH of the same partition
+    """
+    async with engine.connect() as connection:
+        locked = (await connection.execute(text("SELECT pg_try_advisory_lock(:key)"),
+                                           dict(key=MAINTENANCE_LOCK_KEY))).scalar()
+        await connection.commit()
+        try:
+            yield locked
+        finally:
+            if locked:
+                await connection.execute(text("SELECT pg_advisory_unlock(:key)"), dict(key=MAINTENANCE_LOCK_KEY))
+                await connection.commit()
+
+
+async def ensure_future_partitions(engine: AsyncEngine, months_ahead: int, today: date = None) -> List[str]:
+    """creates the partitions of the current month and the next months_ahead months, returns the created ones"""
+    async with maintenance_lock(engine) as locked:
+        if not locked:
+            logger.info("partition maintenance is running elsewhere, skipped")
+            return []
+        return await _ensure_future_partitions(engine, months_ahead, today)
+
+
+async def _ensure_future_partitions(engine: AsyncEngine, months_ahead: int, today: date = None) -> List[str]:
+    if not await is_partitioned(engine):
+        logger.warning("employees is not partitioned, run the alembic migrations first")
+        return []
+    today = today or datetime.utcnow().date()
+    existing = set(await get_partitions(engine))
+    created = []
+    for months_offset in range(months_ahead + 1):
+        start = month_start(today, months_offset)
+        if partition_name(start) in existing:
+            continue
+        async with engine.begin() as connection:
+            await connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+            for statement in create_partition_statements(start):
+                await connection.execute(text(statement))
+        created.append(partition_name(start))
+        logger.info("partition created", extra=dict(partition=partition_name(start)))
+    return created
+
+
+async def detach_partitions(engine: AsyncEngine, before: date, archive_schema: str = None) -> List[str]:
+    """
+    detaches the monthly partitions that end before `before` (see detach_partition_statements), one transaction per
+    partition retried when it runs into lock_timeout, and optionally moves them to an archive schema.
+    the identification codes of detached rows stay reserved in employee_identification_codes
+    """
+    async with maintenance_lock(engine) as locked:
+        if not locked:
+            raise RuntimeError("partition maintenance is running elsewhere, try again later")
+        return await _detach_partitions(engine, before, archive_schema)
+
+
+async def _detach_partitions(engine: AsyncEngine, before: date, archive_schema: str = None) -> List[str]:
+    detached = []
+    for name in await get_partitions(engine):
+        if name == DEFAULT_PARTITION or name >= partition_name(month_start(before)):
+            continue
+        for attempt in range(DETACH_ATTEMPTS):
+            try:
+                async with engine.begin() as connection:
+                    for statement in detach_partition_statements(name, archive_schema):
+                        await connection.execute(text(statement))
+                break
+            except DBAPIError as ex:
+                sqlstate = getattr(ex.orig, "sqlstate", None) or getattr(ex.orig, "pgcode", None)
+                if attempt == DETACH_ATTEMPTS - 1 or sqlstate != LOCK_NOT_AVAILABLE:
+                    raise
+                logger.warning("partition detach retried", extra=dict(partition=name, attempt=attempt + 1))
+                await asyncio.sleep(2 ** attempt)
+        detached.append(name)
+        logger.info("partition detached", extra=dict(partition=name, archiveSchema=archive_schema))
+    return detached
+
+
+async def run_partition_maintenance(engine: AsyncEngine, months_ahead: int, interval_seconds: float):
+    """keeps future partitions around for as long as the app runs"""
+    while True:
+        try:
+            await ensure_future_partitions(engine, months_ahead)
+        except Exception:
+            logger.exception("error at run_partition_maintenance")
+        await asyncio.sleep(interval_seconds)
+
+
+async def main():
+    from db import engine, shard_engines
+
+    parser = argparse.ArgumentParser(description="employees partitions maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ensure_parser = subparsers.add_parser("ensure")
+    ensure_parser.add_argument("--months-ahead", type=int, default=3)
+    detach_parser = subparsers.add_parser("detach")
+    detach_parser.add_argument("--before", type=date.fromisoformat, required=True)
+    detach_parser.add_argument("--archive-schema")
+    args = parser.parse_args()
+
+    # in sharded mode every shard is maintained
+    for partitioned_engine in shard_engines or [engine]:
+        if args.command == "ensure":
+            await ensure_future_partitions(partitioned_engine, args.months_ahead)
+        else:
+            await detach_partitions(partitioned_engine, args.before, args.archive_schema)
+        await partitioned_engine.dispose()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
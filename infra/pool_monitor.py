@@ -0,0 +1,72 @@
+"""
+db pool pressure for admission control - how many connections are checked out relative to what the pool can hand
+out, and how long checkouts recently waited for a connection.
+only pools with a fixed size tell anything: NullPool (the default of the sqlite file engine) opens a connection per
+checkout, both figures are None for it and pool based shedding stays inactive
+"""
+import itertools
+import time
+from typing import Optional
+from sqlalchemy.pool import Pool, QueuePool, AsyncAdaptedQueuePool
+
+# weight of the latest checkout in the average wait
+WAIT_SMOOTHING = 0.2
+# an average older than this is stale - there were no checkouts, so nobody waited
+WAIT_STALE_SECONDS = 5.0
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.average_wait_seconds = 0.0
+        self.last_checkout_time: Optional[float] = None
+        # start time of every checkout still waiting for its connection
+        self._waits = {}
+        self._sequence = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waits)
+
+    def begin(self, now: float) -> int:
+        waiter = next(self._sequence)
+        self._waits[waiter] = now
+        return waiter
+
+    def end(self, waiter: int, now: float):
+        wait_seconds = now - self._waits.pop(waiter)
+        self.average_wait_seconds += WAIT_SMOOTHING * (wait_seconds - self.average_wait_seconds)
+        self.last_checkout_time = now
+
+    def current_wait_seconds(self, now: float) -> float:
+        """the recent average, or how long the oldest current waiter already waits when that is longer"""
+        recent = self.last_checkout_time is not None and now - self.last_checkout_time < WAIT_STALE_SECONDS
+        average = self.average_wait_seconds if recent else 0.0
+        oldest = now - min(self._waits.values()) if self._waits else 0.0
+        return max(average, oldest)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool measuring the time every checkout takes until it gets a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def connect(self):
+        waiter = self.wait_stats.begin(time.monotonic())
+        try:
+            return super().connect()
+        finally:
+            self.wait_stats.end(waiter, time.monotonic())
+
+
+def pool_utilization(pool: Pool) -> Optional[float]:
+    """checked out connections relative to pool_size + max_overflow, None for pools without a limit"""
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0 or pool.size() + pool._max_overflow <= 0:
+        return None
+    return pool.checkedout() / (pool.size() + pool._max_overflow)
+
+
+def pool_wait_seconds(pool: Pool) -> Optional[float]:
+    wait_stats = getattr(pool, "wait_stats", None)
+    return None if wait_stats is None else wait_stats.current_wait_seconds(time.monotonic())
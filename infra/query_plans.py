@@ -0,0 +1,241 @@
+"""
+query plans of the statements BaseCrud / EmployeesCrud (and the outbox dispatcher) generate and an audit of the declared
+indexes, checked by the query plans tests (infra/tests/integration.py) and reported against the configured database by
+python -m infra.query_plans
+every crud call runs inside an outer transaction that is rolled back, so the report leaves no rows behind
+"""
+import asyncio
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+from sqlalchemy import event, inspect, MetaData
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from infra.logger import get_logger
+from infra.outbox import due_events_query
+
+logger = get_logger(__file__)
+
+EXPLAINED_STATEMENTS = ("SELECT", "UPDATE", "DELETE")
+SQLITE_USED_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+POSTGRES_USED_INDEX = re.compile(r"(?:Index Scan|Index Only Scan|Bitmap Index Scan)(?: Backward)? (?:using|on) (\w+)")
+
+
+@dataclass
+class CrudCall:
+    name: str
+    run: Callable[[AsyncSession], Awaitable[Any]]
+    # dialects on which the call is expected to scan the whole table
+    allowed_full_scans: Tuple[str, ...] = ()
+
+
+@dataclass
+class QueryPlan:
+    call: CrudCall
+    statement: str
+    lines: List[str]
+    full_scans: List[str] = field(default_factory=list)
+    used_indexes: Set[str] = field(default_factory=set)
+
+
+@dataclass
+class IndexInfo:
+    name: Optional[str]
+    table: str
+    columns: Tuple[str, ...]
+    unique: bool
+    # primary key / unique constraint - enforces something, never reported as unused
+    constraint: bool = False
+
+
+def employee_crud_calls(employees_crud, sample: Dict[str, Any]) -> List[CrudCall]:
+    """one call per query shape of the employees cruds, `sample` are the create values of one employee"""
+    employee_state = {}
+
+    async def create(session):
+        employee_state["employee"] = await employees_crud.create(session, **sample)
+
+    async def update(session):
+        await employees_crud.update(session, employee_state["employee"], first_name=str(uuid4()))
+
+    async def delete(session):
+        await employees_crud.delete(session, employee_state["employee"])
+
+    code = sample["identification_code"]
+    after = datetime(2000, 1, 1)
+    return [
+        CrudCall("create", create),
+        CrudCall("get_by_id", lambda session: employees_crud.get_by_id(session, employee_state["employee"].id)),
+        CrudCall("get_by_identification_code",
+                 lambda session: employees_crud.get_by_identification_code(session, code)),
+        CrudCall("get_by_ids", lambda session: employees_crud.get_by_ids(session, [employee_state["employee"].id, 0])),
+        CrudCall("get_by_identification_codes",
+                 lambda session: employees_crud.get_by_identification_codes(session, [code, "missing"])),
+        # a page of the whole table - reads offset + limit rows in id order
+        CrudCall("get_all offset", lambda session: employees_crud.get_all(session, offset=0, limit=10),
+                 allowed_full_scans=("sqlite", "postgresql")),
+        CrudCall("get_all after_id", lambda session: employees_crud.get_all(session, after_id=0, limit=10)),
+        CrudCall("get_all after_datetime", lambda session: employees_crud.get_all(session, after, limit=10)),
+        CrudCall("count", lambda session: employees_crud.count(session), allowed_full_scans=("sqlite", "postgresql")),
+        CrudCall("count after_datetime", lambda session: employees_crud.count(session, after)),
+        CrudCall("update", update),
+        CrudCall("delete", delete),
+    ]
+
+
+def outbox_calls() -> List[CrudCall]:
+    return [
+        # walks the events in id order, delivered events are deleted so the table stays short
+        CrudCall("outbox due events", lambda session: session.execute(due_events_query(datetime.utcnow(), 10)),
+                 allowed_full_scans=("sqlite",)),
+    ]
+
+
+def parse_plan(dialect_name: str, lines: List[str]) -> Tuple[List[str], Set[str]]:
+    """(full scan lines, used index names)"""
+    if dialect_name == "sqlite":
+        full_scans = [line for line in lines if line.startswith("SCAN ") and line != "SCAN CONSTANT ROW"]
+        used = {match.group(1) for line in lines for match in SQLITE_USED_INDEX.finditer(line)}
+    else:
+        full_scans = [line.strip() for line in lines if "Seq Scan on" in line]
+        used = {match.group(1) for line in lines for match in POSTGRES_USED_INDEX.finditer(line)}
+    return full_scans, used
+
+
+async def collect_query_plans(engine: AsyncEngine, calls: List[CrudCall]) -> List[QueryPlan]:
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        dialect_name = connection.dialect.name
+        captured: List[Tuple[CrudCall, str, Any]] = []
+        current: List[CrudCall] = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if current and statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+                captured.append((current[0], statement, parameters))
+
+        event.listen(connection.sync_connection, "before_cursor_execute", capture)
+        # crud commits only release savepoints, everything is undone by the outer rollback
+        session = AsyncSession(bind=connection, join_transaction_mode="create_savepoint", expire_on_commit=False)
+        try:
+            for call in calls:
+                current[:] = [call]
+                await call.run(session)
+            current.clear()
+        finally:
+            event.remove(connection.sync_connection, "before_cursor_execute", capture)
+
+        plans = []
+        if dialect_name == "postgresql":
+            # a seq scan only shows up when no index can serve the query (test tables are too small to judge)
+            await connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        for call, statement, parameters in captured:
+            explain = "EXPLAIN QUERY PLAN " if dialect_name == "sqlite" else "EXPLAIN "
+            result = await connection.exec_driver_sql(explain + statement, parameters)
+            lines = [row[-1] for row in result]
+            full_scans, used_indexes = parse_plan(dialect_name, lines)
+            if dialect_name == "postgresql":
+                used_indexes = await resolve_partition_indexes(connection, used_indexes)
+            plans.append(QueryPlan(call, statement, lines, full_scans, used_indexes))
+        await session.close()
+        await transaction.rollback()
+    return plans
+
+
+async def resolve_partition_indexes(connection, index_names: Set[str]) -> Set[str]:
+    """indexes of partitions by the partitioned index they belong to"""
+    resolved = set()
+    for name in index_names:
+        result = await connection.exec_driver_sql(
+            "SELECT parent.relname FROM pg_inherits JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+            "JOIN pg_class child ON pg_inherits.inhrelid = child.oid WHERE child.relname = %s", (name,))
+        resolved.add(result.scalar() or name)
+    return resolved
+
+
+def unexpected_full_scans(plans: List[QueryPlan], dialect_name: str) -> List[QueryPlan]:
+    return [plan for plan in plans if plan.full_scans and dialect_name not in plan.call.allowed_full_scans]
+
+
+def model_indexes(metadata: MetaData) -> List[IndexInfo]:
+    indexes = []
+    for table in metadata.sorted_tables:
+        for constraint in table.constraints:
+            columns = tuple(column.name for column in constraint.columns)
+            if columns and constraint.__visit_name__ in ("primary_key_constraint", "unique_constraint"):
+                indexes.append(IndexInfo(constraint.name, table.name, columns, unique=True, constraint=True))
+        for index in table.indexes:
+            indexes.append(IndexInfo(index.name, table.name, tuple(column.name for column in index.columns),
+                                     unique=bool(index.unique)))
+    return indexes
+
+
+def database_indexes(connection: Connection) -> List[IndexInfo]:
+    """the indexes of the migrated database (sync connection, e.g. through AsyncConnection.run_sync)"""
+    inspector = inspect(connection)
+    indexes = []
+    for table in inspector.get_table_names():
+        if table == "alembic_version":
+            continue
+        primary_key = inspector.get_pk_constraint(table)
+        if primary_key["constrained_columns"]:
+            indexes.append(IndexInfo(primary_key["name"], table, tuple(primary_key["constrained_columns"]),
+                                     unique=True, constraint=True))
+        for unique in inspector.get_unique_constraints(table):
+            indexes.append(IndexInfo(unique["name"], table, tuple(unique["column_names"]), unique=True,
+                                     constraint=True))
+        for index in inspector.get_indexes(table):
+            indexes.append(IndexInfo(index["name"], table, tuple(index["column_names"]), unique=index["unique"]))
+    return indexes
+
+
+def redundant_indexes(indexes: List[IndexInfo]) -> List[Tuple[IndexInfo, IndexInfo]]:
+    """
+    (redundant index, index covering it) - a non unique index whose columns are a leading prefix of another index,
+    or a unique index duplicating another unique one
+    """
+    redundant = []
+    for index in indexes:
+        if index.constraint:
+            continue
+        for other in indexes:
+            if other is index or other.table != index.table or other.columns[:len(index.columns)] != index.columns:
+                continue
+            if not index.unique or (other.unique and other.columns == index.columns):
+                redundant.append((index, other))
+                break
+    return redundant
+
+
+def unused_indexes(indexes: List[IndexInfo], plans: List[QueryPlan]) -> List[IndexInfo]:
+    used = set().union(*(plan.used_indexes for plan in plans))
+    return [index for index in indexes if not index.constraint and not index.unique and index.name not in used]
+
+
+async def main():
+    from db import engine
+    from infra.crud.employee import EmployeesCrud
+    from infra.general import generate_random_date
+
+    sample = dict(identification_code=str(uuid4()), birth_date=generate_random_date(), first_name="query",
+                  last_name="plans", email="query.plans@example.com", city="", country="", street="",
+                  building_number="")
+    plans = await collect_query_plans(engine, employee_crud_calls(EmployeesCrud(), sample) + outbox_calls())
+    async with engine.connect() as connection:
+        indexes = await connection.run_sync(database_indexes)
+    for plan in plans:
+        print(f"{plan.call.name}: {plan.statement}")
+        for line in plan.lines:
+            print(f"    {line}")
+    for plan in unexpected_full_scans(plans, engine.dialect.name):
+        print(f"unexpected full scan - {plan.call.name}: {plan.full_scans}")
+    for index, covering in redundant_indexes(indexes):
+        print(f"redundant index - {index.table}.{index.name} {index.columns} is covered by {covering.name}")
+    for index in unused_indexes(indexes, plans):
+        print(f"unused index - {index.table}.{index.name} {index.columns}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""
+moves a key range (hash slots or ids, depending on DB_SHARDING_STRATEGY) from one shard to another -
+python -m infra.sharding.rebalance --source 0 --target 2 --low 0 --high 256
+rows are copied in id ordered batches (insert on the target first, then delete from the source) so an interrupted run
+can simply be started again - a row already on the target counts as copied only when it equals the source row, a
+different row under the same id stops the move before anything of its batch is deleted. writes to the moved range
+should be paused while it runs, once it is done put the printed range map in DB_SHARD_RANGES and restart the app
+"""
+import argparse
+import asyncio
+import json
+from typing import Optional
+from sqlalchemy import select, insert, delete
+from sqlalchemy.ext.asyncio import AsyncEngine
+from enums.ShardingStrategy import ShardingStrategy
+from infra.logger import get_logger
+from infra.sharding.router import ShardRouter
+
+logger = get_logger(__file__)
+
+
+async def move_range(source: AsyncEngine, target: AsyncEngine, router: ShardRouter, model,
+                     shard_key_field_name: Optional[str], low: int, high: int, batch_size: int = 500) -> int:
+    table = model.__table__
+    moved = 0
+    last_id = None
+    while True:
+        query = select(table).order_by(table.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        if router.strategy == ShardingStrategy.ID_RANGE:
+            query = query.where(table.c.id >= low, table.c.id < high)
+        async with source.connect() as source_connection:
+            rows = (await source_connection.execute(query)).mappings().all()
+        if not rows:
+            return moved
+        last_id = rows[-1]["id"]
+        # hash slots can not be computed by the db, rows outside the range are filtered here
+        batch = [dict(row) for row in rows
+                 if low <= router.row_key(row["id"],
+                                          row[shard_key_field_name] if shard_key_field_name else None) < high]
+        if not batch:
+            continue
+        ids = [row["id"] for row in batch]
+        async with target.begin() as target_connection:
+            result = await target_connection.execute(select(table).where(table.c.id.in_(ids)))
+            existing = {row["id"]: dict(row) for row in result.mappings()}
+            conflicts = [row["id"] for row in batch if row["id"] in existing and existing[row["id"]] != row]
+            if conflicts:
+                raise ValueError(f"ids {conflicts} exist on the target with other values, resolve them before moving "
+                                 f"the range again")
+            new_rows = [row for row in batch if row["id"] not in existing]
+            if new_rows:
+                await target_connection.execute(insert(table), new_rows)
+        # copied now or verified as copied by an earlier run
+        copied_ids = [row["id"] for row in new_rows] + [id for id in ids if id in existing]
+        async with source.begin() as source_connection:
+            await source_connection.execute(delete(table).where(table.c.id.in_(copied_ids)))
+        moved += len(batch)
+        logger.info("moved batch", extra=dict(moved=moved, lastId=last_id))
+
+
+async def main():
+    from db import shard_engines, shard_router
+    from infra.crud.employee import EmployeesCrud
+
+    parser = argparse.ArgumentParser(description="move a key range between employee shards")
+    parser.add_argument("--source", type=int, required=True)
+    parser.add_argument("--target", type=int, required=True)
+    parser.add_argument("--low", type=int, required=True)
+    parser.add_argument("--high", type=int, required=True, help="exclusive")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    assert shard_router is not None, "sharded mode is off, set DB_SHARD_URLS"
+
+    employees_crud = EmployeesCrud()
+    moved = await move_range(shard_engines[args.source], shard_engines[args.target], shard_router, employees_crud.model,
+                             employees_crud.shard_key_field_name, args.low, args.high, args.batch_size)
+    logger.info("range moved", extra=dict(moved=moved, low=args.low, high=args.high))
+    ranges = shard_router.move_range(args.low, args.high, args.target)
+    print(json.dumps([[shard_range.low, shard_range.high, shard_range.shard] for shard_range in ranges]))
+    for shard_engine in shard_engines:
+        await shard_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+import bisect
+import zlib
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+from enums.ShardingStrategy import ShardingStrategy
+
+# the hash of a shard key is mapped to one of HASH_SLOTS slots, slot ranges are what gets assigned (and moved) to shards
+HASH_SLOTS = 1024
+
+
+@dataclass
+class ShardRange:
+    low: int
+    # exclusive, None for an open ended range
+    high: Optional[int]
+    shard: int
+
+    def contains(self, key: int) -> bool:
+        return self.low <= key and (self.high is None or key < self.high)
+
+
+class ShardRouter:
+    """
+    maps rows to shards by a range map -
+    HASH: ranges over hash slots of the shard key (e.g. identification_code), ids are not routable and are scattered
+    ID_RANGE: ranges over ids, new rows go to the shard of their id, or of the open ended (last) range when the id is
+    generated by the db - that shard's id sequence has to start inside its range (see check_new_id)
+    """
+
+    def __init__(self, strategy: ShardingStrategy, ranges: Sequence[ShardRange], shards_count: int):
+        self.strategy = ShardingStrategy(strategy)
+        self.shards_count = shards_count
+        self.ranges = sorted(ranges, key=lambda shard_range: shard_range.low)
+        self._lows = [shard_range.low for shard_range in self.ranges]
+        for shard_range in self.ranges:
+            assert 0 <= shard_range.shard < shards_count, f"shard range {shard_range} points to a missing shard"
+
+    @classmethod
+    def from_settings(cls, strategy: ShardingStrategy, ranges: List[List[Optional[int]]], shards_count: int):
+        if ranges:
+            return cls(strategy, [ShardRange(*shard_range) for shard_range in ranges], shards_count)
+        assert strategy == ShardingStrategy.HASH, "DB_SHARD_RANGES is required for the id_range strategy"
+        return cls(strategy, cls.even_hash_ranges(shards_count), shards_count)
+
+    @staticmethod
+    def even_hash_ranges(shards_count: int) -> List[ShardRange]:
+        bounds = [HASH_SLOTS * shard // shards_count for shard in range(shards_count + 1)]
+        return [ShardRange(bounds[shard], bounds[shard + 1], shard) for shard in range(shards_count)]
+
+    @staticmethod
+    def hash_slot(shard_key: str) -> int:
+        # crc32 is stable across processes (unlike hash()), so rows keep their slot between restarts
+        return zlib.crc32(shard_key.encode()) % HASH_SLOTS
+
+    def lookup(self, key: int) -> int:
+        index = bisect.bisect_right(self._lows, key) - 1
+        if index < 0 or not self.ranges[index].contains(key):
+            raise KeyError(f"{key} is not covered by the shard map")
+        return self.ranges[index].shard
+
+    def shard_for_key(self, shard_key: str) -> Optional[int]:
+        """shard of a shard key value (e.g. identification_code), None when it has to be scattered"""
+        if self.strategy != ShardingStrategy.HASH or shard_key is None:
+            return None
+        return self.lookup(self.hash_slot(shard_key))
+
+    def shard_for_id(self, id: int) -> Optional[int]:
+        """shard of an id, None when it has to be scattered. KeyError for an id outside the id ranges"""
+        if self.strategy != ShardingStrategy.ID_RANGE:
+            return None
+        return self.lookup(id)
+
+    def shard_for_new_row(self, shard_key: Optional[str], id: Optional[int] = None) -> int:
+        if self.strategy == ShardingStrategy.HASH:
+            assert shard_key is not None, "the shard key is required to create a row in hash sharded mode"
+            return self.shard_for_key(shard_key)
+        return self.lookup(id) if id is not None else self.ranges[-1].shard
+
+    def check_new_id(self, shard_id: int, id: int):
+        """raises when a db generated id does not route back to the shard that generated it"""
+        if self.strategy != ShardingStrategy.ID_RANGE:
+            return
+        try:
+            routed_shard_id = self.lookup(id)
+        except KeyError:
+            routed_shard_id = None
+        if routed_shard_id != shard_id:
+            raise ValueError(f"id {id} generated by shard {shard_id} is routed to shard {routed_shard_id}, start the "
+                             f"id sequence of shard {shard_id} at {self.ranges[-1].low}")
+
+    def row_key(self, id: int, shard_key: Optional[str]) -> int:
+        """the position of a row in the range map - hash slot or id"""
+        return self.hash_slot(shard_key) if self.strategy == ShardingStrategy.HASH else id
+
+    def move_range(self, low: int, high: int, target_shard: int) -> List[ShardRange]:
+        """the range map after [low, high) moved to target_shard, neighbouring ranges of the same shard are merged"""
+        moved = []
+        for shard_range in self.ranges:
+            range_high = shard_range.high if shard_range.high is not None else float("inf")
+            if range_high <= low or shard_range.low >= high:
+                moved.append(shard_range)
+                continue
+            if shard_range.low < low:
+                moved.append(ShardRange(shard_range.low, low, shard_range.shard))
+            moved.append(ShardRange(max(shard_range.low, low), min(range_high, high), target_shard))
+            if range_high > high:
+                moved.append(ShardRange(high, shard_range.high, shard_range.shard))
+        merged: List[ShardRange] = []
+        for shard_range in moved:
+            if merged and merged[-1].shard == shard_range.shard and merged[-1].high == shard_range.low:
+                merged[-1] = ShardRange(merged[-1].low, shard_range.high, shard_range.shard)
+            else:
+                merged.append(shard_range)
+        return merged
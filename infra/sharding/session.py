@@ -0,0 +1,48 @@
+import asyncio
+from typing import Dict, List
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from infra.sharding.router import ShardRouter
+
+
+class ShardedSession:
+    """
+    one AsyncSession per shard, created on first use. single key operations use the session of their shard,
+    scatter-gather operations run on all of them in parallel (every shard session has its own connection).
+    commit / rollback are per shard - a unit of work is expected to touch a single shard
+    """
+
+    def __init__(self, session_makers: List[async_sessionmaker], router: ShardRouter):
+        self.session_makers = session_makers
+        self.router = router
+        self._sessions: Dict[int, AsyncSession] = {}
+
+    def shard(self, shard_id: int) -> AsyncSession:
+        session = self._sessions.get(shard_id)
+        if session is None:
+            session = self.session_makers[shard_id]()
+            self._sessions[shard_id] = session
+        return session
+
+    def shards(self) -> List[AsyncSession]:
+        return [self.shard(shard_id) for shard_id in range(len(self.session_makers))]
+
+    def shard_of(self, obj) -> int:
+        for shard_id, session in self._sessions.items():
+            if obj in session:
+                return shard_id
+        raise ValueError(f"{obj} was not loaded through this sharded session")
+
+    async def commit(self):
+        await asyncio.gather(*(session.commit() for session in self._sessions.values()))
+
+    async def rollback(self):
+        await asyncio.gather(*(session.rollback() for session in self._sessions.values()))
+
+    async def close(self):
+        await asyncio.gather(*(session.close() for session in self._sessions.values()))
+
+    async def __aenter__(self) -> "ShardedSession":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
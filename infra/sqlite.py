@@ -0,0 +1,112 @@
+from typing import Any, Dict, Tuple
+from sqlalchemy import event, Insert, Update, Delete, Boolean
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.sql.visitors import InternalTraversal
+from infra.pool_monitor import TimedQueuePool
+
+# session.info key of a RoutingSession whose transaction wrote
+WRITER_PINNED = "writer_pinned"
+# share of the rows sqlite assumes a `selective` condition to match
+SELECTIVE_LIKELIHOOD = 0.01
+
+
+def high_concurrency_pragmas(mmap_size: int, cache_size_kib: int, busy_timeout_ms: int) -> Dict[str, Any]:
+    return dict(
+        # readers do not block the writer (and vice versa)
+        journal_mode="WAL",
+        # with WAL, NORMAL only fsyncs on checkpoints and is still safe against corruption
+        synchronous="NORMAL",
+        mmap_size=mmap_size,
+        # negative - in KiB instead of pages
+        cache_size=-cache_size_kib,
+        busy_timeout=busy_timeout_ms,
+        temp_store="MEMORY",
+    )
+
+
+def install_sqlite_pragmas(engine: Engine, pragmas: Dict[str, Any], begin_immediate: bool = False):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+        if begin_immediate:
+            # transactions are started by the begin listener below instead of by the driver
+            dbapi_connection.isolation_level = None
+
+    if begin_immediate:
+        @event.listens_for(engine, "begin")
+        def begin_immediate_transaction(connection):
+            # takes the write lock up front - a deferred transaction that reads first and then writes can fail with
+            # "database is locked" right away instead of waiting for busy_timeout
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def create_high_concurrency_engines(database_url: str, reader_pool_size: int, pragmas: Dict[str, Any],
+                                    **engine_kwargs) -> Tuple[AsyncEngine, AsyncEngine]:
+    """
+    a single writer connection (writes queue on its pool instead of failing on the sqlite lock) and a pool of
+    read only reader connections, see routing_session_class for sending statements to the right one
+    """
+    writer = create_async_engine(database_url, poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+                                 **engine_kwargs)
+    reader = create_async_engine(database_url, poolclass=TimedQueuePool, pool_size=reader_pool_size,
+                                 max_overflow=0, **engine_kwargs)
+    install_sqlite_pragmas(writer.sync_engine, pragmas, begin_immediate=True)
+    install_sqlite_pragmas(reader.sync_engine, dict(pragmas, query_only=1))
+    return writer, reader
+
+
+def routing_session_class(base: type, writer: AsyncEngine, reader: AsyncEngine) -> type:
+    """
+    session class sending flushes and insert / update / delete statements to the writer, everything else to readers.
+    once a transaction wrote, its reads go to the writer too until it ends - the readers do not see uncommitted rows
+    """
+
+    class RoutingSession(base):
+        def get_bind(self, mapper=None, clause=None, **kwargs):
+            if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+                self.info[WRITER_PINNED] = True
+                return writer.sync_engine
+            if self.info.get(WRITER_PINNED) and self.in_transaction():
+                return writer.sync_engine
+            return reader.sync_engine
+
+    @event.listens_for(RoutingSession, "after_transaction_end")
+    def unpin_writer(session, transaction):
+        if transaction.parent is None:
+            session.info.pop(WRITER_PINNED, None)
+
+    return RoutingSession
+
+
+class selective(ColumnElement):
+    """
+    a condition expected to match a small share of the rows. sqlite can not estimate a comparison with a bound value
+    and, for a query ordered by id, walks the whole table in id order rather than searching an index and sorting -
+    on sqlite the condition is wrapped in likelihood(), other databases get it as it is
+    """
+    inherit_cache = True
+    type = Boolean()
+    _traverse_internals = [("condition", InternalTraversal.dp_clauseelement)]
+
+    def __init__(self, condition: ColumnElement):
+        self.condition = condition
+
+    def self_group(self, against=None):
+        # already a condition - not compared with true on databases without a boolean type
+        return self
+
+
+@compiles(selective)
+def compile_selective(element: selective, compiler, **kwargs) -> str:
+    return compiler.process(element.condition, **kwargs)
+
+
+@compiles(selective, "sqlite")
+def compile_selective_sqlite(element: selective, compiler, **kwargs) -> str:
+    return f"likelihood({compiler.process(element.condition, **kwargs)}, {SELECTIVE_LIKELIHOOD})"
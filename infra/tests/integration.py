@@ -1,32 +1,113 @@
+import asyncio
 import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import time
 from dataclasses import dataclass, asdict
 from typing import Optional
 from uuid import uuid4
 from faker import Faker
-from sqlalchemy.orm import clear_mappers
+from sqlalchemy import text, make_url, select, update, delete
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from enums.DBType import DBType
+from enums.ExportJobStatus import ExportJobStatus
+from enums.ShardingStrategy import ShardingStrategy
+from infra.crud.base import BaseCrud, RELEASE_CONNECTION_AFTER_READS
+from infra.crud.errors import EntryNotFoundError
+from infra.crud.write_batcher import WriteBatcher, register_write_batcher, write_batchers
+from infra.deadline import install_deadline_listeners, request_deadline
+from infra.exports import ExportJobManager
+from infra import migrations
+from infra.pool_monitor import TimedQueuePool, pool_utilization, pool_wait_seconds
+from infra.outbox import OutboxDispatcher, register_outbox_model, outbox_models
+from infra.models.outbox_event import OutboxEvent
 from infra.crud.employee import EmployeesCrud
 from infra.general import generate_random_date
 from infra.models.base import Base
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from infra.models.employee import Employee as EmployeeModel
+from infra.query_plans import collect_query_plans, employee_crud_calls, outbox_calls, unexpected_full_scans, \
+    database_indexes, redundant_indexes, model_indexes, unused_indexes
+from infra.sharding.rebalance import move_range
+from infra.tests.temp_engines import temp_engines
+from infra.tests.template_db import generate_employee_rows, build_sqlite_template, build_postgres_template, \
+    copy_sqlite_template, create_postgres_database
+from infra.sharding.router import ShardRouter
+from infra.sharding.session import ShardedSession
+from settings import settings
+from infra.sqlite import high_concurrency_pragmas, create_high_concurrency_engines, routing_session_class
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker, AsyncEngine
 import pytest
+from unittest.mock import patch
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
 
 fake = Faker()
 employees_crud = EmployeesCrud()
 
 
+TEMPLATE_EMPLOYEES = 1000
+# set by pytest-xdist (pytest -n auto), every worker gets its own databases
+WORKER_ID = os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+
+def postgres_url(database: str) -> str:
+    from db import database_url
+    return make_url(database_url).set(database=database).render_as_string(hide_password=False)
+
+
 @pytest.fixture(scope="session")
-async def db_generator():
-    DATABASE_URL = "sqlite+aiosqlite:///test_db.sqlite"
-    engine = create_async_engine(DATABASE_URL)
+def template_db(tmp_path_factory) -> str:
+    """path of the seeded sqlite template, on postgres the name of the template database"""
+    rows = generate_employee_rows(TEMPLATE_EMPLOYEES)
+    if settings.DB_DRIVER == DBType.POSTGRES:
+        name = f"{settings.DB_NAME}_test_template_{WORKER_ID}"
+
+        async def build():
+            admin_engine = create_async_engine(postgres_url("postgres"))
+            try:
+                await build_postgres_template(admin_engine, name, postgres_url(name), rows)
+            finally:
+                await admin_engine.dispose()
+
+        asyncio.run(build())
+        return name
+    # the temp directories of the xdist workers share a parent, the template is built once for all of them
+    directory = tmp_path_factory.getbasetemp()
+    if WORKER_ID != "main":
+        directory = directory.parent
+    path = directory / "template.sqlite"
+    if not path.exists():
+        asyncio.run(build_sqlite_template(str(path), rows))
+    return str(path)
+
+
+async def clone_template(template_db: str, tmp_path, **engine_kwargs) -> AsyncEngine:
+    """an engine on a fresh copy of the template"""
+    if settings.DB_DRIVER == DBType.POSTGRES:
+        name = f"{settings.DB_NAME}_test_{WORKER_ID}"
+        admin_engine = create_async_engine(postgres_url("postgres"))
+        try:
+            await create_postgres_database(admin_engine, name, template=template_db)
+        finally:
+            await admin_engine.dispose()
+        return create_async_engine(postgres_url(name), **engine_kwargs)
+    path = copy_sqlite_template(template_db, str(tmp_path / "test_db.sqlite"))
+    return create_async_engine(f"sqlite+aiosqlite:///{path}", **engine_kwargs)
+
+
+@pytest.fixture
+async def db_generator(template_db, tmp_path):
+    engine = await clone_template(template_db, tmp_path)
     async_session = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
     async with async_session() as session:
-        # setup code for populating database goes here
         yield session
-        # teardown code goes here, if any
-    clear_mappers()  # clear mappers after session
+    await engine.dispose()
 
 
 @dataclass
@@ -139,4 +220,664 @@ async def test_employee_get_all(db_generator):
             created_employees_ids.add(employee.id)
         extracted_employees = await employees_crud.get_all(db)
         extracted_employees_ids = {e.id for e in extracted_employees}
-        assert created_employees_ids == extracted_employees_ids
+        assert created_employees_ids <= extracted_employees_ids
+        assert len(extracted_employees_ids) == TEMPLATE_EMPLOYEES + len(created_employees_ids)
+
+
+@pytest.mark.asyncio
+async def test_employee_get_all_rows(db_generator):
+    async for db in db_generator:
+        columns = ["id", "identification_code", "birth_date"]
+        rows = await employees_crud.get_all_rows(db, columns, after_id=10, limit=5)
+        employees = await employees_crud.get_all(db, after_id=10, limit=5)
+        assert rows == [(employee.id, employee.identification_code, employee.birth_date) for employee in employees]
+
+
+@pytest.mark.asyncio
+async def test_employee_filter_on_null_column(db_generator):
+    async for db in db_generator:
+        employee = await employees_crud.create(db, **dict(asdict(generate_random_employee_metadata()), street=None))
+        assert [e.id for e in await employees_crud.get_all(db, street=None)] == [employee.id]
+        assert await employees_crud.get_all_rows(db, ["id"], street=None) == [(employee.id,)]
+        assert await employees_crud.count(db, street=None) == 1
+        # the null filter has its own cached statement, the same key with a value still matches by value
+        assert await employees_crud.count(db, street="no such street") == 0
+        assert await employees_crud.count(db, city=employee.city, street=None) == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_checkout_wait_measured(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.sqlite'}", poolclass=TimedQueuePool,
+                                 pool_size=1, max_overflow=0)
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+            assert pool_utilization(engine.pool) == 1
+            second = asyncio.create_task(engine.connect().start())
+            await asyncio.sleep(0.2)
+            assert engine.pool.wait_stats.waiting == 1
+            assert pool_wait_seconds(engine.pool) >= 0.2
+        await (await second).close()
+        assert engine.pool.wait_stats.waiting == 0
+        assert engine.pool.wait_stats.average_wait_seconds > 0
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_connection_released_after_reads_and_commits(template_db, tmp_path):
+    engine = await clone_template(template_db, tmp_path, poolclass=AsyncAdaptedQueuePool)
+    async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False,
+                                       info={RELEASE_CONNECTION_AFTER_READS: True})
+    try:
+        async with async_session() as session:
+            employee = await employees_crud.get_by_id(session, 1)
+            assert engine.pool.checkedout() == 0
+            employee = await employees_crud.update(session, employee, first_name="released")
+            assert engine.pool.checkedout() == 0
+            assert employee.first_name == "released"
+            created = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            assert engine.pool.checkedout() == 0
+            # returned by the INSERT
+            assert created.id is not None and created.create_time is not None
+            # pending changes keep the transaction (and its connection) for their commit
+            created.first_name = "pending"
+            await employees_crud.count(session)
+            assert engine.pool.checkedout() == 1
+            await session.commit()
+            assert engine.pool.checkedout() == 0
+    finally:
+        await engine.dispose()
+
+
+@pytest.fixture
+def webhook_sink():
+    """local stand-in for a webhook consumer - failing_requests requests fail with a 500, the others are recorded"""
+    state = dict(received=[], failing_requests=0)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if state["failing_requests"] > 0:
+                state["failing_requests"] -= 1
+                self.send_response(500)
+            else:
+                state["received"].extend(json.loads(body))
+                self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}/events"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_events_dispatched_in_order(db_generator, webhook_sink):
+    register_outbox_model(EmployeeModel)
+    try:
+        async for session in db_generator:
+            first = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            first = await employees_crud.update(session, first, first_name="updated")
+            second = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            async_session = async_sessionmaker(session.bind, class_=AsyncSession, expire_on_commit=False)
+            dispatcher = OutboxDispatcher([async_session], [webhook_sink["url"]], batch_size=10,
+                                          request_timeout_seconds=5, max_backoff_seconds=60, claim_seconds=60)
+
+            webhook_sink["failing_requests"] = 1
+            assert await dispatcher.dispatch_once() == 0
+            events = (await session.execute(select(OutboxEvent))).scalars().all()
+            assert [event.attempts for event in events] == [1, 1, 1]
+            # the waiting events hold back their own rows only
+            third = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            third = await employees_crud.update(session, third, first_name="third")
+            await employees_crud.delete(session, second)
+            assert await dispatcher.dispatch_once() == 2
+            await session.execute(update(OutboxEvent).values(next_attempt_time=None))
+            await session.commit()
+            assert await dispatcher.dispatch_once() == 4
+
+            assert [(message["type"], message["aggregateId"]) for message in webhook_sink["received"]] == [
+                ("employees.created", third.id), ("employees.updated", third.id),
+                ("employees.created", first.id), ("employees.updated", first.id),
+                ("employees.created", second.id), ("employees.deleted", second.id)]
+            assert webhook_sink["received"][3]["data"]["first_name"] == "updated"
+            assert webhook_sink["received"][3]["data"]["identification_code"] == first.identification_code
+            assert (await session.execute(select(OutboxEvent))).scalars().all() == []
+            assert dispatcher.stats.snapshot() == dict(rounds=3, deliveredEvents=6, failedRounds=1)
+    finally:
+        outbox_models.discard(EmployeeModel)
+
+
+@pytest.mark.asyncio
+async def test_outbox_events_claimed_before_posting(db_generator, webhook_sink):
+    register_outbox_model(EmployeeModel)
+    try:
+        async for session in db_generator:
+            first = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            await employees_crud.update(session, first, first_name="updated")
+            second = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            async_session = async_sessionmaker(session.bind, class_=AsyncSession, expire_on_commit=False)
+            dispatcher, other_worker = (
+                OutboxDispatcher([async_session], [webhook_sink["url"]], batch_size=batch_size,
+                                 request_timeout_seconds=5, max_backoff_seconds=60, claim_seconds=60)
+                for batch_size in (1, 10))
+            post = dispatcher._post
+
+            async def post_after_other_worker(url: str, body: bytes):
+                # the claim is committed before the posts - the other worker skips the claimed event and the later
+                # one of its row
+                assert await other_worker.dispatch_once() == 1
+                return await post(url, body)
+
+            with patch.object(dispatcher, "_post", post_after_other_worker):
+                assert await dispatcher.dispatch_once() == 1
+            assert [(message["type"], message["aggregateId"]) for message in webhook_sink["received"]] == [
+                ("employees.created", second.id), ("employees.created", first.id)]
+
+            # an event waiting for its retry does not hold back the events of other rows behind it
+            third = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            webhook_sink["failing_requests"] = 1
+            assert await dispatcher.dispatch_once() == 0
+            assert await dispatcher.dispatch_once() == 1
+            assert (webhook_sink["received"][-1]["type"], webhook_sink["received"][-1]["aggregateId"]) == \
+                   ("employees.created", third.id)
+            events = (await session.execute(select(OutboxEvent))).scalars().all()
+            assert [(event.event_type, event.aggregate_id, event.attempts) for event in events] == [
+                ("updated", first.id, 1)]
+    finally:
+        outbox_models.discard(EmployeeModel)
+
+
+SLOW_QUERY = text("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000) "
+                  "SELECT count(*) FROM c")
+
+
+class DeadlineSession(Session):
+    pass
+
+
+def deadline_session_maker(engine: AsyncEngine) -> async_sessionmaker:
+    install_deadline_listeners(engine.sync_engine, DeadlineSession)
+    return async_sessionmaker(engine, class_=AsyncSession, sync_session_class=DeadlineSession)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(create_schema=False)], indirect=True)
+async def test_sqlite_statement_interrupted_on_deadline(temp_engines):
+    async for (engine,) in temp_engines:
+        async_session = deadline_session_maker(engine)
+        token = request_deadline.set(time.monotonic() + 0.1)
+        try:
+            async with async_session() as session:
+                with pytest.raises(OperationalError, match="interrupted"):
+                    await employees_crud.execute(session, SLOW_QUERY)
+        finally:
+            request_deadline.reset(token)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(create_schema=False)], indirect=True)
+async def test_cancelled_execute_releases_connection(temp_engines):
+    async for (engine,) in temp_engines:
+        async_session = deadline_session_maker(engine)
+        async with async_session() as session:
+            task = asyncio.create_task(BaseCrud.execute(session, SLOW_QUERY))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            started = time.monotonic()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert time.monotonic() - started < 1
+            assert not session.in_transaction()
+            result = await session.execute(text("SELECT 1"))
+            assert result.scalar() == 1
+
+
+def create_sharded_session(engines, router: ShardRouter) -> ShardedSession:
+    return ShardedSession([async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+                           for engine in engines], router)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(name="shard", count=3)], indirect=True)
+async def test_sharded_crud(temp_engines):
+    async for engines in temp_engines:
+        router = ShardRouter.from_settings(ShardingStrategy.HASH, [], len(engines))
+        async with create_sharded_session(engines, router) as session:
+            employees = []
+            for id in range(1, 31):
+                employee_data = generate_random_employee_metadata()
+                # shards are provisioned with disjoint id sequences
+                employee_data.id = id
+                employees.append(await employees_crud.create(session, **asdict(employee_data)))
+            for employee in employees:
+                assert session.shard_of(employee) == router.shard_for_key(employee.identification_code)
+                assert await employees_crud.get_by_identification_code(session, employee.identification_code) == employee
+                assert (await employees_crud.get_by_id(session, employee.id)).id == employee.id
+            assert await employees_crud.count(session) == len(employees)
+            page = await employees_crud.get_all(session, offset=5, limit=10)
+            assert [employee.id for employee in page] == list(range(6, 16))
+            page = await employees_crud.get_all(session, after_id=25, limit=10)
+            assert [employee.id for employee in page] == list(range(26, 31))
+            rows = await employees_crud.get_all_rows(session, ["identification_code", "id"], offset=5, limit=3)
+            assert rows == [(employees[id - 1].identification_code, id) for id in range(6, 9)]
+            found = await employees_crud.get_by_ids(session, [30, 999, 2, 30])
+            assert [employee and employee.id for employee in found] == [30, None, 2, 30]
+            codes = [employees[7].identification_code, "missing", employees[3].identification_code]
+            found = await employees_crud.get_by_identification_codes(session, codes)
+            assert found == [employees[7], None, employees[3]]
+
+            employee = employees[0]
+            new_code = next(code for code in (str(uuid4()) for _ in range(100))
+                            if router.shard_for_key(code) != session.shard_of(employee))
+            moved = await employees_crud.update(session, employee, identification_code=new_code)
+            assert moved.id == employee.id
+            assert session.shard_of(moved) == router.shard_for_key(new_code)
+            await employees_crud.delete(session, moved)
+            assert await employees_crud.get_by_id(session, employee.id) is None
+            assert await employees_crud.count(session) == len(employees) - 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(name="shard", count=3)], indirect=True)
+async def test_shard_rebalance_moves_range(temp_engines):
+    async for engines in temp_engines:
+        router = ShardRouter.from_settings(ShardingStrategy.ID_RANGE, [[1, 11, 0], [11, None, 1]], len(engines))
+        async with create_sharded_session(engines, router) as session:
+            for id in range(1, 21):
+                employee_data = generate_random_employee_metadata()
+                employee_data.id = id
+                await employees_crud.create(session.shard(router.shard_for_id(id)), **asdict(employee_data))
+        moved = await move_range(engines[0], engines[2], router, EmployeeModel, employees_crud.shard_key_field_name,
+                                 5, 11, batch_size=2)
+        assert moved == 6
+        rebalanced_router = ShardRouter(router.strategy, router.move_range(5, 11, 2), len(engines))
+        async with create_sharded_session(engines, rebalanced_router) as session:
+            assert await employees_crud.count(session.shard(0)) == 4
+            assert await employees_crud.count(session.shard(2)) == 6
+            for id in range(1, 21):
+                assert (await employees_crud.get_by_id(session, id)).id == id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(name="shard", count=2)], indirect=True)
+async def test_shard_rebalance_stops_on_conflicting_ids(temp_engines):
+    async for engines in temp_engines:
+        router = ShardRouter.from_settings(ShardingStrategy.ID_RANGE, [[1, None, 0]], len(engines))
+        for engine, codes in zip(engines, (["source-1", "source-2"], ["source-1", "unrelated"])):
+            async with async_sessionmaker(engine, class_=AsyncSession)() as session:
+                for id, code in enumerate(codes, start=1):
+                    employee_data = generate_random_employee_metadata()
+                    employee_data.id, employee_data.identification_code = id, code
+                    await employees_crud.create(session, **asdict(employee_data))
+        # id 1 differs in everything but the code, id 2 is an unrelated row
+        with pytest.raises(ValueError, match=r"\[1, 2\]"):
+            await move_range(engines[0], engines[1], router, EmployeeModel, employees_crud.shard_key_field_name,
+                             1, 3)
+        async with async_sessionmaker(engines[0], class_=AsyncSession)() as session:
+            assert await employees_crud.count(session) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(name="shard", count=2)], indirect=True)
+async def test_id_range_new_rows_route_by_id(temp_engines):
+    async for engines in temp_engines:
+        router = ShardRouter.from_settings(ShardingStrategy.ID_RANGE, [[1, 11, 0], [11, None, 1]], len(engines))
+        async with create_sharded_session(engines, router) as session:
+            employee_data = generate_random_employee_metadata()
+            employee_data.id = 3
+            employee = await employees_crud.create(session, **asdict(employee_data))
+            assert session.shard_of(employee) == 0
+            # shard 1's sequence starts at 1, outside its range - the row would never be found by its id
+            with pytest.raises(ValueError, match="routed to shard 0"):
+                await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            assert await employees_crud.count(session.shard(1)) == 0
+            employee_data = generate_random_employee_metadata()
+            employee_data.id = 11
+            await employees_crud.create(session, **asdict(employee_data))
+            employee = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+            assert employee.id == 12
+            assert (await employees_crud.get_by_id(session, 12)).identification_code == employee.identification_code
+            # not covered by the range map - can not exist
+            assert await employees_crud.get_by_id(session, 0) is None
+            # one uncovered id in a batch is just not found
+            found = await employees_crud.get_by_ids(session, [12, 0, 3, 10])
+            assert [obj.id if obj else None for obj in found] == [12, None, 3, None]
+
+
+@pytest.mark.asyncio
+async def test_write_batcher_group_commit(temp_engines):
+    async for (engine,) in temp_engines:
+        async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        write_batcher = WriteBatcher(EmployeeModel, async_session, max_batch_size=100, max_delay_seconds=0.01)
+        register_write_batcher(write_batcher)
+        try:
+            async with async_session() as session:
+                employees_data = [generate_random_employee_metadata() for _ in range(10)]
+                duplicate = generate_random_employee_metadata()
+                duplicate.identification_code = employees_data[0].identification_code
+                results = await asyncio.gather(*(employees_crud.create(session, **asdict(employee_data))
+                                                 for employee_data in employees_data + [duplicate]),
+                                               return_exceptions=True)
+                # the rows of the failed batch are retried concurrently, either duplicate may win
+                assert len([result for result in results if isinstance(result, IntegrityError)]) == 1
+                results = [result for result in results if not isinstance(result, Exception)]
+                assert {employee.identification_code for employee in results} == \
+                       {employee_data.identification_code for employee_data in employees_data}
+                for employee in results:
+                    assert employee.create_time is not None
+                assert write_batcher.stats.retried_batches == 1
+                assert write_batcher.stats.failed_rows == 1
+
+                updates = [generate_random_employee_metadata() for _ in results[:5]]
+                updated = await asyncio.gather(*(employees_crud.update(session, employee, **asdict(update))
+                                                 for employee, update in zip(results, updates)))
+                assert [employee.identification_code for employee in updated] == \
+                       [update.identification_code for update in updates]
+                assert write_batcher.stats.snapshot()["maxBatchSize"] == len(updates)
+                assert await employees_crud.count(session) == 10
+
+                missing = results[-1]
+                await employees_crud.delete(session, missing)
+                with pytest.raises(EntryNotFoundError):
+                    await employees_crud.update(session, missing, first_name="missing")
+        finally:
+            write_batchers.pop(EmployeeModel)
+
+
+@pytest.mark.asyncio
+async def test_update_of_deleted_row_raises_not_found(db_generator):
+    async for session in db_generator:
+        employee = await employees_crud.get_by_id(session, 1)
+        await session.execute(delete(EmployeeModel).where(EmployeeModel.id == 1))
+        await session.commit()
+        with pytest.raises(EntryNotFoundError):
+            await employees_crud.update(session, employee, first_name="deleted")
+        session.expunge_all()
+        with pytest.raises(EntryNotFoundError):
+            await employees_crud.update(session, employee, first_name="deleted")
+        assert await employees_crud.get_by_id(session, 1) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("temp_engines", [dict(count=3)], indirect=True)
+async def test_write_batcher_skipped_for_shards(temp_engines):
+    async for (main_engine, *engines) in temp_engines:
+        write_batcher = WriteBatcher(EmployeeModel, async_sessionmaker(main_engine, class_=AsyncSession),
+                                     max_batch_size=100, max_delay_seconds=0.01)
+        register_write_batcher(write_batcher)
+        try:
+            router = ShardRouter.from_settings(ShardingStrategy.HASH, [], len(engines))
+            async with create_sharded_session(engines, router) as session:
+                employee = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+                await employees_crud.update(session, employee, first_name="sharded")
+                assert sum([await employees_crud.count(shard) for shard in session.shards()]) == 1
+            async with async_sessionmaker(main_engine, class_=AsyncSession)() as session:
+                assert await employees_crud.count(session) == 0
+            assert write_batcher.stats.rows == 0
+        finally:
+            write_batchers.pop(EmployeeModel)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_high_concurrency_profile(tmp_path):
+    pragmas = high_concurrency_pragmas(mmap_size=2 ** 20, cache_size_kib=1024, busy_timeout_ms=5000)
+    writer, reader = create_high_concurrency_engines(f"sqlite+aiosqlite:///{tmp_path / 'wal.sqlite'}", 4, pragmas)
+    try:
+        async with writer.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async_session = async_sessionmaker(writer, class_=AsyncSession, expire_on_commit=False,
+                                           sync_session_class=routing_session_class(Session, writer, reader))
+
+        async def create_and_read():
+            async with async_session() as session:
+                employee = await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+                assert (await employees_crud.get_by_id(session, employee.id)).id == employee.id
+
+        await asyncio.gather(*(create_and_read() for _ in range(30)))
+        async with async_session() as session:
+            # reads after a write see the transaction's uncommitted rows, after the commit they go to readers again
+            employee = EmployeeModel(**asdict(generate_random_employee_metadata()))
+            session.add(employee)
+            await session.flush()
+            assert await session.scalar(select(EmployeeModel.id).where(EmployeeModel.id == employee.id)) \
+                   == employee.id
+            await session.execute(update(EmployeeModel).where(EmployeeModel.id == employee.id).values(city="pinned"))
+            assert await session.scalar(select(EmployeeModel.city).where(EmployeeModel.id == employee.id)) == "pinned"
+            await session.rollback()
+            assert await session.scalar(select(EmployeeModel.id).where(EmployeeModel.id == employee.id)) is None
+            with pytest.raises(OperationalError, match="readonly"):
+                await session.execute(text("DELETE FROM employees"))
+        async with async_session() as session:
+            assert await employees_crud.count(session) == 30
+            assert (await session.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+            # plain text statements go to the read only readers
+            with pytest.raises(OperationalError, match="readonly"):
+                await session.execute(text("DELETE FROM employees"))
+        assert writer.pool.size() == 1
+    finally:
+        await writer.dispose()
+        await reader.dispose()
+
+
+@pytest.mark.asyncio
+async def test_export_job_writes_parquet(db_generator, tmp_path):
+    import pyarrow.parquet as pq
+
+    async for session in db_generator:
+        export_jobs = ExportJobManager(EmployeeModel, [deadline_session_maker(session.bind)],
+                                       directory=str(tmp_path / "exports"), batch_size=100, process_pool_size=1,
+                                       max_running_jobs=1, job_ttl_seconds=60, max_jobs=10)
+        # started by a request whose deadline passed right away - the export does not inherit it
+        token = request_deadline.set(time.monotonic())
+        try:
+            job = export_jobs.start()
+            assert export_jobs.start() is None
+            while job.status in (ExportJobStatus.PENDING, ExportJobStatus.RUNNING):
+                await asyncio.sleep(0.05)
+            assert job.status == ExportJobStatus.SUCCEEDED, job.error
+            table = pq.read_table(job.path)
+            assert job.rows == table.num_rows == TEMPLATE_EMPLOYEES
+            assert table.column("id").to_pylist() == list(range(1, TEMPLATE_EMPLOYEES + 1))
+            assert table.schema.field("birth_date").type == "date32[day]"
+        finally:
+            request_deadline.reset(token)
+            await export_jobs.close()
+
+
+class GatedExecutor(ThreadPoolExecutor):
+    """stands in for the export process pool - conversions wait for `release`, holding the export mid stream"""
+
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.started, self.release = threading.Event(), threading.Event()
+
+    def submit(self, fn, *args, **kwargs):
+        def gated():
+            self.started.set()
+            self.release.wait(10)
+            return fn(*args, **kwargs)
+
+        return super().submit(gated)
+
+
+@pytest.mark.asyncio
+async def test_export_does_not_hold_the_writer(tmp_path):
+    pragmas = high_concurrency_pragmas(mmap_size=2 ** 20, cache_size_kib=1024, busy_timeout_ms=5000)
+    writer, reader = create_high_concurrency_engines(f"sqlite+aiosqlite:///{tmp_path / 'wal.sqlite'}", 2, pragmas)
+    executor = GatedExecutor()
+    try:
+        async with writer.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async_session = async_sessionmaker(writer, class_=AsyncSession, expire_on_commit=False,
+                                           sync_session_class=routing_session_class(Session, writer, reader))
+        async with async_session() as session:
+            for _ in range(3):
+                await employees_crud.create(session, **asdict(generate_random_employee_metadata()))
+        # the export reads through the readers, like db.background_read_session in this profile
+        export_jobs = ExportJobManager(
+            EmployeeModel, [async_sessionmaker(reader, class_=AsyncSession, expire_on_commit=False)],
+            directory=str(tmp_path / "exports"), batch_size=1, process_pool_size=1, max_running_jobs=1,
+            job_ttl_seconds=60, max_jobs=10)
+        with patch.object(export_jobs, "_get_process_pool", return_value=executor):
+            job = export_jobs.start()
+            while not executor.started.is_set():
+                await asyncio.sleep(0.01)
+            async with async_session() as session:
+                await asyncio.wait_for(
+                    employees_crud.create(session, **asdict(generate_random_employee_metadata())), 5)
+            assert job.status == ExportJobStatus.RUNNING
+            executor.release.set()
+            while job.finish_time is None:
+                await asyncio.sleep(0.01)
+        assert job.status == ExportJobStatus.SUCCEEDED, job.error
+        assert job.rows == 3
+        await export_jobs.close()
+    finally:
+        executor.release.set()
+        executor.shutdown()
+        await writer.dispose()
+        await reader.dispose()
+
+
+@pytest.mark.asyncio
+async def test_export_jobs_removed_with_their_files(tmp_path):
+    export_jobs = ExportJobManager(EmployeeModel, [], directory=str(tmp_path), batch_size=100, process_pool_size=1,
+                                   max_running_jobs=1, job_ttl_seconds=60, max_jobs=2)
+    orphan, recent_orphan = tmp_path / "employees-orphan.parquet", tmp_path / "employees-recent.parquet"
+    orphan.write_bytes(b"PAR1")
+    recent_orphan.write_bytes(b"PAR1")
+    os.utime(orphan, (time.time() - 120, time.time() - 120))
+    try:
+        jobs = []
+        for _ in range(3):
+            job = export_jobs.start()
+            while job.finish_time is None:
+                await asyncio.sleep(0.01)
+            jobs.append(job)
+        # the oldest job made room for the third one
+        assert export_jobs.get(jobs[0].id) is None and not os.path.exists(jobs[0].path)
+        assert all(export_jobs.get(job.id) is job and os.path.exists(job.path) for job in jobs[1:])
+        assert not orphan.exists() and recent_orphan.exists()
+
+        jobs[1].finish_time -= datetime.timedelta(seconds=61)
+        assert export_jobs.get(jobs[1].id) is None and not os.path.exists(jobs[1].path)
+        assert export_jobs.get(jobs[2].id) is jobs[2]
+    finally:
+        await export_jobs.close()
+
+
+# region query plans
+
+
+async def check_query_plans(engine):
+    calls = employee_crud_calls(employees_crud, asdict(generate_random_employee_metadata())) + outbox_calls()
+    plans = await collect_query_plans(engine, calls)
+    # create is a single INSERT ... RETURNING, nothing to explain
+    assert {plan.call.name for plan in plans} == {call.name for call in calls} - {"create"}
+    scans = unexpected_full_scans(plans, engine.dialect.name)
+    assert not scans, [(plan.call.name, plan.statement, plan.full_scans) for plan in scans]
+    async with engine.connect() as connection:
+        indexes = await connection.run_sync(database_indexes)
+    assert not redundant_indexes(indexes)
+    assert not unused_indexes(indexes, plans)
+
+
+@pytest.mark.asyncio
+async def test_crud_query_plans(db_generator):
+    async for session in db_generator:
+        await check_query_plans(session.bind)
+        assert not redundant_indexes(model_indexes(Base.metadata))
+        # everything ran in a rolled back transaction
+        assert await employees_crud.count(session) == TEMPLATE_EMPLOYEES
+
+
+# endregion
+
+
+# region online migrations
+
+
+@pytest.mark.asyncio
+async def test_models_match_migrations(template_db, tmp_path):
+    engine = await clone_template(template_db, tmp_path)
+    try:
+        async with engine.connect() as connection:
+            differences = await connection.run_sync(lambda sync_connection: compare_metadata(
+                MigrationContext.configure(sync_connection, opts=dict(include_object=migrations.include_object)),
+                Base.metadata))
+        assert differences == []
+    finally:
+        await engine.dispose()
+
+
+def run_operations(connection, operations):
+    """runs `operations` like a migration script - with op bound to `connection`"""
+    context = MigrationContext.configure(connection)
+    with Operations.context(context), context.begin_transaction():
+        operations()
+
+
+@pytest.mark.asyncio
+async def test_migration_backfill_resumes(template_db, tmp_path):
+    engine = await clone_template(template_db, tmp_path)
+    backfill = lambda: migrations.backfill("employees_country", "employees", "country = 'backfilled'",
+                                           where="country <> 'backfilled'", batch_size=100, sleep_seconds=0.01)
+    sleeps = []
+
+    def fail_after_three_batches(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 3:
+            raise KeyboardInterrupt
+
+    try:
+        async with engine.connect() as connection:
+            with patch("infra.migrations.time.sleep", side_effect=fail_after_three_batches):
+                with pytest.raises(KeyboardInterrupt):
+                    await connection.run_sync(run_operations, backfill)
+            progress = (await connection.execute(text("SELECT last_key, done FROM migration_backfills"))).one()
+            assert progress == (300, False)
+            assert (await connection.execute(
+                text("SELECT count(*) FROM employees WHERE country = 'backfilled'"))).scalar() == 300
+            await connection.commit()
+
+            await connection.run_sync(run_operations, backfill)
+            await connection.commit()
+            progress = (await connection.execute(
+                text("SELECT last_key, updated_rows, done FROM migration_backfills"))).one()
+            assert progress == (TEMPLATE_EMPLOYEES, TEMPLATE_EMPLOYEES, True)
+            assert (await connection.execute(
+                text("SELECT count(*) FROM employees WHERE country <> 'backfilled'"))).scalar() == 0
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_migration_index_and_constraint_helpers(template_db, tmp_path):
+    engine = await clone_template(template_db, tmp_path)
+
+    def operations():
+        migrations.create_index_concurrently("idx_employee_city", "employees", ["city"])
+        migrations.add_check_constraint_not_valid("ck_outbox_events_attempts", "outbox_events", "attempts >= 0")
+        migrations.validate_constraint("ck_outbox_events_attempts", "outbox_events")
+
+    try:
+        async with engine.connect() as connection:
+            await connection.run_sync(run_operations, operations)
+            await connection.commit()
+            indexes = await connection.run_sync(database_indexes)
+            assert ("employees", ("city",)) in {(index.table, index.columns) for index in indexes}
+            with pytest.raises(IntegrityError):
+                await connection.execute(text(
+                    "INSERT INTO outbox_events (aggregate_type, aggregate_id, event_type, payload, attempts) "
+                    "VALUES ('employees', 1, 'created', '{}', -1)"))
+    finally:
+        await engine.dispose()
+
+# endregion
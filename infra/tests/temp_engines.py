@@ -0,0 +1,31 @@
+"""
+throwaway sqlite engines for the tests that need databases of their own (several shards, custom listeners, ...)
+rather than a copy of the template - every test gets new files in its tmp_path
+"""
+from typing import List
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from infra.models.base import Base
+
+
+async def create_temp_engines(directory, name: str = "temp", count: int = 1, create_schema: bool = True,
+                              **engine_kwargs) -> List[AsyncEngine]:
+    engines = [create_async_engine(f"sqlite+aiosqlite:///{directory / f'{name}_{index}.sqlite'}", **engine_kwargs)
+               for index in range(count)]
+    if create_schema:
+        for engine in engines:
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+    return engines
+
+
+@pytest.fixture
+async def temp_engines(request, tmp_path):
+    """
+    engines on empty databases with the models' schema, parametrized (indirect=True) with the keyword arguments of
+    create_temp_engines - @pytest.mark.parametrize("temp_engines", [dict(count=3)], indirect=True)
+    """
+    engines = await create_temp_engines(tmp_path, **getattr(request, "param", {}))
+    yield engines
+    for engine in engines:
+        await engine.dispose()
@@ -0,0 +1,108 @@
+"""
+template databases for the integration tests - migrated and seeded once per test run, every test then works on a
+cheap copy of it (a file copy for sqlite, CREATE DATABASE ... TEMPLATE for postgres), so tests neither share rows
+nor pay for the schema and the seed, and parallel (pytest -n auto) workers never touch the same database
+"""
+import os
+import random
+import shutil
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List
+from uuid import UUID
+from alembic import command
+from alembic.config import Config
+from faker import Faker
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from infra.models.employee import Employee
+
+ALEMBIC_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "alembic")
+# distinct values per column, rows are random combinations of them
+VALUE_POOL_SIZE = 200
+
+
+def generate_employee_rows(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    deterministic employee rows - faker only fills small pools of values (a faker call per column per row is what
+    made seeding slow), create_time is spread over the last two years for the after_datetime queries
+    """
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+    pool_size = min(count, VALUE_POOL_SIZE) or 1
+    pools = dict(first_name=[fake.first_name() for _ in range(pool_size)],
+                 last_name=[fake.last_name() for _ in range(pool_size)],
+                 email=[fake.email() for _ in range(pool_size)],
+                 city=[fake.city() for _ in range(pool_size)],
+                 country=[fake.country() for _ in range(pool_size)],
+                 street=[fake.street_name() for _ in range(pool_size)],
+                 building_number=[fake.building_number() for _ in range(pool_size)])
+    first_create_time = datetime.utcnow() - timedelta(days=2 * 365)
+    rows = []
+    for index in range(count):
+        row = {column: rng.choice(values) for column, values in pools.items()}
+        row.update(identification_code=str(UUID(int=rng.getrandbits(128), version=4)),
+                   birth_date=date(1950, 1, 1) + timedelta(days=rng.randrange(50 * 365)),
+                   create_time=first_create_time + timedelta(days=2 * 365 * index / count))
+        rows.append(row)
+    return rows
+
+
+def upgrade_head(connection):
+    config = Config()
+    config.set_main_option("script_location", ALEMBIC_DIRECTORY)
+    config.attributes["connection"] = connection
+    command.upgrade(config, "head")
+
+
+async def build_template(engine: AsyncEngine, rows: List[Dict[str, Any]]):
+    """migrates the (empty) database of `engine` to head and seeds it with one multi row insert"""
+    # not in a transaction - alembic begins one per revision
+    async with engine.connect() as connection:
+        await connection.run_sync(upgrade_head)
+    async with engine.begin() as connection:
+        if rows:
+            await connection.execute(insert(Employee), rows)
+
+
+async def build_sqlite_template(path: str, rows: List[Dict[str, Any]]) -> str:
+    """built next to its final path and moved into place, concurrent builders never see a partial template"""
+    building_path = f"{path}.{os.getpid()}"
+    engine = create_async_engine(f"sqlite+aiosqlite:///{building_path}")
+    try:
+        await build_template(engine, rows)
+    finally:
+        await engine.dispose()
+    os.replace(building_path, path)
+    return path
+
+
+def copy_sqlite_template(template_path: str, path: str) -> str:
+    shutil.copyfile(template_path, path)
+    return path
+
+
+async def create_postgres_database(admin_engine: AsyncEngine, name: str, template: str = None):
+    """(re)creates database `name`, as a copy of database `template` when given"""
+    async with admin_engine.connect() as connection:
+        # CREATE / DROP DATABASE can not run inside a transaction block
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+        template_clause = f' TEMPLATE "{template}"' if template else ""
+        await connection.execute(text(f'CREATE DATABASE "{name}"{template_clause}'))
+
+
+async def drop_postgres_database(admin_engine: AsyncEngine, name: str):
+    async with admin_engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+
+
+async def build_postgres_template(admin_engine: AsyncEngine, name: str, url: str, rows: List[Dict[str, Any]]):
+    await create_postgres_database(admin_engine, name)
+    engine = create_async_engine(url)
+    try:
+        await build_template(engine, rows)
+    finally:
+        # postgres only copies a template nobody is connected to
+        await engine.dispose()
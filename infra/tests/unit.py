@@ -0,0 +1,428 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import date
+from unittest.mock import patch
+import pytest
+from async_asgi_testclient import TestClient
+from fastapi import FastAPI, status as http_status
+from sqlalchemy import create_engine, UniqueConstraint
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from enums.RequestPriority import RequestPriority
+from enums.ShardingStrategy import ShardingStrategy
+from infra.messages.error_messages import ErrorMessages
+from infra.crud.statement_cache import StatementCache
+from infra.deadline import get_remaining_seconds, install_deadline_listeners
+from infra.middlewares.admission_control import PriorityLimiter, AdmissionControlMiddleware
+from infra.pool_monitor import PoolWaitStats, TimedQueuePool, pool_utilization, WAIT_SMOOTHING, WAIT_STALE_SECONDS
+from infra.middlewares.request_deadline import RequestDeadlineMiddleware
+from infra.middlewares.profiling import ProfilingMiddleware, PROFILE_FILE_HEADER
+from infra.query_plans import IndexInfo, redundant_indexes, parse_plan
+from infra.partitioning import ensure_future_partitions, month_start, partition_name, create_partition_statements, \
+    detach_partition_statements
+from infra.sharding.router import ShardRouter, ShardRange, HASH_SLOTS
+from infra.migrations import create_index_statement, include_object
+from infra.models.employee import Employee
+from infra.wire_formats import negotiate_compact_format, MSGPACK_MEDIA_TYPE, COLUMNAR_JSON_MEDIA_TYPE
+
+# region admission control
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_prefers_reads():
+    limiter = PriorityLimiter(concurrency=1, max_queue_depth=10)
+    assert await limiter.acquire(RequestPriority.READ, timeout=1)
+    admitted = []
+
+    async def wait_for_slot(priority: RequestPriority):
+        await limiter.acquire(priority, timeout=1)
+        admitted.append(priority)
+        limiter.release()
+
+    waiters = [asyncio.create_task(wait_for_slot(RequestPriority.BULK)),
+               asyncio.create_task(wait_for_slot(RequestPriority.WRITE)),
+               asyncio.create_task(wait_for_slot(RequestPriority.READ))]
+    await asyncio.sleep(0)
+    assert limiter.queue_depth == 3
+    limiter.release()
+    await asyncio.gather(*waiters)
+    assert admitted == [RequestPriority.READ, RequestPriority.WRITE, RequestPriority.BULK]
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_priority_limiter_bounded_queue_and_wait():
+    limiter = PriorityLimiter(concurrency=1, max_queue_depth=1)
+    assert await limiter.acquire(RequestPriority.READ, timeout=1)
+    waiter = asyncio.create_task(limiter.acquire(RequestPriority.READ, timeout=0.05))
+    await asyncio.sleep(0)
+    assert not await limiter.acquire(RequestPriority.READ, timeout=1)
+    assert not await waiter
+    assert limiter.queue_depth == 0
+    limiter.release()
+    assert limiter.active == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_control_rejects_with_retry_after():
+    app = FastAPI()
+    release = asyncio.Event()
+
+    @app.get("/slow")
+    async def slow():
+        await release.wait()
+        return {}
+
+    app.add_middleware(AdmissionControlMiddleware, global_concurrency=10, default_concurrency=1, max_queue_depth=0,
+                       max_queue_wait_seconds=0.1, retry_after_seconds=3)
+    client = TestClient(app)
+    first = asyncio.create_task(client.get("/slow"))
+    await asyncio.sleep(0.05)
+    response = await client.get("/slow")
+    assert response.status_code == http_status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "3"
+    assert response.json()["errorMessage"] == ErrorMessages.SERVICE_OVERLOADED
+    release.set()
+    assert (await first).status_code == http_status.HTTP_200_OK
+
+
+@pytest.mark.asyncio
+async def test_admission_control_exempt_routes_hold_no_slot():
+    app = FastAPI()
+    release = asyncio.Event()
+
+    @app.get("/files/{name}")
+    async def download(name: str):
+        await release.wait()
+        return {}
+
+    @app.get("/items")
+    async def items():
+        return []
+
+    app.add_middleware(AdmissionControlMiddleware, global_concurrency=1, default_concurrency=1, max_queue_depth=0,
+                       max_queue_wait_seconds=0.1, retry_after_seconds=1, exempt_routes=["GET /files/{name}"])
+    client = TestClient(app)
+    downloads = [asyncio.create_task(client.get(f"/files/{index}")) for index in range(2)]
+    await asyncio.sleep(0.05)
+    assert (await client.get("/items")).status_code == http_status.HTTP_200_OK
+    release.set()
+    assert [(await download).status_code for download in downloads] == [http_status.HTTP_200_OK] * 2
+
+
+@pytest.mark.asyncio
+async def test_admission_control_sheds_bulk_on_pool_saturation():
+    app = FastAPI()
+
+    @app.get("/items")
+    async def items():
+        return []
+
+    app.add_middleware(AdmissionControlMiddleware, global_concurrency=10, default_concurrency=10, max_queue_depth=10,
+                       max_queue_wait_seconds=1, retry_after_seconds=1, bulk_routes=["GET /items"],
+                       pool_utilization=lambda: 1.0)
+    response = await TestClient(app).get("/items")
+    assert response.status_code == http_status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+@pytest.mark.asyncio
+async def test_admission_control_sheds_bulk_on_pool_wait():
+    app = FastAPI()
+
+    @app.get("/items")
+    async def items():
+        return []
+
+    wait_seconds = [0.1]
+    app.add_middleware(AdmissionControlMiddleware, global_concurrency=10, default_concurrency=10, max_queue_depth=10,
+                       max_queue_wait_seconds=1, retry_after_seconds=1, bulk_routes=["GET /items"],
+                       pool_utilization=lambda: None, pool_wait_threshold_seconds=0.5,
+                       pool_wait_seconds=lambda: wait_seconds[0])
+    client = TestClient(app)
+    assert (await client.get("/items")).status_code == http_status.HTTP_200_OK
+    wait_seconds[0] = 0.6
+    assert (await client.get("/items")).status_code == http_status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+def test_pool_wait_stats():
+    stats = PoolWaitStats()
+    assert stats.current_wait_seconds(0) == 0
+    waiter = stats.begin(10)
+    # a waiter that did not get its connection yet counts with what it waited so far
+    assert stats.current_wait_seconds(13) == 3
+    stats.end(waiter, 14)
+    assert stats.waiting == 0
+    assert stats.current_wait_seconds(14) == pytest.approx(4 * WAIT_SMOOTHING)
+    assert stats.current_wait_seconds(14 + WAIT_STALE_SECONDS) == 0
+
+
+def test_pool_utilization_counts_overflow():
+    pool = TimedQueuePool(lambda: None, pool_size=2, max_overflow=2)
+    assert pool_utilization(pool) == 0
+    assert pool_utilization(NullPool(lambda: None)) is None
+    assert pool_utilization(TimedQueuePool(lambda: None, pool_size=2, max_overflow=-1)) is None
+
+# endregion
+
+# region request deadlines
+
+
+@pytest.mark.asyncio
+async def test_request_deadline_exceeded():
+    app = FastAPI()
+    cancelled = asyncio.Event()
+
+    @app.get("/slow")
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    app.add_middleware(RequestDeadlineMiddleware, default_deadline_seconds=10, header_name="X-Request-Timeout",
+                       route_deadlines={"GET /slow": 0.05})
+    response = await TestClient(app).get("/slow")
+    assert response.status_code == http_status.HTTP_504_GATEWAY_TIMEOUT
+    assert response.json()["errorMessage"] == ErrorMessages.DEADLINE_EXCEEDED
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_request_deadline_header_only_shortens():
+    app = FastAPI()
+
+    @app.get("/remaining")
+    async def remaining():
+        return dict(remaining=get_remaining_seconds())
+
+    app.add_middleware(RequestDeadlineMiddleware, default_deadline_seconds=5, header_name="X-Request-Timeout")
+    client = TestClient(app)
+    response = await client.get("/remaining", headers={"X-Request-Timeout": "1"})
+    assert 0 < response.json()["remaining"] <= 1
+    response = await client.get("/remaining", headers={"X-Request-Timeout": "100"})
+    assert 1 < response.json()["remaining"] <= 5
+
+
+@pytest.mark.asyncio
+async def test_request_cancelled_on_client_disconnect():
+    cancelled = asyncio.Event()
+
+    async def app(scope, receive, send):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    messages = [{"type": "http.request", "body": b"", "more_body": False}, {"type": "http.disconnect"}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        raise AssertionError("nothing should be sent to a disconnected client")
+
+    middleware = RequestDeadlineMiddleware(app, default_deadline_seconds=10, header_name="X-Request-Timeout")
+    scope = dict(type="http", method="GET", path="/", headers=[])
+    await asyncio.wait_for(middleware(scope, receive, send), timeout=1)
+    assert cancelled.is_set()
+
+
+def test_deadline_listeners_follow_the_engine_dialect():
+    class DeadlineTestSession(Session):
+        pass
+
+    sqlite_engine, postgres_engine = create_engine("sqlite://"), create_engine("sqlite://")
+    postgres_engine.dialect.name = "postgresql"
+    connect_listeners = [len(engine.pool.dispatch.connect) for engine in (sqlite_engine, postgres_engine)]
+    for engine in (sqlite_engine, postgres_engine, postgres_engine):
+        install_deadline_listeners(engine, DeadlineTestSession)
+    # one statement_timeout listener however many postgres engines (shards) share the session class
+    assert len(DeadlineTestSession().dispatch.after_begin) == 1
+    # the sqlite progress handler is only installed on the sqlite engine
+    assert [len(engine.pool.dispatch.connect) for engine in (sqlite_engine, postgres_engine)] == \
+           [connect_listeners[0] + 1, connect_listeners[1]]
+
+
+def create_profiled_app(tmp_path, sample_rate: float = 0.0) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/work")
+    async def work():
+        await asyncio.sleep(0.01)
+        return dict(total=sum(range(10000)))
+
+    app.add_middleware(ProfilingMiddleware, api_key="key", api_key_name="apiKey", trigger_header="X-Profile",
+                       directory=str(tmp_path), sample_rate=sample_rate)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_profiling_requires_api_key(tmp_path):
+    client = TestClient(create_profiled_app(tmp_path))
+    response = await client.get("/work", headers={"X-Profile": "1", "apiKey": "wrong"})
+    assert response.status_code == http_status.HTTP_200_OK
+    assert PROFILE_FILE_HEADER not in response.headers
+    assert not list(tmp_path.iterdir())
+
+    response = await client.get("/work?apiKey=key", headers={"X-Profile": "1"})
+    profile = json.loads((tmp_path / response.headers[PROFILE_FILE_HEADER]).read_text())
+    assert profile["$schema"] == "https://www.speedscope.app/file-format-schema.json"
+    # wall clock - the awaited sleep is part of the profile
+    assert profile["profiles"][0]["endValue"] - profile["profiles"][0]["startValue"] >= 0.01
+
+
+@pytest.mark.asyncio
+async def test_profiling_sample_rate(tmp_path):
+    response = await TestClient(create_profiled_app(tmp_path, sample_rate=1.0)).get("/work")
+    assert (tmp_path / response.headers[PROFILE_FILE_HEADER]).exists()
+
+# endregion
+
+# region sharding
+
+
+def test_shard_router_even_hash_ranges():
+    router = ShardRouter.from_settings(ShardingStrategy.HASH, [], 3)
+    assert router.ranges[0].low == 0 and router.ranges[-1].high == HASH_SLOTS
+    assert router.shard_for_key("some-code") == router.lookup(ShardRouter.hash_slot("some-code"))
+    assert router.shard_for_key("some-code") == router.shard_for_new_row("some-code")
+    assert router.shard_for_id(1) is None
+
+
+def test_shard_router_id_ranges():
+    router = ShardRouter.from_settings(ShardingStrategy.ID_RANGE, [[1, 1000, 0], [1000, None, 1]], 2)
+    assert router.shard_for_id(999) == 0
+    assert router.shard_for_id(10 ** 9) == 1
+    assert router.shard_for_key("some-code") is None
+    assert router.shard_for_new_row(None) == 1
+    with pytest.raises(KeyError):
+        router.lookup(0)
+
+
+def test_shard_router_move_range():
+    router = ShardRouter(ShardingStrategy.HASH, [ShardRange(0, 512, 0), ShardRange(512, 1024, 1)], 3)
+    assert router.move_range(256, 768, 2) == [ShardRange(0, 256, 0), ShardRange(256, 768, 2), ShardRange(768, 1024, 1)]
+    assert router.move_range(0, 512, 1) == [ShardRange(0, 1024, 1)]
+
+# endregion
+
+# region partitioning
+
+
+def test_month_start():
+    assert month_start(date(2026, 10, 19)) == date(2026, 10, 1)
+    assert month_start(date(2026, 11, 30), 2) == date(2027, 1, 1)
+    assert month_start(date(2026, 1, 5), -1) == date(2025, 12, 1)
+
+
+def test_create_partition_statements():
+    statements = create_partition_statements(date(2026, 12, 1))
+    assert partition_name(date(2026, 12, 1)) == "employees_p202612"
+    assert "ATTACH PARTITION employees_p202612 FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')" in statements[3]
+
+
+def test_detach_partition_statements():
+    statements = detach_partition_statements("employees_p202401", "archive")
+    assert statements[0].startswith("SET LOCAL lock_timeout")
+    # employees_default rules out CONCURRENTLY
+    assert statements[1] == "ALTER TABLE employees DETACH PARTITION employees_p202401"
+    assert statements[-1] == "ALTER TABLE employees_p202401 SET SCHEMA archive"
+
+
+@pytest.mark.asyncio
+async def test_partition_maintenance_skipped_while_locked_elsewhere():
+    @asynccontextmanager
+    async def locked_elsewhere(engine):
+        yield False
+
+    with patch("infra.partitioning.maintenance_lock", locked_elsewhere), \
+            patch("infra.partitioning._ensure_future_partitions") as ensure:
+        assert await ensure_future_partitions(None, 3) == []
+        ensure.assert_not_called()
+
+# endregion
+
+# region statement cache
+
+
+def test_statement_cache_builds_once_per_shape():
+    cache = StatementCache(max_size=2)
+    built = []
+
+    def build():
+        built.append(object())
+        return built[-1]
+
+    assert cache.get(("get_all", ("city",)), build) is cache.get(("get_all", ("city",)), build)
+    cache.get(("get_all", ()), build)
+    cache.get(("count", ()), build)
+    cache.get(("count", ()), build)
+    assert len(built) == 4
+    assert cache.stats() == dict(hits=1, misses=4, size=2, hitRatio=0.2)
+
+# endregion
+
+# region query plans
+
+
+def test_redundant_indexes():
+    primary_key = IndexInfo("employees_pkey", "employees", ("id",), unique=True, constraint=True)
+    unique = IndexInfo(None, "employees", ("identification_code",), unique=True, constraint=True)
+    duplicate = IndexInfo("idx_employee_identification_code", "employees", ("identification_code",), unique=False)
+    prefix = IndexInfo("idx_city", "employees", ("city",), unique=False)
+    composite = IndexInfo("idx_city_country", "employees", ("city", "country"), unique=False)
+    redundant = redundant_indexes([primary_key, unique, duplicate, prefix, composite])
+    assert [(index.name, covering.name) for index, covering in redundant] == [
+        ("idx_employee_identification_code", None), ("idx_city", "idx_city_country")]
+
+
+def test_parse_plan():
+    assert parse_plan("sqlite", ["SCAN employees", "SEARCH employees USING INDEX idx_a (a=?)"]) == \
+           (["SCAN employees"], {"idx_a"})
+    assert parse_plan("postgresql", ["Index Scan using employees_pkey on employees  (cost=0.15..8.17 rows=1)",
+                                     "  ->  Seq Scan on employees_default"]) == \
+           (["->  Seq Scan on employees_default"], {"employees_pkey"})
+
+# endregion
+
+# region wire formats
+
+
+def test_negotiate_compact_format():
+    assert negotiate_compact_format(None) is None
+    assert negotiate_compact_format("application/json") is None
+    assert negotiate_compact_format("*/*") is None
+    assert negotiate_compact_format("application/msgpack") == MSGPACK_MEDIA_TYPE
+    assert negotiate_compact_format("application/x-msgpack") == MSGPACK_MEDIA_TYPE
+    assert negotiate_compact_format(f"application/json;q=0.5, {COLUMNAR_JSON_MEDIA_TYPE}") == COLUMNAR_JSON_MEDIA_TYPE
+    assert negotiate_compact_format("application/json, application/msgpack") is None
+    assert negotiate_compact_format("application/msgpack;q=0, application/json") is None
+
+# endregion
+
+# region online migrations
+
+
+def test_create_index_statement():
+    assert create_index_statement("idx_city", "employees", ["city", "country"]) == \
+           "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_city ON employees (city, country)"
+    assert create_index_statement("idx_city", "employees", ["city"], unique=True, concurrently=False, only=True,
+                                  where="city IS NOT NULL") == \
+           "CREATE UNIQUE INDEX IF NOT EXISTS idx_city ON ONLY employees (city) WHERE city IS NOT NULL"
+
+
+def test_autogenerate_ignores_postgres_partitioning():
+    employees = Employee.__table__
+    unique_code = next(constraint for constraint in employees.constraints if isinstance(constraint, UniqueConstraint))
+    # what a partitioned postgres database has and the models do not, and the other way around
+    assert not include_object(None, "employees_p202610", "table", True, None)
+    assert not include_object(None, "employee_identification_codes", "table", True, None)
+    assert not include_object(None, "idx_employee_identification_code", "index", True, None)
+    assert not include_object(unique_code, None, "unique_constraint", False, None)
+    assert include_object(employees, "employees", "table", False, None)
+    assert include_object(None, "idx_employee_city", "index", True, None)
+
+# endregion
@@ -0,0 +1,63 @@
+"""
+compact list encodings chosen by the Accept header - {"columns": [...], "rows": [[...]]} as json or msgpack.
+every key name is sent once instead of once per entry, and the body is encoded straight from the query rows
+"""
+import json
+from datetime import date, datetime
+from typing import Any, List, Optional, Sequence
+from starlette.responses import Response
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+COLUMNAR_JSON_MEDIA_TYPE = "application/vnd.columnar+json"
+# accepted aliases of the supported media types
+MEDIA_TYPE_ALIASES = {"application/x-msgpack": MSGPACK_MEDIA_TYPE}
+COMPACT_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, COLUMNAR_JSON_MEDIA_TYPE)
+
+
+def negotiate_compact_format(accept: Optional[str]) -> Optional[str]:
+    """the compact media type preferred by the Accept header, None for the default json response"""
+    if not accept:
+        return None
+    preferred = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        media_type = MEDIA_TYPE_ALIASES.get(media_type.lower(), media_type.lower())
+        if quality > 0:
+            preferred.append((-quality, position, media_type))
+    for _, _, media_type in sorted(preferred):
+        if media_type in COMPACT_MEDIA_TYPES:
+            return media_type
+        if media_type in ("application/json", "application/*", "*/*"):
+            return None
+    return None
+
+
+def _encode_default(value: Any):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not serializable")
+
+
+def columnar_response(media_type: str, columns: Sequence[str], rows: List[tuple], status_code: int = 200) -> Response:
+    body = dict(columns=list(columns), rows=rows)
+    if media_type == MSGPACK_MEDIA_TYPE:
+        import msgpack
+
+        content = msgpack.packb(body, default=_encode_default)
+    else:
+        content = json.dumps(body, default=_encode_default, separators=(",", ":")).encode()
+    return Response(content, status_code=status_code, media_type=media_type, headers={"Vary": "Accept"})
+
+
+# openapi description of the routes that support the compact formats
+COMPACT_RESPONSES = {200: {"content": {media_type: {"schema": {
+    "type": "object", "properties": {"columns": {"type": "array", "items": {"type": "string"}},
+                                     "rows": {"type": "array", "items": {"type": "array", "items": {}}}}}}
+    for media_type in COMPACT_MEDIA_TYPES}}}
@@ -1,16 +1,30 @@
+import asyncio
 import uvicorn
 from starlette.middleware.cors import CORSMiddleware
 from routes.employees.v1.get import router as get_router
 from routes.employees.v1.put import router as put_router
 from routes.employees.v1.post import router as post_router
 from routes.employees.v1.delete import router as delete_router
+from routes.exports.v1.get import router as exports_get_router
+from routes.exports.v1.post import router as exports_post_router
+from routes.exports.v1.jobs import export_jobs
 from fastapi import Security, Depends, FastAPI, HTTPException
 from fastapi.security.api_key import APIKeyQuery, APIKeyCookie, APIKeyHeader, APIKey
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 from starlette.status import HTTP_403_FORBIDDEN
 from starlette.responses import RedirectResponse, JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from settings import settings
+from db import get_pool_utilization, get_pool_wait_seconds, engine, background_session, shard_engines
+from infra.crud.statement_cache import statement_cache
+from infra.crud.write_batcher import WriteBatcher, register_write_batcher, write_batchers
+from infra.models.employee import Employee
+from infra.outbox import OutboxDispatcher, register_outbox_model, run_outbox_dispatcher
+from infra.partitioning import run_partition_maintenance
+from infra.middlewares.admission_control import AdmissionControlMiddleware
+from infra.middlewares.request_deadline import RequestDeadlineMiddleware
+from infra.middlewares.profiling import ProfilingMiddleware
 
 app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
 
@@ -19,17 +33,87 @@ app.include_router(get_router)
 app.include_router(put_router)
 app.include_router(post_router)
 app.include_router(delete_router)
+app.include_router(exports_get_router)
+app.include_router(exports_post_router)
 # endregion
 # region add_middlewares
+if settings.ADMISSION_CONTROL_ENABLED:
+    app.add_middleware(AdmissionControlMiddleware, global_concurrency=settings.ADMISSION_GLOBAL_CONCURRENCY,
+                       default_concurrency=settings.ADMISSION_DEFAULT_CONCURRENCY,
+                       route_concurrency=settings.ADMISSION_ROUTE_CONCURRENCY,
+                       bulk_routes=settings.ADMISSION_BULK_ROUTES,
+                       exempt_routes=settings.ADMISSION_EXEMPT_ROUTES,
+                       max_queue_depth=settings.ADMISSION_MAX_QUEUE_DEPTH,
+                       max_queue_wait_seconds=settings.ADMISSION_MAX_QUEUE_WAIT_SECONDS,
+                       pool_saturation_threshold=settings.ADMISSION_POOL_SATURATION_THRESHOLD,
+                       retry_after_seconds=settings.ADMISSION_RETRY_AFTER_SECONDS,
+                       pool_utilization=get_pool_utilization,
+                       pool_wait_threshold_seconds=settings.ADMISSION_POOL_WAIT_THRESHOLD_SECONDS,
+                       pool_wait_seconds=get_pool_wait_seconds)
+app.add_middleware(RequestDeadlineMiddleware, default_deadline_seconds=settings.REQUEST_DEADLINE_SECONDS,
+                   route_deadlines=settings.ROUTE_DEADLINES, header_name=settings.REQUEST_DEADLINE_HEADER)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["*"])
 # endregion
 
+# region write batching
+# sharded writes go to the shards row by row, the batcher writes through the main engine
+if settings.WRITE_BATCHING_ENABLED and not shard_engines:
+    register_write_batcher(WriteBatcher(Employee, background_session, max_batch_size=settings.WRITE_BATCH_MAX_SIZE,
+                                        max_delay_seconds=settings.WRITE_BATCH_MAX_DELAY_MS / 1000))
+# endregion
+
+# region outbox
+outbox_dispatcher = None
+if settings.OUTBOX_WEBHOOK_URLS:
+    register_outbox_model(Employee)
+    outbox_dispatcher = OutboxDispatcher(
+        [async_sessionmaker(shard_engine, class_=AsyncSession, expire_on_commit=False) for shard_engine in shard_engines]
+        or [background_session], settings.OUTBOX_WEBHOOK_URLS, batch_size=settings.OUTBOX_BATCH_SIZE,
+        request_timeout_seconds=settings.OUTBOX_REQUEST_TIMEOUT_SECONDS,
+        max_backoff_seconds=settings.OUTBOX_MAX_BACKOFF_SECONDS, claim_seconds=settings.OUTBOX_CLAIM_SECONDS)
+# endregion
+
+# region background tasks
+background_tasks = set()
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if settings.EMPLOYEES_PARTITIONS_MONTHS_AHEAD > 0:
+        # every shard has its own partitioned employees table, the main engine is not used in sharded mode
+        for partitioned_engine in shard_engines or [engine]:
+            if partitioned_engine.dialect.name == "postgresql":
+                background_tasks.add(asyncio.create_task(run_partition_maintenance(
+                    partitioned_engine, settings.EMPLOYEES_PARTITIONS_MONTHS_AHEAD,
+                    settings.EMPLOYEES_PARTITIONS_MAINTENANCE_INTERVAL_SECONDS)))
+    if outbox_dispatcher is not None:
+        background_tasks.add(asyncio.create_task(run_outbox_dispatcher(outbox_dispatcher,
+                                                                       settings.OUTBOX_POLL_INTERVAL_SECONDS)))
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await export_jobs.close()
+# endregion
+
 # region secure api doc
 
 API_KEY = settings.SWAGGER_API_KEY
 API_KEY_NAME = "apiKey"
 COOKIE_DOMAIN = "clarity.io"
 
+# region profiling
+# outermost - the profile includes the time spent waiting for admission
+if settings.PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware, api_key=API_KEY, api_key_name=API_KEY_NAME,
+                       trigger_header=settings.PROFILING_HEADER, directory=settings.PROFILING_DIRECTORY,
+                       sample_rate=settings.PROFILING_SAMPLE_RATE, interval_seconds=settings.PROFILING_INTERVAL_SECONDS)
+# endregion
+
 
 async def get_api_key(api_key_query: str = Security(APIKeyQuery(name=API_KEY_NAME, auto_error=False)),
                       api_key_header: str = Security(APIKeyHeader(name=API_KEY_NAME, auto_error=False)),
@@ -57,6 +141,17 @@ async def get_open_api_endpoint(api_key: APIKey = Depends(get_api_key)):
     return response
 
 
+@app.get("/metrics", tags=["monitoring"])
+async def get_metrics(api_key: str = Depends(get_api_key)):
+    return JSONResponse(dict(
+        statementCache=statement_cache.stats(),
+        writeBatchers={model.__tablename__: write_batcher.stats.snapshot()
+                       for model, write_batcher in write_batchers.items()},
+        outbox=outbox_dispatcher.stats.snapshot() if outbox_dispatcher is not None else None,
+        dbPool=dict(utilization=get_pool_utilization(), waitSeconds=get_pool_wait_seconds())
+    ))
+
+
 @app.get("/docs", tags=["documentation"])
 async def get_documentation(api_key: str = Depends(get_api_key)):
     response = get_swagger_ui_html(openapi_url="/openapi.json", title="docs")
@@ -1,22 +1,31 @@
-from typing import Union
-from fastapi import APIRouter, Depends, Response, status as http_status
+from typing import Union, Optional
+from fastapi import APIRouter, Depends, Header, Response, status as http_status
 from sqlalchemy.ext.asyncio import AsyncSession
 from db import get_session
 from infra.crud.employee import EmployeesCrud
 from infra.logger import get_logger
 from infra.messages.error_messages import ErrorMessages
-from routes.employees.v1.schemas import EmployeeGetResponse, EmployeesGetResponse, EmployeeEntry
+from infra.wire_formats import negotiate_compact_format, columnar_response, COMPACT_RESPONSES
+from routes.employees.v1.schemas import EmployeeGetResponse, EmployeesGetResponse, EmployeeEntry, \
+    EmployeesBatchGetRequest, EmployeesBatchGetResponse, EmployeeBatchGetResult, ENTRY_COLUMNS
+from settings import settings
 
 logger = get_logger(__file__)
 router = APIRouter(prefix="/api/v1")
 employees_crud = EmployeesCrud()
 
 
-@router.get("/employees", response_model=EmployeesGetResponse)
-async def get_all_employees(response: Response, offset: int = 0, limit: int = 500,
+@router.get("/employees", response_model=EmployeesGetResponse, responses=COMPACT_RESPONSES)
+async def get_all_employees(response: Response, offset: int = 0, limit: int = 500, after_id: Optional[int] = None,
+                            accept: Optional[str] = Header(None),
                             session: AsyncSession = Depends(get_session)) -> EmployeesGetResponse:
     try:
-        employees = await employees_crud.get_all(session, offset=offset, limit=limit)
+        compact_format = negotiate_compact_format(accept)
+        if compact_format:
+            rows = await employees_crud.get_all_rows(session, list(ENTRY_COLUMNS.values()), offset=offset, limit=limit,
+                                                     after_id=after_id)
+            return columnar_response(compact_format, list(ENTRY_COLUMNS), rows)
+        employees = await employees_crud.get_all(session, offset=offset, limit=limit, after_id=after_id)
         entries = []
         for employee in employees:
             entries.append(EmployeeEntry(
@@ -31,12 +40,16 @@ async def get_all_employees(response: Response, offset: int = 0, limit: int = 50
     return employee_response
 
 
-@router.get("/employees/{employee_id}")
-async def get_employee_by_id(employee_id: Union[int, str], response: Response,
+@router.get("/employees/{employee_id}", responses=COMPACT_RESPONSES)
+async def get_employee_by_id(employee_id: Union[int, str], response: Response, accept: Optional[str] = Header(None),
                              session: AsyncSession = Depends(get_session)) -> EmployeeGetResponse:
     try:
         employee = await employees_crud.get_by_id(session, employee_id) if type(employee_id) is int \
             else await employees_crud.get_by_identification_code(session, employee_id)
+        compact_format = negotiate_compact_format(accept)
+        if employee and compact_format:
+            row = tuple(getattr(employee, name) for name in ENTRY_COLUMNS.values())
+            return columnar_response(compact_format, list(ENTRY_COLUMNS), [row])
         if employee:
             employee_response = EmployeeGetResponse(entry=EmployeeEntry(
                 id=employee.id, identificationCode=employee.identification_code,
@@ -50,3 +63,31 @@ async def get_employee_by_id(employee_id: Union[int, str], response: Response,
         response.status_code = http_status.HTTP_500_INTERNAL_SERVER_ERROR
         employee_response = EmployeeGetResponse(errorMessage=ErrorMessages.INTERNAL_ERROR)
     return employee_response
+
+
+@router.post("/employees/batch-get", response_model=EmployeesBatchGetResponse)
+async def batch_get_employees(request: EmployeesBatchGetRequest, response: Response,
+                              session: AsyncSession = Depends(get_session)) -> EmployeesBatchGetResponse:
+    keys = request.ids if request.ids is not None else request.identificationCodes
+    if len(keys) > settings.EMPLOYEES_BATCH_GET_MAX_KEYS:
+        response.status_code = http_status.HTTP_400_BAD_REQUEST
+        return EmployeesBatchGetResponse(errorMessage=ErrorMessages.TOO_MANY_KEYS)
+    try:
+        employees = await employees_crud.get_by_ids(session, keys) if request.ids is not None \
+            else await employees_crud.get_by_identification_codes(session, keys)
+        results = []
+        for key, employee in zip(keys, employees):
+            if employee is None:
+                results.append(EmployeeBatchGetResult(key=key, errorMessage=ErrorMessages.ENTRY_NOT_EXIST))
+                continue
+            results.append(EmployeeBatchGetResult(key=key, entry=EmployeeEntry(
+                id=employee.id, identificationCode=employee.identification_code,
+                birthDate=employee.birth_date, firstName=employee.first_name,
+                lastName=employee.last_name, city=employee.city, email=employee.email,
+                country=employee.country, street=employee.street, buildingNumber=employee.building_number)))
+        batch_get_response = EmployeesBatchGetResponse(results=results)
+    except Exception:
+        logger.exception("error at batch_get_employees")
+        response.status_code = http_status.HTTP_500_INTERNAL_SERVER_ERROR
+        batch_get_response = EmployeesBatchGetResponse(errorMessage=ErrorMessages.INTERNAL_ERROR)
+    return batch_get_response
@@ -3,6 +3,7 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from db import get_session
 from infra.crud.employee import EmployeesCrud
+from infra.crud.errors import EntryNotFoundError
 from infra.logger import get_logger
 from infra.messages.error_messages import ErrorMessages
 from routes.employees.v1.schemas import EmployeePutResponse, EmployeePutRequest, EmployeeEntry
@@ -34,6 +35,10 @@ async def update_employee(request: EmployeePutRequest, response: Response,
         else:
             r = EmployeePutResponse(errorMessage=ErrorMessages.ENTRY_NOT_EXIST)
             response.status_code = http_status.HTTP_400_BAD_REQUEST
+    except EntryNotFoundError:
+        # deleted between the lookup and the update
+        r = EmployeePutResponse(errorMessage=ErrorMessages.ENTRY_NOT_EXIST)
+        response.status_code = http_status.HTTP_400_BAD_REQUEST
     except IntegrityError:
         r = EmployeePutResponse(errorMessage=ErrorMessages.INTEGRITY_ERROR)
         response.status_code = http_status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -1,6 +1,6 @@
 from datetime import date
-from typing import Optional, List
-from pydantic import BaseModel, EmailStr
+from typing import Optional, List, Union
+from pydantic import BaseModel, EmailStr, root_validator, StrictInt, StrictStr
 
 
 class Employee(BaseModel):
@@ -15,6 +15,12 @@ class Employee(BaseModel):
     buildingNumber: str
 
 
+# response field -> model attribute, the columns of the compact (columnar / msgpack) responses
+ENTRY_COLUMNS = dict(id="id", identificationCode="identification_code", birthDate="birth_date",
+                     firstName="first_name", lastName="last_name", email="email", city="city", country="country",
+                     street="street", buildingNumber="building_number")
+
+
 class EmployeePostRequest(Employee):
     pass
 
@@ -46,6 +52,30 @@ class EmployeesGetResponse(BaseModel):
     errorMessage: Optional[str] = None
 
 
+class EmployeesBatchGetRequest(BaseModel):
+    ids: Optional[List[int]] = None
+    identificationCodes: Optional[List[str]] = None
+
+    @root_validator
+    def check_one_key_type(cls, values):
+        if (values.get("ids") is None) == (values.get("identificationCodes") is None):
+            raise ValueError("exactly one of ids, identificationCodes is required")
+        return values
+
+
+class EmployeeBatchGetResult(BaseModel):
+    # strict - the key is echoed as sent, a numeric identification code like "00123" must not become 123
+    key: Union[StrictInt, StrictStr]
+    entry: Optional[EmployeeEntry] = None
+    errorMessage: Optional[str] = None
+
+
+class EmployeesBatchGetResponse(BaseModel):
+    # in the order of the requested keys
+    results: Optional[List[EmployeeBatchGetResult]] = None
+    errorMessage: Optional[str] = None
+
+
 class DeleteResponse(BaseModel):
     entry: Optional[EmployeeEntry] = None
     errorMessage: Optional[str] = None
@@ -2,19 +2,22 @@ import random
 from datetime import datetime
 from typing import Optional
 from uuid import uuid4
+import msgpack
 import pytest
 from unittest.mock import patch, MagicMock
 from async_asgi_testclient import TestClient
 from faker import Faker
 from sqlalchemy.exc import IntegrityError
 from fastapi import status as http_status
+from infra.crud.errors import EntryNotFoundError
 from infra.general import generate_random_date
 from infra.messages.error_messages import ErrorMessages
+from infra.wire_formats import MSGPACK_MEDIA_TYPE, COLUMNAR_JSON_MEDIA_TYPE
 from infra.models.employee import Employee as EmployeeDTO
 
 from main import app
 from routes.employees.v1.schemas import EmployeeGetResponse, EmployeesGetResponse, EmployeePostRequest, \
-    EmployeePostResponse, Employee as EmployeeSchema, EmployeePutResponse, DeleteResponse
+    EmployeePostResponse, Employee as EmployeeSchema, EmployeePutResponse, DeleteResponse, EmployeesBatchGetResponse, EmployeeEntry, ENTRY_COLUMNS
 
 fake = Faker()
 
@@ -137,6 +140,83 @@ async def test_get_employee_raises_error(client: TestClient):
         response_obj = EmployeesGetResponse(**response.json())
         assert response_obj.errorMessage == ErrorMessages.INTERNAL_ERROR
 
+
+def employee_row(employee: EmployeeDTO) -> tuple:
+    return tuple(getattr(employee, name) for name in ENTRY_COLUMNS.values())
+
+
+@pytest.mark.asyncio
+async def test_get_employees_msgpack(client: TestClient):
+    rows = [employee_row(generate_dto_employee()) for _ in range(3)]
+    with patch("routes.employees.v1.get.employees_crud.get_all_rows", return_value=rows):
+        response = await client.get("/api/v1/employees?limit=3", headers={"Accept": MSGPACK_MEDIA_TYPE})
+        assert response.headers["content-type"] == MSGPACK_MEDIA_TYPE
+        body = msgpack.unpackb(response.content)
+        assert body["columns"] == list(ENTRY_COLUMNS)
+        entries = [EmployeeEntry(**dict(zip(body["columns"], row))) for row in body["rows"]]
+        assert [entry.identificationCode for entry in entries] == [row[1] for row in rows]
+        assert entries[0].birthDate == rows[0][2]
+
+
+@pytest.mark.asyncio
+async def test_get_employees_columnar_json(client: TestClient):
+    employee = generate_dto_employee()
+    with patch("routes.employees.v1.get.employees_crud.get_all_rows", return_value=[employee_row(employee)]):
+        response = await client.get("/api/v1/employees", headers={"Accept": COLUMNAR_JSON_MEDIA_TYPE})
+        body = response.json()
+        assert body["columns"] == list(ENTRY_COLUMNS)
+        assert body["rows"][0][1] == employee.identification_code
+    with patch("routes.employees.v1.get.employees_crud.get_by_id", return_value=employee):
+        response = await client.get("/api/v1/employees/1", headers={"Accept": COLUMNAR_JSON_MEDIA_TYPE})
+        assert response.json()["rows"][0][0] == employee.id
+
+# endregion
+
+# region POST batch get Employees
+
+
+@pytest.mark.asyncio
+async def test_batch_get_employees_in_request_order(client: TestClient):
+    employees = [generate_dto_employee(), None, generate_dto_employee()]
+    with patch("routes.employees.v1.get.employees_crud.get_by_ids", return_value=employees):
+        response = await client.post("/api/v1/employees/batch-get", json=dict(ids=[3, 1000, 5]))
+        response_obj = EmployeesBatchGetResponse(**response.json())
+        assert [result.key for result in response_obj.results] == [3, 1000, 5]
+        assert response_obj.results[0].entry.identificationCode == employees[0].identification_code
+        assert response_obj.results[1].entry is None
+        assert response_obj.results[1].errorMessage == ErrorMessages.ENTRY_NOT_EXIST
+        assert response_obj.results[2].entry.identificationCode == employees[2].identification_code
+
+
+@pytest.mark.asyncio
+async def test_batch_get_employees_by_identification_codes(client: TestClient):
+    employee = generate_dto_employee()
+    with patch("routes.employees.v1.get.employees_crud.get_by_identification_codes", return_value=[employee]):
+        response = await client.post("/api/v1/employees/batch-get",
+                                     json=dict(identificationCodes=[employee.identification_code]))
+        response_obj = EmployeesBatchGetResponse(**response.json())
+        assert response_obj.results[0].key == employee.identification_code
+        assert response_obj.results[0].entry.id == employee.id
+
+
+@pytest.mark.asyncio
+async def test_batch_get_employees_keeps_numeric_codes(client: TestClient):
+    employee = generate_dto_employee()
+    employee.identification_code = "00123"
+    with patch("routes.employees.v1.get.employees_crud.get_by_identification_codes", return_value=[employee, None]):
+        response = await client.post("/api/v1/employees/batch-get", json=dict(identificationCodes=["00123", "7"]))
+        assert [result["key"] for result in response.json()["results"]] == ["00123", "7"]
+
+
+@pytest.mark.asyncio
+async def test_batch_get_employees_invalid_request(client: TestClient):
+    response = await client.post("/api/v1/employees/batch-get", json=dict(ids=[1], identificationCodes=["a"]))
+    assert response.status_code == http_status.HTTP_422_UNPROCESSABLE_ENTITY
+    with patch("routes.employees.v1.get.settings.EMPLOYEES_BATCH_GET_MAX_KEYS", 2):
+        response = await client.post("/api/v1/employees/batch-get", json=dict(ids=[1, 2, 3]))
+        assert response.status_code == http_status.HTTP_400_BAD_REQUEST
+        assert EmployeesBatchGetResponse(**response.json()).errorMessage == ErrorMessages.TOO_MANY_KEYS
+
 # endregion
 
 # region POST Employee
@@ -228,6 +308,18 @@ async def test_post_employee_not_exist(client: TestClient):
             response_obj = EmployeePutResponse(**response.json())
             assert response_obj.errorMessage == ErrorMessages.ENTRY_NOT_EXIST
 
+
+@pytest.mark.asyncio
+async def test_put_employee_deleted_before_update(client: TestClient):
+    employee = generate_employee_schema_obj()
+    employee.birthDate = employee.birthDate.isoformat()
+    with patch("routes.employees.v1.put.employees_crud.get_by_identification_code",
+               return_value=generate_dto_employee()):
+        with patch("routes.employees.v1.put.employees_crud.update", side_effect=EntryNotFoundError("gone")):
+            response = await client.put("/api/v1/employees", json=employee.dict())
+            assert response.status_code == http_status.HTTP_400_BAD_REQUEST
+            assert EmployeePutResponse(**response.json()).errorMessage == ErrorMessages.ENTRY_NOT_EXIST
+
 # endregion
 
 # region DELETE Employee
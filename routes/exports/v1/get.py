@@ -0,0 +1,34 @@
+import os
+from fastapi import APIRouter, Response, status as http_status
+from starlette.responses import FileResponse, JSONResponse
+from enums.ExportJobStatus import ExportJobStatus
+from infra.exports import PARQUET_MEDIA_TYPE
+from infra.logger import get_logger
+from infra.messages.error_messages import ErrorMessages
+from routes.exports.v1.jobs import export_jobs, to_entry
+from routes.exports.v1.schemas import ExportJobResponse
+
+logger = get_logger(__file__)
+router = APIRouter(prefix="/api/v1")
+
+
+@router.get("/exports/{job_id}", response_model=ExportJobResponse)
+async def get_export_job(job_id: str, response: Response) -> ExportJobResponse:
+    job = export_jobs.get(job_id)
+    if job is None:
+        response.status_code = http_status.HTTP_404_NOT_FOUND
+        return ExportJobResponse(errorMessage=ErrorMessages.ENTRY_NOT_EXIST)
+    return ExportJobResponse(entry=to_entry(job))
+
+
+@router.get("/exports/{job_id}/file", response_class=FileResponse)
+async def download_export_file(job_id: str):
+    job = export_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(ExportJobResponse(errorMessage=ErrorMessages.ENTRY_NOT_EXIST).dict(),
+                            status_code=http_status.HTTP_404_NOT_FOUND)
+    if job.status != ExportJobStatus.SUCCEEDED:
+        return JSONResponse(ExportJobResponse(errorMessage=ErrorMessages.EXPORT_NOT_FINISHED).dict(),
+                            status_code=http_status.HTTP_409_CONFLICT)
+    # sent from disk in chunks, the file is never loaded into memory
+    return FileResponse(job.path, media_type=PARQUET_MEDIA_TYPE, filename=os.path.basename(job.path))
@@ -0,0 +1,19 @@
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from db import background_read_session, shard_engines
+from infra.exports import ExportJobManager, ExportJob
+from infra.models.employee import Employee
+from routes.exports.v1.schemas import ExportJobEntry
+from settings import settings
+
+export_jobs = ExportJobManager(
+    Employee,
+    [async_sessionmaker(shard_engine, class_=AsyncSession, expire_on_commit=False) for shard_engine in shard_engines]
+    or [background_read_session],
+    directory=settings.EXPORTS_DIRECTORY, batch_size=settings.EXPORT_BATCH_SIZE,
+    process_pool_size=settings.EXPORT_PROCESS_POOL_SIZE, max_running_jobs=settings.EXPORT_MAX_RUNNING_JOBS,
+    job_ttl_seconds=settings.EXPORT_JOB_TTL_SECONDS, max_jobs=settings.EXPORT_MAX_JOBS)
+
+
+def to_entry(job: ExportJob) -> ExportJobEntry:
+    return ExportJobEntry(id=job.id, status=job.status, createTime=job.create_time, finishTime=job.finish_time,
+                          rows=job.rows, error=job.error)
@@ -0,0 +1,18 @@
+from fastapi import APIRouter, Response, status as http_status
+from infra.logger import get_logger
+from infra.messages.error_messages import ErrorMessages
+from routes.exports.v1.jobs import export_jobs, to_entry
+from routes.exports.v1.schemas import ExportJobResponse
+
+logger = get_logger(__file__)
+router = APIRouter(prefix="/api/v1")
+
+
+@router.post("/exports/employees", response_model=ExportJobResponse, status_code=http_status.HTTP_202_ACCEPTED)
+async def start_employees_export(response: Response) -> ExportJobResponse:
+    job = export_jobs.start()
+    if job is None:
+        response.status_code = http_status.HTTP_503_SERVICE_UNAVAILABLE
+        return ExportJobResponse(errorMessage=ErrorMessages.SERVICE_OVERLOADED)
+    response.headers["Location"] = f"{router.prefix}/exports/{job.id}"
+    return ExportJobResponse(entry=to_entry(job))
@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+from enums.ExportJobStatus import ExportJobStatus
+
+
+class ExportJobEntry(BaseModel):
+    id: str
+    status: ExportJobStatus
+    createTime: datetime
+    finishTime: Optional[datetime] = None
+    rows: int
+    error: Optional[str] = None
+
+
+class ExportJobResponse(BaseModel):
+    entry: Optional[ExportJobEntry] = None
+    errorMessage: Optional[str] = None
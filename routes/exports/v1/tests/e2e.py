@@ -0,0 +1,53 @@
+from datetime import datetime
+import pytest
+from unittest.mock import patch
+from async_asgi_testclient import TestClient
+from fastapi import status as http_status
+from enums.ExportJobStatus import ExportJobStatus
+from infra.exports import ExportJob
+from infra.messages.error_messages import ErrorMessages
+from main import app
+from routes.exports.v1.schemas import ExportJobResponse
+
+
+@pytest.fixture
+def client() -> TestClient:
+    return TestClient(app)
+
+
+@pytest.mark.asyncio
+async def test_start_export(client):
+    job = ExportJob(id="1", path="exports/employees-1.parquet")
+    with patch("routes.exports.v1.post.export_jobs.start", return_value=job):
+        response = await client.post("/api/v1/exports/employees")
+        assert response.status_code == http_status.HTTP_202_ACCEPTED
+        assert response.headers["Location"] == "/api/v1/exports/1"
+        assert ExportJobResponse(**response.json()).entry.status == ExportJobStatus.PENDING
+
+
+@pytest.mark.asyncio
+async def test_start_export_too_many_jobs(client):
+    with patch("routes.exports.v1.post.export_jobs.start", return_value=None):
+        response = await client.post("/api/v1/exports/employees")
+        assert response.status_code == http_status.HTTP_503_SERVICE_UNAVAILABLE
+        assert response.json()["errorMessage"] == ErrorMessages.SERVICE_OVERLOADED
+
+
+@pytest.mark.asyncio
+async def test_download_export(client, tmp_path):
+    path = tmp_path / "employees-1.parquet"
+    path.write_bytes(b"PAR1")
+    job = ExportJob(id="1", path=str(path), status=ExportJobStatus.RUNNING)
+    with patch("routes.exports.v1.get.export_jobs.get", return_value=job):
+        response = await client.get("/api/v1/exports/1/file")
+        assert response.status_code == http_status.HTTP_409_CONFLICT
+        assert response.json()["errorMessage"] == ErrorMessages.EXPORT_NOT_FINISHED
+
+        job.status, job.finish_time, job.rows = ExportJobStatus.SUCCEEDED, datetime.utcnow(), 0
+        response = await client.get("/api/v1/exports/1/file")
+        assert response.status_code == http_status.HTTP_200_OK
+        assert response.content == b"PAR1"
+
+    with patch("routes.exports.v1.get.export_jobs.get", return_value=None):
+        response = await client.get("/api/v1/exports/2")
+        assert response.status_code == http_status.HTTP_404_NOT_FOUND
@@ -1,7 +1,9 @@
 import os
-from typing import Optional
+from typing import Optional, Dict, List
 from pydantic import BaseSettings
 from enums.DBType import DBType
+from enums.SQLiteProfile import SQLiteProfile
+from enums.ShardingStrategy import ShardingStrategy
 
 
 class Settings(BaseSettings):
@@ -15,6 +17,62 @@ class Settings(BaseSettings):
     DB_USERNAME: Optional[str] = None
     DB_PASSWORD: Optional[str] = None
 
+    # region sqlite
+    # high_concurrency - WAL + tuned pragmas, writes serialized through a single writer connection, reads on a pool
+    SQLITE_PROFILE: SQLiteProfile = SQLiteProfile.DEFAULT
+    SQLITE_READER_POOL_SIZE: int = 8
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE_KIB: int = 64 * 1024
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    # endregion
+
+    # region sharding
+    # sharded mode is on when shard urls are given (shard N is the N-th url), DB_HOST & co. are ignored then
+    DB_SHARD_URLS: List[str] = []
+    DB_SHARDING_STRATEGY: ShardingStrategy = ShardingStrategy.HASH
+    # [[low, high (exclusive, null = open ended), shard], ...] over hash slots (hash) or ids (id_range),
+    # the hash strategy defaults to an even split of the slots
+    DB_SHARD_RANGES: List[List[Optional[int]]] = []
+    # endregion
+
+    # region employees partitions (postgres)
+    # future monthly partitions kept around by the app, 0 disables the maintenance
+    EMPLOYEES_PARTITIONS_MONTHS_AHEAD: int = 3
+    EMPLOYEES_PARTITIONS_MAINTENANCE_INTERVAL_SECONDS: float = 24 * 60 * 60
+    # endregion
+
+    # region write batching (group commit)
+    # concurrent single row creates / updates are written in one transaction, opt-in
+    WRITE_BATCHING_ENABLED: bool = False
+    WRITE_BATCH_MAX_SIZE: int = 64
+    WRITE_BATCH_MAX_DELAY_MS: float = 5
+    # endregion
+
+    # region outbox
+    # employee change events are written to the outbox and posted (json arrays) to these urls, off when empty
+    OUTBOX_WEBHOOK_URLS: List[str] = []
+    OUTBOX_BATCH_SIZE: int = 100
+    OUTBOX_POLL_INTERVAL_SECONDS: float = 1.0
+    OUTBOX_REQUEST_TIMEOUT_SECONDS: float = 5.0
+    OUTBOX_MAX_BACKOFF_SECONDS: float = 300.0
+    # claimed events are skipped by the other workers for this long - should outlast the posts of one round
+    OUTBOX_CLAIM_SECONDS: float = 60.0
+    # endregion
+
+    # keys accepted by POST /api/v1/employees/batch-get
+    EMPLOYEES_BATCH_GET_MAX_KEYS: int = 500
+
+    # region exports
+    # parquet files of finished export jobs, relative paths are relative to the working directory
+    EXPORTS_DIRECTORY: str = "exports"
+    EXPORT_BATCH_SIZE: int = 10000
+    EXPORT_PROCESS_POOL_SIZE: int = 2
+    EXPORT_MAX_RUNNING_JOBS: int = 2
+    # finished jobs and their files are deleted after the ttl, or oldest first once more jobs are kept
+    EXPORT_JOB_TTL_SECONDS: float = 3600.0
+    EXPORT_MAX_JOBS: int = 20
+    # endregion
+
     # region local app settings
     APP_HOST: str = "localhost"
     APP_PORT: int = 5000
@@ -22,6 +80,44 @@ class Settings(BaseSettings):
 
     SWAGGER_API_KEY: str = "1234567"
 
+    # region profiling
+    # off - the middleware is not added at all. on - requests sending PROFILING_HEADER with the swagger api key and
+    # a PROFILING_SAMPLE_RATE share of all requests are profiled into PROFILING_DIRECTORY
+    PROFILING_ENABLED: bool = False
+    PROFILING_HEADER: str = "X-Profile"
+    PROFILING_SAMPLE_RATE: float = 0.0
+    PROFILING_DIRECTORY: str = "profiles"
+    PROFILING_INTERVAL_SECONDS: float = 0.001
+    # endregion
+
+    # region admission control
+    ADMISSION_CONTROL_ENABLED: bool = True
+    # shared by all routes, should roughly match the db pool size
+    ADMISSION_GLOBAL_CONCURRENCY: int = 32
+    ADMISSION_DEFAULT_CONCURRENCY: int = 16
+    # per route overrides, keyed by "<METHOD> <route path>", e.g. {"GET /api/v1/employees": 4}
+    ADMISSION_ROUTE_CONCURRENCY: Dict[str, int] = {}
+    ADMISSION_BULK_ROUTES: List[str] = ["GET /api/v1/employees", "POST /api/v1/employees/batch-get"]
+    # never limited - file downloads do not touch the db and would hold their slots until the last byte is sent
+    ADMISSION_EXEMPT_ROUTES: List[str] = ["GET /api/v1/exports/{job_id}/file"]
+    ADMISSION_MAX_QUEUE_DEPTH: int = 64
+    ADMISSION_MAX_QUEUE_WAIT_SECONDS: float = 2.0
+    # bulk routes are shed once the checked out share of pool_size + max_overflow or the checkout wait reaches these,
+    # inactive with the default sqlite engine (NullPool has neither)
+    ADMISSION_POOL_SATURATION_THRESHOLD: float = 1.0
+    ADMISSION_POOL_WAIT_THRESHOLD_SECONDS: float = 0.5
+    ADMISSION_RETRY_AFTER_SECONDS: int = 1
+    # endregion
+
+    # region request deadlines
+    REQUEST_DEADLINE_SECONDS: float = 30.0
+    # per route overrides, keyed by "<METHOD> <route path>", e.g. {"GET /api/v1/employees": 10}
+    # export downloads are bound by the client's bandwidth, not by the db
+    ROUTE_DEADLINES: Dict[str, float] = {"GET /api/v1/exports/{job_id}/file": 60 * 60}
+    # clients may shorten (never extend) the deadline by sending the number of seconds in this header
+    REQUEST_DEADLINE_HEADER: str = "X-Request-Timeout"
+    # endregion
+
     class Config:
         case_sensitive = True
 